@@ -36,12 +36,17 @@ class API(IAPIEvents):
 
     ########################################
 
-    def store_add(self, storage_id, package):
+    def store_add(self, storage_id, package, backend=None):
+        # Only pass the backend along if one was picked, custom APIs might not take one
+        kwargs = {}
+        if backend:
+            kwargs["backend"] = backend
+
         package_hash = None
         if self.custom_api and hasattr(self.custom_api, 'store_add'):
-            package_hash = self.custom_api.store_add(storage_id, package)
+            package_hash = self.custom_api.store_add(storage_id, package, **kwargs)
         else:
-            package_hash = self.default_api.store_add(storage_id, package)
+            package_hash = self.default_api.store_add(storage_id, package, **kwargs)
         return package_hash
 
     def store_get(self, storage_id=None):
@@ -90,19 +95,97 @@ class API(IAPIEvents):
             matches = self.default_api.store_find_matches(storage_id, partial_package_hash)
         return matches
 
-    def store_ls(self, storage_id, package_hash):
+    def store_ls(self, storage_id, package_hash, relpath=None, offset=0, limit=None, recursive=False):
+        # Only pass along what was asked for, custom APIs might not take them
+        kwargs = {}
+        if relpath:
+            kwargs["relpath"] = relpath
+        if offset:
+            kwargs["offset"] = offset
+        if limit is not None:
+            kwargs["limit"] = limit
+        if recursive:
+            kwargs["recursive"] = recursive
+
         package_fileinfos = None
         if self.custom_api and hasattr(self.custom_api, 'store_ls'):
-            package_fileinfos = self.custom_api.store_ls(storage_id, package_hash)
+            package_fileinfos = self.custom_api.store_ls(storage_id, package_hash, **kwargs)
         else:
-            package_fileinfos = self.default_api.store_ls(storage_id, package_hash)
+            package_fileinfos = self.default_api.store_ls(storage_id, package_hash, **kwargs)
         return package_fileinfos
 
-    def store_download(self, storage_id, package_hash, target_path):
+    def store_download(self, storage_id, package_hash, target_path, include=None):
+        # Only pass include along if given, custom APIs might not take it
+        kwargs = {}
+        if include:
+            kwargs["include"] = include
+
         if self.custom_api and hasattr(self.custom_api, 'store_download'):
-            self.custom_api.store_download(storage_id, package_hash, target_path)
+            self.custom_api.store_download(storage_id, package_hash, target_path, **kwargs)
+        else:
+            self.default_api.store_download(storage_id, package_hash, target_path, **kwargs)
+
+    def store_verify(self, storage_id, package_hash, paths=None):
+        problems = None
+        if self.custom_api and hasattr(self.custom_api, 'store_verify'):
+            problems = self.custom_api.store_verify(storage_id, package_hash, paths)
+        else:
+            problems = self.default_api.store_verify(storage_id, package_hash, paths)
+        return problems
+
+    def store_verify_packages(self, packages, max_workers=None, checkpoint_path=None, limit=None):
+        results = None
+        if self.custom_api and hasattr(self.custom_api, 'store_verify_packages'):
+            results = self.custom_api.store_verify_packages(packages, max_workers, checkpoint_path, limit)
+        else:
+            results = self.default_api.store_verify_packages(packages, max_workers, checkpoint_path, limit)
+        return results
+
+    def store_quarantine(self, storage_id, package_hash):
+        quarantine_path = None
+        if self.custom_api and hasattr(self.custom_api, 'store_quarantine'):
+            quarantine_path = self.custom_api.store_quarantine(storage_id, package_hash)
+        else:
+            quarantine_path = self.default_api.store_quarantine(storage_id, package_hash)
+        return quarantine_path
+
+    def store_gc(self, dry_run=False):
+        result = None
+        if self.custom_api and hasattr(self.custom_api, 'store_gc'):
+            result = self.custom_api.store_gc(dry_run)
+        else:
+            result = self.default_api.store_gc(dry_run)
+        return result
+
+    def store_get_settings(self, storage_id):
+        settings = None
+        if self.custom_api and hasattr(self.custom_api, 'store_get_settings'):
+            settings = self.custom_api.store_get_settings(storage_id)
+        else:
+            settings = self.default_api.store_get_settings(storage_id)
+        return settings
+
+    def store_set_setting(self, storage_id, name, value):
+        if self.custom_api and hasattr(self.custom_api, 'store_set_setting'):
+            self.custom_api.store_set_setting(storage_id, name, value)
+        else:
+            self.default_api.store_set_setting(storage_id, name, value)
+
+    def store_abbreviate(self, storage_id, package_hash, min_length=None):
+        abbrev = None
+        if self.custom_api and hasattr(self.custom_api, 'store_abbreviate'):
+            abbrev = self.custom_api.store_abbreviate(storage_id, package_hash, min_length)
+        else:
+            abbrev = self.default_api.store_abbreviate(storage_id, package_hash, min_length)
+        return abbrev
+
+    def store_migrate(self, storage_id, layout):
+        moved = None
+        if self.custom_api and hasattr(self.custom_api, 'store_migrate'):
+            moved = self.custom_api.store_migrate(storage_id, layout)
         else:
-            self.default_api.store_download(storage_id, package_hash, target_path)
+            moved = self.default_api.store_migrate(storage_id, layout)
+        return moved
 
     ########################################
 
@@ -5,6 +5,7 @@ from libmailcd.constants import DEFAULT_ENV_CONFIG_NAME
 from libmailcd.constants import LOCAL_MB_ROOT
 
 import libmailcd.storage
+import libmailcd.verify
 import libmailcd.env
 import libmailcd.cred
 
@@ -43,8 +44,8 @@ class DefaultAPI(IAPIEvents):
 
     ########################################
 
-    def store_add(self, storage_id, package):
-        package_hash = libmailcd.storage.add(storage_id, package)
+    def store_add(self, storage_id, package, backend=None):
+        package_hash = libmailcd.storage.add(storage_id, package, backend=backend)
         return package_hash
 
     def store_get(self, storage_id=None):
@@ -73,12 +74,50 @@ class DefaultAPI(IAPIEvents):
         matches = libmailcd.storage.get_package_hash_matches(storage_id, partial_package_hash)
         return matches
 
-    def store_ls(self, storage_id, package_hash):
-        package_fileinfos = libmailcd.storage.ls(storage_id, package_hash)
+    def store_ls(self, storage_id, package_hash, relpath=None, offset=0, limit=None, recursive=False):
+        package_fileinfos = libmailcd.storage.ls(
+            storage_id,
+            package_hash,
+            relpath=relpath,
+            offset=offset,
+            limit=limit,
+            recursive=recursive
+        )
         return package_fileinfos
 
-    def store_download(self, storage_id, package_hash, target_path):
-        libmailcd.storage.download(storage_id, package_hash, target_path)
+    def store_download(self, storage_id, package_hash, target_path, include=None):
+        libmailcd.storage.download(storage_id, package_hash, target_path, include=include)
+
+    def store_verify(self, storage_id, package_hash, paths=None):
+        problems = libmailcd.storage.verify(storage_id, package_hash, paths)
+        return problems
+
+    def store_verify_packages(self, packages, max_workers=None, checkpoint_path=None, limit=None):
+        results = libmailcd.verify.verify_packages(packages, max_workers, checkpoint_path, limit)
+        return results
+
+    def store_quarantine(self, storage_id, package_hash):
+        quarantine_path = libmailcd.storage.quarantine(storage_id, package_hash)
+        return quarantine_path
+
+    def store_gc(self, dry_run=False):
+        removed, chunks_removed, freed = libmailcd.storage.gc(dry_run=dry_run)
+        return removed, chunks_removed, freed
+
+    def store_get_settings(self, storage_id):
+        settings = libmailcd.storage.get_settings(storage_id)
+        return settings
+
+    def store_set_setting(self, storage_id, name, value):
+        libmailcd.storage.set_setting(storage_id, name, value)
+
+    def store_abbreviate(self, storage_id, package_hash, min_length=None):
+        abbrev = libmailcd.storage.abbreviate(storage_id, package_hash, min_length)
+        return abbrev
+
+    def store_migrate(self, storage_id, layout):
+        moved = libmailcd.storage.migrate_layout(storage_id, layout)
+        return moved
 
     ########################################
 
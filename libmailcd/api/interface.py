@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 
 class IAPIEvents(ABC):
     @abstractmethod
-    def store_add(self, storage_id, package):
+    def store_add(self, storage_id, package, backend=None):
         raise NotImplementedError
 
     @abstractmethod
@@ -30,11 +30,43 @@ class IAPIEvents(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def store_ls(self, storage_id, package_hash):
+    def store_ls(self, storage_id, package_hash, relpath=None, offset=0, limit=None, recursive=False):
         raise NotImplementedError
 
     @abstractmethod
-    def store_download(self, storage_id, package_hash, target_path):
+    def store_download(self, storage_id, package_hash, target_path, include=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_verify(self, storage_id, package_hash, paths=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_verify_packages(self, packages, max_workers=None, checkpoint_path=None, limit=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_quarantine(self, storage_id, package_hash):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_gc(self, dry_run=False):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_get_settings(self, storage_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_set_setting(self, storage_id, name, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_abbreviate(self, storage_id, package_hash, min_length=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def store_migrate(self, storage_id, layout):
         raise NotImplementedError
 
     @abstractmethod
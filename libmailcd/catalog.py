@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+import libmailcd.hashing
+import libmailcd.utils
+
+########################################
+
+CATALOG_FILENAME = "catalog.db"
+
+# A package's last use is only recorded if the one on record is older than this
+#  (so reading the same package over and over doesn't write every time)
+TOUCH_INTERVAL = 60 * 60
+
+# Each entry upgrades the schema by one version (PRAGMA user_version).
+#  Never edit an entry that has shipped, append a new one instead.
+_SCHEMA_MIGRATIONS = [
+    """
+    CREATE TABLE packages (
+        storage_id TEXT NOT NULL,
+        package_hash TEXT NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        added REAL NOT NULL,
+        PRIMARY KEY (storage_id, package_hash)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE labels (
+        storage_id TEXT NOT NULL,
+        package_hash TEXT NOT NULL,
+        label TEXT NOT NULL,
+        PRIMARY KEY (storage_id, package_hash, label)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX labels_by_label ON labels (storage_id, label, package_hash);
+    """,
+    """
+    CREATE TABLE settings (
+        storage_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (storage_id, name)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE trees (
+        package_hash TEXT NOT NULL PRIMARY KEY,
+        tree BLOB NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE packages ADD COLUMN last_used REAL;
+
+    CREATE INDEX packages_by_last_used ON packages (storage_id, last_used);
+    """,
+]
+
+_local = threading.local()
+
+########################################
+
+def open_catalog(storage_root):
+    """Get the catalog for a storage root.
+
+    Connections are cached per thread, sqlite connections can't be shared
+    between threads.
+    """
+    catalogs = getattr(_local, "catalogs", None)
+    if catalogs is None:
+        catalogs = _local.catalogs = {}
+
+    key = str(storage_root)
+    if key not in catalogs:
+        catalogs[key] = Catalog(storage_root)
+
+    return catalogs[key]
+
+class Catalog():
+    """Package metadata (packages, labels, trees, settings) for every storage ID under a storage root.
+    """
+
+    def __init__(self, storage_root):
+        self.storage_root = Path(storage_root)
+        self.path = Path(self.storage_root, CATALOG_FILENAME)
+
+        os.makedirs(self.storage_root, exist_ok=True)
+
+        self._conn = sqlite3.connect(str(self.path), timeout=30)
+        # NOTE: the storage root can be shared between machines (e.g. over NFS),
+        #  WAL needs shared memory between every connection so it only works on
+        #  a local disk. The rollback journal works anywhere locking does.
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+
+        self._upgrade()
+
+    def _upgrade(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(_SCHEMA_MIGRATIONS):
+            return
+
+        # Take the write lock before checking again, another process might be
+        #  creating the catalog at the same time
+        self._conn.isolation_level = None
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            is_new = (version == 0)
+
+            for migration in _SCHEMA_MIGRATIONS[version:]:
+                for statement in migration.split(";"):
+                    if statement.strip():
+                        self._conn.execute(statement)
+            self._conn.execute(f"PRAGMA user_version = {len(_SCHEMA_MIGRATIONS)}")
+
+            if is_new:
+                migrate_yaml_db(self, self.storage_root)
+
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._conn.isolation_level = ""
+
+    ########################################
+
+    def get_storage_ids(self):
+        rows = self._conn.execute(
+            "SELECT DISTINCT storage_id FROM packages ORDER BY storage_id"
+        )
+        return [row[0] for row in rows]
+
+    def has_storage_id(self, storage_id):
+        row = self._conn.execute(
+            "SELECT 1 FROM packages WHERE storage_id = ? LIMIT 1",
+            (storage_id,)
+        ).fetchone()
+        return row is not None
+
+    def get_packages(self, storage_id):
+        rows = self._conn.execute(
+            "SELECT package_hash FROM packages WHERE storage_id = ? ORDER BY package_hash",
+            (storage_id,)
+        )
+        return [row[0] for row in rows]
+
+    def get_package(self, storage_id, package_hash):
+        """Get the record for a package (or None if not in the catalog)
+        """
+        row = self._conn.execute(
+            "SELECT package_hash, size, added FROM packages WHERE storage_id = ? AND package_hash = ?",
+            (storage_id, package_hash)
+        ).fetchone()
+
+        if not row:
+            return None
+
+        return {
+            "hash": row[0],
+            "size": row[1],
+            "added": row[2]
+        }
+
+    def get_package_infos(self, storage_id):
+        """Get the records of every package of a storage ID, least recently used first
+        (packages never used count as used when they were added)
+        """
+        rows = self._conn.execute(
+            "SELECT package_hash, size, added, COALESCE(last_used, added) AS used FROM packages"
+            " WHERE storage_id = ? ORDER BY used, package_hash",
+            (storage_id,)
+        )
+        return [{ "hash": row[0], "size": row[1], "added": row[2], "last_used": row[3] } for row in rows]
+
+    def touch_package(self, storage_id, package_hash, when=None):
+        """Record that a package was used (downloaded, listed, ...)
+        """
+        if when is None:
+            when = time.time()
+
+        with self._conn:
+            self._conn.execute(
+                "UPDATE packages SET last_used = ?"
+                " WHERE storage_id = ? AND package_hash = ? AND (last_used IS NULL OR last_used < ?)",
+                (when, storage_id, package_hash, when - TOUCH_INTERVAL)
+            )
+
+    def remove_package(self, storage_id, package_hash):
+        """Remove a package and its labels (and its tree, if no other storage ID has the package)
+        """
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM labels WHERE storage_id = ? AND package_hash = ?",
+                (storage_id, package_hash)
+            )
+            self._conn.execute(
+                "DELETE FROM packages WHERE storage_id = ? AND package_hash = ?",
+                (storage_id, package_hash)
+            )
+            self._conn.execute(
+                "DELETE FROM trees WHERE package_hash = ?"
+                " AND NOT EXISTS (SELECT 1 FROM packages WHERE package_hash = ?)",
+                (package_hash, package_hash)
+            )
+
+    def add_package(self, storage_id, package_hash, size, added=None):
+        if added is None:
+            added = time.time()
+
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO packages (storage_id, package_hash, size, added) VALUES (?, ?, ?, ?)",
+                (storage_id, package_hash, size, added)
+            )
+
+    def get_package_hash_matches(self, storage_id, partial_package_hash):
+        """Get all package hashes starting with partial_package_hash (an index range scan)
+        """
+        query = "SELECT package_hash FROM packages WHERE storage_id = ?"
+        params = [storage_id]
+
+        if partial_package_hash:
+            query += " AND package_hash >= ? AND package_hash < ?"
+            params.append(partial_package_hash)
+            params.append(_prefix_upper_bound(partial_package_hash))
+
+        rows = self._conn.execute(query + " ORDER BY package_hash", params)
+        return [row[0] for row in rows]
+
+    def get_neighbours(self, storage_id, package_hash):
+        """Get the package hashes just before and just after package_hash (in hash
+        order, package_hash itself doesn't need to exist), two index lookups.
+        """
+        neighbours = []
+        for query in [
+            "SELECT package_hash FROM packages WHERE storage_id = ? AND package_hash < ? ORDER BY package_hash DESC LIMIT 1",
+            "SELECT package_hash FROM packages WHERE storage_id = ? AND package_hash > ? ORDER BY package_hash LIMIT 1"
+        ]:
+            row = self._conn.execute(query, (storage_id, package_hash)).fetchone()
+            if row is not None:
+                neighbours.append(row[0])
+        return neighbours
+
+    ########################################
+
+    def get_labels(self, storage_id, package_hash):
+        rows = self._conn.execute(
+            "SELECT label FROM labels WHERE storage_id = ? AND package_hash = ? ORDER BY label",
+            (storage_id, package_hash)
+        )
+        return [row[0] for row in rows]
+
+    def add_label(self, storage_id, package_hash, label):
+        """Add a label to a package.
+
+        Returns False if the package already had the label.
+        """
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO labels (storage_id, package_hash, label) VALUES (?, ?, ?)",
+                (storage_id, package_hash, label)
+            )
+        return cursor.rowcount == 1
+
+    def find(self, storage_id, labels):
+        """Find all packages (in storage_id) that have every one of the labels.
+        """
+        labels = list(set(labels))
+        if not labels:
+            return self.get_packages(storage_id)
+
+        placeholders = ", ".join("?" for _ in labels)
+        rows = self._conn.execute(
+            f"SELECT package_hash FROM labels"
+            f" WHERE storage_id = ? AND label IN ({placeholders})"
+            f" GROUP BY package_hash HAVING COUNT(*) = ?"
+            f" ORDER BY package_hash",
+            [storage_id, *labels, len(labels)]
+        )
+        return [row[0] for row in rows]
+
+    ########################################
+
+    # NOTE: trees are keyed by package hash only, a package hash is the same
+    #  content (and so the same tree) in every storage ID
+    def get_tree(self, package_hash):
+        """Get the (serialized) Merkle tree of a package, None if there isn't one (see libmailcd.merkle)
+        """
+        row = self._conn.execute(
+            "SELECT tree FROM trees WHERE package_hash = ?",
+            (package_hash,)
+        ).fetchone()
+
+        if not row:
+            return None
+
+        return bytes(row[0])
+
+    def set_tree(self, package_hash, tree):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO trees (package_hash, tree) VALUES (?, ?)",
+                (package_hash, tree)
+            )
+
+    ########################################
+
+    def get_settings(self, storage_id):
+        rows = self._conn.execute(
+            "SELECT name, value FROM settings WHERE storage_id = ? ORDER BY name",
+            (storage_id,)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def get_setting(self, storage_id, name, default=None):
+        row = self._conn.execute(
+            "SELECT value FROM settings WHERE storage_id = ? AND name = ?",
+            (storage_id, name)
+        ).fetchone()
+
+        if not row:
+            return default
+
+        return row[0]
+
+    def set_setting(self, storage_id, name, value):
+        """Set a setting of a storage ID (None to unset it)
+        """
+        with self._conn:
+            if value is None:
+                self._conn.execute(
+                    "DELETE FROM settings WHERE storage_id = ? AND name = ?",
+                    (storage_id, name)
+                )
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO settings (storage_id, name, value) VALUES (?, ?, ?)",
+                    (storage_id, name, str(value))
+                )
+
+########################################
+
+def _prefix_upper_bound(prefix):
+    """Smallest string that sorts after every string starting with prefix.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _get_directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+# Name of the per-storage ID yaml database the catalog replaced
+LEGACY_DB_FILENAME = "db.yml"
+
+def migrate_yaml_db(catalog, storage_root):
+    """Import a store from before the catalog existed.
+
+    Registers every package directory found under storage_root, and the labels
+    from each storage ID's db.yml. The yaml files are left in place (but are no
+    longer read or written).
+    """
+    conn = catalog._conn
+
+    if not storage_root.exists():
+        return
+
+    for storage_id in os.listdir(storage_root):
+        storage_path = Path(storage_root, storage_id)
+        if not storage_path.is_dir() or storage_id.startswith("."):
+            continue
+
+        logging.debug(f"catalog: importing {storage_id}")
+
+        for package_hash in os.listdir(storage_path):
+            package_path = Path(storage_path, package_hash)
+            if not package_path.is_dir() or not libmailcd.hashing.is_package_id(package_hash):
+                continue
+
+            conn.execute(
+                "INSERT OR IGNORE INTO packages (storage_id, package_hash, size, added) VALUES (?, ?, ?, ?)",
+                (storage_id, package_hash, _get_directory_size(package_path), package_path.stat().st_mtime)
+            )
+
+        db_file_path = Path(storage_path, LEGACY_DB_FILENAME)
+        if db_file_path.exists():
+            db = libmailcd.utils.load_yaml(db_file_path) or {}
+            for package_hash, package_info in db.items():
+                for label in (package_info or {}).get("labels") or []:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO labels (storage_id, package_hash, label) VALUES (?, ?, ?)",
+                        (storage_id, package_hash, label)
+                    )
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+import zipfile
+from pathlib import Path
+
+import libmailcd.hashcache
+import libmailcd.hashing
+import libmailcd.manifest
+
+########################################
+
+# Packages stored as chunks have this file (instead of a zip) in their package directory
+CHUNK_MANIFEST_SUFFIX = ".chunks.json"
+CHUNK_MANIFEST_VERSION = 1
+
+CHUNK_INDEX_FILENAME = "index.db"
+
+# Chunk sizes: boundaries are content-defined, but never closer than the
+#  minimum or further apart than the maximum.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_BITS = 20 # ~1 MiB
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+COMPRESS_LEVEL = 6
+
+########################################
+# Content-defined chunking
+#
+# Every byte is mapped to a '0' or '1' (half the byte values each), and a chunk
+#  ends wherever the last CHUNK_AVG_BITS bytes map to a fixed pattern. Like a
+#  rolling hash, a boundary only depends on the bytes right before it, so an
+#  insert/delete only changes the chunks around it. Unlike a rolling hash, it
+#  can be done with bytes.translate() and bytes.find(), at memory speed.
+
+def _make_bit_table():
+    ranked = sorted(range(256), key=lambda b: hashlib.blake2b(bytes([b]), digest_size=8).digest())
+    table = bytearray(b"0" * 256)
+    for b in ranked[:128]:
+        table[b] = ord("1")
+    return bytes(table)
+
+def _make_boundary_pattern():
+    seed = hashlib.blake2b(b"libmailcd.chunkstore", digest_size=CHUNK_AVG_BITS).digest()
+    return bytes(ord("1") if b & 1 else ord("0") for b in seed)
+
+_BIT_TABLE = _make_bit_table()
+_BOUNDARY_PATTERN = _make_boundary_pattern()
+
+def _find_cut(bits, start, end):
+    """Length of the chunk starting at start (bits is the translated data, end the end of it)
+    """
+    if end - start <= CHUNK_MIN_SIZE:
+        return end - start
+
+    search_end = min(end, start + CHUNK_MAX_SIZE)
+    index = bits.find(_BOUNDARY_PATTERN, start + CHUNK_MIN_SIZE - len(_BOUNDARY_PATTERN), search_end)
+    if index < 0:
+        return search_end - start
+
+    return index + len(_BOUNDARY_PATTERN) - start
+
+def iter_chunks(f, digester=None):
+    """Split a (binary) file object into content-defined chunks.
+
+    If digester given, it's fed the entire contents along the way.
+    """
+    pending = bytearray()
+    for data in libmailcd.hashing.read_chunks(f):
+        if digester:
+            digester.update(data)
+        pending += data
+
+        # Only cut once there's a full max sized chunk, so where a cut lands
+        #  doesn't depend on how the file was read
+        if len(pending) < CHUNK_MAX_SIZE * 2:
+            continue
+
+        bits = pending.translate(_BIT_TABLE)
+        offset = 0
+        while len(pending) - offset >= CHUNK_MAX_SIZE:
+            cut = _find_cut(bits, offset, len(pending))
+            yield bytes(pending[offset:offset + cut])
+            offset += cut
+        del pending[:offset]
+
+    bits = pending.translate(_BIT_TABLE)
+    offset = 0
+    while offset < len(pending):
+        cut = _find_cut(bits, offset, len(pending))
+        yield bytes(pending[offset:offset + cut])
+        offset += cut
+
+########################################
+
+_local = threading.local()
+
+def open_chunk_store(root):
+    """Get the chunk store at root (connections are cached per thread)
+    """
+    stores = getattr(_local, "stores", None)
+    if stores is None:
+        stores = _local.stores = {}
+
+    key = str(root)
+    if key not in stores:
+        stores[key] = ChunkStore(root)
+
+    return stores[key]
+
+class ChunkStore():
+    """Unique chunks, shared by every package stored as chunks.
+
+    Chunks are stored (compressed) at <root>/<id[:2]>/<id>, and packages are
+     stored as a chunk manifest (see add()), so content shared between packages
+     is only stored once.
+
+    The index remembers which chunks a file's contents (by digest) were split
+     into, so unchanged files are never read or chunked again.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        os.makedirs(self.root, exist_ok=True)
+
+        self._conn = sqlite3.connect(str(Path(self.root, CHUNK_INDEX_FILENAME)), timeout=30)
+        # In the storage root, which can be shared (no WAL, see catalog.py)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " scheme TEXT NOT NULL, digest BLOB NOT NULL, chunks TEXT NOT NULL,"
+                " PRIMARY KEY (scheme, digest)) WITHOUT ROWID"
+            )
+
+    ########################################
+
+    def add(self, package, scheme=None):
+        """Store a package (directory, zip or tarball) as chunks.
+
+        Returns (manifest, chunk_manifest), manifest.get_id() is the package hash
+        """
+        scheme = libmailcd.hashing.get_scheme(scheme)
+
+        if os.path.isdir(package):
+            dirs, files = self._add_directory(package, scheme)
+        elif zipfile.is_zipfile(package):
+            dirs, files = self._add_zip(package, scheme)
+        elif tarfile.is_tarfile(package):
+            dirs, files = self._add_tar(package, scheme)
+        else:
+            raise ValueError(f"Can only store directories, zips and tarballs as chunks: {package}")
+
+        manifest = libmailcd.manifest.Manifest(scheme, [
+            libmailcd.manifest.ManifestEntry(f["path"], f["size"], bytes.fromhex(f["digest"])) for f in files
+        ])
+
+        chunk_manifest = {
+            "version": CHUNK_MANIFEST_VERSION,
+            "scheme": scheme.name,
+            "dirs": dirs,
+            "files": _order_files(manifest, files)
+        }
+
+        return manifest, chunk_manifest
+
+    def _add_directory(self, directory, scheme):
+        dirs = []
+        files = []
+
+        with libmailcd.hashcache.open_cache().scan(directory, scheme.cache_kind_file) as scan:
+            for relfilepath, filepath in scheme.get_directory_entries(directory, dirs=dirs):
+                if not os.path.isfile(filepath):
+                    continue
+
+                st = os.stat(filepath)
+
+                # Unchanged file we've chunked before? Don't even open it
+                digest = scan.lookup(filepath, st)
+                chunks = self._lookup_file(scheme, digest) if digest else None
+
+                if chunks is None:
+                    with open(filepath, 'rb') as f:
+                        digest, chunks = self._add_stream(f, scheme)
+                    scan.store(filepath, digest, st)
+
+                files.append(_file_record(relfilepath, st.st_size, digest, chunks))
+
+        return [d.replace('\\', '/') for d in dirs], files
+
+    def _add_zip(self, filepath, scheme):
+        dirs = []
+        files = []
+        with zipfile.ZipFile(filepath) as zfile:
+            for info in zfile.infolist():
+                relpath = scheme.normalize_path(info.filename)
+                if info.is_dir():
+                    if relpath:
+                        dirs.append(relpath)
+                    continue
+
+                with zfile.open(info, mode='r') as f:
+                    digest, chunks = self._add_stream(f, scheme)
+                files.append(_file_record(relpath, info.file_size, digest, chunks))
+
+        return dirs, files
+
+    def _add_tar(self, filepath, scheme):
+        dirs = []
+        files = []
+        with tarfile.open(filepath, mode='r|*') as tfile:
+            for member in tfile:
+                relpath = scheme.normalize_path(member.name)
+                if member.isdir():
+                    if relpath:
+                        dirs.append(relpath)
+                    continue
+                if not member.isfile():
+                    continue
+
+                with tfile.extractfile(member) as f:
+                    digest, chunks = self._add_stream(f, scheme)
+                files.append(_file_record(relpath, member.size, digest, chunks))
+
+        return dirs, files
+
+    def _add_stream(self, f, scheme):
+        digester = scheme.new_file_digester()
+
+        chunks = []
+        for chunk in iter_chunks(f, digester):
+            chunks.append([self._put_chunk(chunk), len(chunk)])
+
+        digest = digester.digest()
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (scheme, digest, chunks) VALUES (?, ?, ?)",
+                (scheme.name, digest, json.dumps(chunks))
+            )
+
+        return digest, chunks
+
+    def _lookup_file(self, scheme, digest):
+        row = self._conn.execute(
+            "SELECT chunks FROM files WHERE scheme = ? AND digest = ?",
+            (scheme.name, digest)
+        ).fetchone()
+
+        if not row:
+            return None
+
+        return json.loads(row[0])
+
+    def _chunk_path(self, chunk_id):
+        return Path(self.root, chunk_id[:2], chunk_id)
+
+    def _put_chunk(self, chunk):
+        chunk_id = hashlib.blake2b(chunk, digest_size=32).hexdigest()
+        chunk_path = self._chunk_path(chunk_id)
+
+        if not chunk_path.exists():
+            os.makedirs(chunk_path.parent, exist_ok=True)
+
+            # Write to a temp file and move it into place, so a chunk is either
+            #  complete or not there at all
+            fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=chunk_path.parent)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(zlib.compress(chunk, COMPRESS_LEVEL))
+                os.replace(temp_path, chunk_path)
+            except:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+        return chunk_id
+
+    def read_chunk(self, chunk_id):
+        with open(self._chunk_path(chunk_id), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    ########################################
+
+    def extract(self, chunk_manifest, target_path):
+        """Reassemble the files of a package into target_path
+        """
+        for relpath in chunk_manifest["dirs"]:
+            os.makedirs(Path(target_path, relpath), exist_ok=True)
+
+        for record in chunk_manifest["files"]:
+            self.extract_file(record, Path(target_path, record["path"]))
+
+    def extract_file(self, record, filepath):
+        os.makedirs(Path(filepath).parent, exist_ok=True)
+        with open(filepath, 'wb') as f:
+            for data in self.iter_file(record):
+                f.write(data)
+
+    def iter_file(self, record):
+        """Yield the contents of a file (of a chunk manifest), a chunk at a time
+        """
+        for chunk_id, _ in record["chunks"]:
+            yield self.read_chunk(chunk_id)
+
+    ########################################
+
+    def gc(self, chunk_manifests, dry_run=False):
+        """Remove every chunk not used by any of the (live) chunk manifests.
+
+        Returns (number of chunks removed, bytes freed)
+        """
+        live_chunks = set()
+        live_files = set()
+        for chunk_manifest in chunk_manifests:
+            for record in chunk_manifest["files"]:
+                live_files.add((chunk_manifest["scheme"], bytes.fromhex(record["digest"])))
+                for chunk_id, _ in record["chunks"]:
+                    live_chunks.add(chunk_id)
+
+        removed = 0
+        freed = 0
+        for shard in os.listdir(self.root):
+            shard_path = Path(self.root, shard)
+            if not shard_path.is_dir():
+                continue
+
+            for chunk_id in os.listdir(shard_path):
+                if chunk_id in live_chunks:
+                    continue
+
+                chunk_path = Path(shard_path, chunk_id)
+                freed += chunk_path.stat().st_size
+                removed += 1
+                if not dry_run:
+                    logging.debug(f"gc: removing chunk {chunk_id}")
+                    chunk_path.unlink()
+
+        if not dry_run:
+            # Forget files that were split into chunks that are gone now
+            rows = self._conn.execute("SELECT scheme, digest FROM files").fetchall()
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM files WHERE scheme = ? AND digest = ?",
+                    [row for row in rows if (row[0], bytes(row[1])) not in live_files]
+                )
+
+        return removed, freed
+
+########################################
+
+def _file_record(relpath, size, digest, chunks):
+    return {
+        "path": relpath,
+        "size": size,
+        "digest": digest.hex(),
+        "chunks": chunks
+    }
+
+def _order_files(manifest, files):
+    records = {f["path"]: f for f in files}
+    return [records[entry.path] for entry in manifest.entries]
+
+def load_manifest(filepath):
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+def save_manifest(filepath, chunk_manifest):
+    with open(filepath, 'w') as f:
+        json.dump(chunk_manifest, f, separators=(",", ":"))
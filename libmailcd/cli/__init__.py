@@ -5,6 +5,7 @@ from .clean import *
 from .credential import *
 from .environment import *
 from .library import *
+from .lock import *
 from .logs import *
 from .pull import *
 from .push import *
@@ -10,6 +10,10 @@ import libmailcd.utils
 import libmailcd.workflow
 import libmailcd.env
 import libmailcd.pipeline
+import libmailcd.stagecache
+import libmailcd.filecopy
+import libmailcd.pool
+from libmailcd.cli.common import lockfile
 from libmailcd.cli.common.exceptions import AppNotInstalledError
 from libmailcd.cli.common.exceptions import AppNotRunningError
 from libmailcd.cli.common.path_manager import Layout
@@ -24,8 +28,16 @@ from libmailcd.cli.main import main
 ########################################
 
 @main.command("build")
+@click.option("--verify", is_flag=True, help="Check the contents of already downloaded inbox packages (not just their stats)")
+@click.option("--jobs", "-j", type=int, default=None, help="Stages run at the same time (the ones that don't depend on each other)")
+@click.option("--stage-cache", envvar="MB_STAGE_CACHE", is_flag=True, help="Cache the results of every stage with an outbox (not just the ones with a 'cache' key), unless it has 'cache: false'")
+@click.option("--stage-cache-dir", envvar="MB_STAGE_CACHE_DIR", default=None, help="Directory to cache stage results in (can be shared), instead of the store")
+@click.option("--no-stage-cache", is_flag=True, help="Run every stage, even the ones with a 'cache' key")
+@click.option("--outbox-mode", envvar="MB_OUTBOX_MODE", type=click.Choice(libmailcd.filecopy.COPY_MODES), default=libmailcd.filecopy.COPY_MODE_COPY, help="How files are staged into outboxes: 'copy' (reflinks where the file system can), or 'link' (hard links, outbox files are the workspace files)")
+@click.option("--inbox-mode", envvar="MB_INBOX_MODE", type=click.Choice(libmailcd.pool.MATERIALIZE_MODES), default=libmailcd.pool.DEFAULT_MATERIALIZE_MODE, help="How inboxes are filled from the machine's package pool: 'auto' (reflinks, or copies), 'reflink', 'copy', or 'hardlink'/'symlink' (share the pool's files, read-only)")
+@click.option("--pool-max-size", envvar="MB_POOL_MAX_SIZE", default=None, help="Size the machine's package pool is kept under, e.g. 50G (least recently used packages are removed)")
 @click.pass_obj
-def main_build(obj):
+def main_build(obj, verify, jobs, stage_cache, stage_cache_dir, no_stage_cache, outbox_mode, inbox_mode, pool_max_size):
     exit_code = 0
 
     api = obj["api"]
@@ -80,7 +92,8 @@ def main_build(obj):
         #######################################
         if pipeline.inbox:
             print(f"========== INBOX ==========")
-            mb_inbox_env_vars = pipeline_inbox_run(layout.inbox, pipeline.inbox)
+            lock = lockfile.load(layout.lock)
+            mb_inbox_env_vars = pipeline_inbox_run(layout.inbox, pipeline.inbox, verify=verify, lock=lock, inbox_mode=inbox_mode, pool_max_size=pool_max_size)
             show_footer = True
 
         #######################################
@@ -101,7 +114,12 @@ def main_build(obj):
                 workspace.resolve(),
                 pipeline.stages,
                 layout_logs=layout.logs,
-                env=env_vars
+                env=env_vars,
+                jobs=jobs,
+                stage_cache=None if no_stage_cache else libmailcd.stagecache.open_cache(stage_cache_dir),
+                cache_all_stages=stage_cache,
+                exclude=pipeline.exclude,
+                copy_mode=outbox_mode
             )
             show_footer = True
 
@@ -111,7 +129,7 @@ def main_build(obj):
 
         if pipeline.outbox:
             print(f"========== OUTBOX ==========")
-            pipeline_outbox_run(workspace, layout.outbox, pipeline.outbox)
+            pipeline_outbox_run(workspace, layout.outbox, pipeline.outbox, exclude=pipeline.exclude, copy_mode=outbox_mode)
             show_footer = True
 
         if show_footer:
@@ -126,6 +144,14 @@ def main_build(obj):
     except libmailcd.errors.StorageIdNotFoundError as e:
         print(f"{e}")
         exit_code = 1
+    except libmailcd.errors.InboxError as e:
+        print(f"Error - {e}")
+        for slot, error in e.errors:
+            print(f" {slot}: {error}")
+        exit_code = 1
+    except libmailcd.errors.StageError as e:
+        print(f"Error - {e}")
+        exit_code = 1
     except AppNotInstalledError as e:
         print(f"Required application is not installed: {e.app}")
         if e.app == "docker":
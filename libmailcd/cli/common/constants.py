@@ -1,3 +1,4 @@
 LOG_FILE_EXTENSION = ".log"
 ENV_LOG_FILE_EXTENSION = ".env"
 INSOURCE_PIPELINE_FILENAME = 'pipeline.yml'
+INSOURCE_LOCK_FILENAME = 'pipeline.lock'
@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+
+import libmailcd.utils
+
+########################################
+
+# The lock file pins every inbox slot to the package its labels resolved to
+#  (see 'mb lock'), so builds stay reproducible when new packages get the same
+#  labels, and don't have to search the store's labels every time:
+#
+# inbox:
+#   <slot>:
+#     tag: [<labels the package was resolved from>]
+#     package: <storage_id>/<package_hash>
+LOCK_VERSION = 1
+
+########################################
+
+def load(lock_filepath):
+    """Get the locked inbox slots ({slot: entry}), None if there's no lock file
+    """
+    if not Path(lock_filepath).is_file():
+        return None
+
+    lock = libmailcd.utils.load_yaml(lock_filepath) or {}
+    if lock.get('version') != LOCK_VERSION:
+        raise ValueError(f"Unsupported lock file version: {lock.get('version')} ({lock_filepath})")
+
+    return lock.get('inbox') or {}
+
+def save(lock_filepath, inbox):
+    lock = {
+        'version': LOCK_VERSION,
+        'inbox': inbox
+    }
+
+    temp_filepath = Path(f"{lock_filepath}.tmp")
+    libmailcd.utils.save_yaml(temp_filepath, lock, indent=2)
+    os.replace(temp_filepath, lock_filepath)
+
+def make_entry(slot_config, storage_id, package_hash):
+    return {
+        'tag': _get_tags(slot_config),
+        'package': f"{storage_id}/{package_hash}"
+    }
+
+def get_locked(lock, slot, slot_config):
+    """Get the (storage_id, package_hash) a slot is locked to, None if it isn't locked
+     (or its labels changed in the pipeline since)
+    """
+    if not lock or slot not in lock:
+        return None
+
+    entry = lock[slot]
+    if entry.get('tag') != _get_tags(slot_config):
+        return None
+
+    storage_id, _, package_hash = entry['package'].partition('/')
+    if storage_id != slot or not package_hash:
+        return None
+
+    return storage_id, package_hash
+
+def _get_tags(slot_config):
+    tag = slot_config['tag']
+    if isinstance(tag, str):
+        tag = [tag]
+    return sorted(tag)
@@ -10,6 +10,7 @@ from libmailcd.constants import LOCAL_MB_LOGS_ROOT_DIRNAME
 from libmailcd.constants import LOCAL_MB_STAGE_ROOT
 
 from libmailcd.cli.common.constants import INSOURCE_PIPELINE_FILENAME
+from libmailcd.cli.common.constants import INSOURCE_LOCK_FILENAME
 from libmailcd.cli.common.constants import LOG_FILE_EXTENSION
 from libmailcd.cli.common.constants import ENV_LOG_FILE_EXTENSION
 
@@ -44,6 +45,12 @@ class Inbox:
         '''
         return Path(self._root, storage_id, package_hash)
 
+    def get_stamp_path(self, storage_id, package_hash):
+        '''
+        Get the path to the stamp of a package (what it was filled with, see libmailcd.stamp)
+        '''
+        return Path(self._root, storage_id, f".{package_hash}.stamp")
+
 class Stages:
     def __init__(self, root):
         self._root = root
@@ -104,6 +111,10 @@ class Layout:
     def pipeline(self): # this case complicates this pattern (if we want to get rid of workspace from here)
         return Path(self._workspace, INSOURCE_PIPELINE_FILENAME)
 
+    @property
+    def lock(self):
+        return Path(self._workspace, INSOURCE_LOCK_FILENAME)
+
     @property
     def env(self):
         return Env(Path(self._root, LOCAL_ENV_DIRNAME))
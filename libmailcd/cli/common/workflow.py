@@ -1,15 +1,30 @@
 import os
 import logging
 from pathlib import Path
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
+import libmailcd.copyrules
+import libmailcd.filecopy
+import libmailcd.pool
+import libmailcd.stamp
 import libmailcd.storage
 import libmailcd.errors
-from libmailcd.constants import PIPELINE_COPY_SEPARATOR
+import libmailcd.stagecache
+import libmailcd.stagegraph
+import libmailcd.utils
 from libmailcd.constants import LOCAL_OUTBOX_DIRNAME # Note(matthew): The use of this variable should be refactored (should not include this here)
 
+from libmailcd.cli.common import lockfile
 from libmailcd.cli.tools import agent
 
+# Inbox slots downloaded at the same time
+INBOX_MAX_WORKERS = 8
+
+# Stages run at the same time (see pipeline_stages_run)
+DEFAULT_STAGE_JOBS = 1
+
+_print_lock = threading.Lock()
 
 ########################################
 
@@ -51,81 +66,157 @@ def pipeline_outbox_deploy(api, pipeline_outbox):
     return packages_to_upload
 
 # TODO(Matthew): this should be reused between stage and pipeline outboxes
-def pipeline_outbox_run(workspace, layout_outbox, pipeline_outbox):
+def pipeline_outbox_run(workspace, layout_outbox, pipeline_outbox, exclude=None, copy_mode=None):
+    """Copy the workspace files matching the outbox rules into the outbox.
+
+    exclude are workspace paths not searched (on top of copyrules.EXCLUDED_ROOTS),
+     copy_mode is how files are copied (see libmailcd.filecopy.COPY_MODES).
+    """
     if not pipeline_outbox:
         raise ValueError("No outbox set")
 
     mb_outbox_path = layout_outbox.root
-    #mb_local_root = api.settings("local_root_relative")
-    mb_local_root = layout_outbox.root
 
     outboxes = get_outboxes(pipeline_outbox, mb_outbox_path)
 
     _exec_outbox_rules(
-        mb_local_root=mb_local_root,
         workspace=workspace,
         outbox=pipeline_outbox,
-        outboxes=outboxes
+        outboxes=outboxes,
+        exclude=exclude,
+        copy_mode=copy_mode
     )
 
 
-def pipeline_inbox_run(inbox_layout, pipeline_inbox):
-    if not pipeline_inbox:
-        raise ValueError("No inbox set")
-
-    env_vars = {}
-    inbox_packages = [] # all packages
-    packages_to_download = [] # all packages that need to be downloaded
-
-    # Find required packages
-    for slot in pipeline_inbox:
-        logging.debug(f"{slot}")
-
-        tag = pipeline_inbox[slot]['tag']
-        logging.debug(f"tag={tag}")
-
-        labels = tag
-        storage_id = slot
-
-        matches = libmailcd.storage.find(storage_id, labels)
-        if len(matches) > 1:
-            raise libmailcd.errors.StorageMultipleFound(storage_id, matches, f"multiple found in store '{storage_id}' with labels: {labels}")
-        if not matches:
-            raise ValueError(f"No matches found for '{storage_id}' with labels: {labels}")
-        package_hash = matches[0]
-
-        pkg = {
-            "id": storage_id,
-            "hash": package_hash
-        }
+def pipeline_inbox_run(inbox_layout, pipeline_inbox, verify=False, max_workers=None, lock=None, inbox_mode=None, pool_max_size=None):
+    """Find and download every inbox package (concurrently, each slot is independent).
 
-        packages_to_download.append(pkg)
-        inbox_packages.append(pkg)
+    Slots pinned in the lock (see lockfile.py) use their locked package, instead
+     of searching the store for their labels.
 
-    # Download all required packages
-    if packages_to_download:
+    inbox_mode is how inboxes are filled from the machine's package pool, and
+     pool_max_size its size cap (see libmailcd.pool).
 
-        # TODO(matthew): Do we need to optimize this to only actually download ones we don't already have
-        for package in packages_to_download:
-            storage_id = package['id']
-            package_hash = package['hash']
-            print(f"Downloading package: {storage_id}/{package_hash}")
+    Every slot is tried, errors are raised at the end: on their own if only one
+     slot failed, otherwise together as an InboxError.
+    """
+    if not pipeline_inbox:
+        raise ValueError("No inbox set")
 
-            # calculate target directory
-            target_path = inbox_layout.get_package_path(storage_id, package_hash)
+    if max_workers is None:
+        max_workers = INBOX_MAX_WORKERS
 
-            # download to the target directory
-            libmailcd.storage.download(storage_id, package_hash, target_path)
-            print(f" --> '{target_path}'")
+    # Bad values fail once, not once per slot
+    if inbox_mode is not None and inbox_mode not in libmailcd.pool.MATERIALIZE_MODES:
+        raise ValueError(f"Unknown inbox mode: {inbox_mode}")
+    if pool_max_size is not None:
+        pool_max_size = libmailcd.utils.parse_size(pool_max_size)
 
-    # Set env variables that point to the inbox packages
-    for package in inbox_packages:
-        env_var_name = f"MB_{storage_id}_ROOT"
-        env_var_value = str(target_path)
-        env_vars[env_var_name] = env_var_value
+    env_vars = {}
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for slot in pipeline_inbox:
+            futures[slot] = executor.submit(_inbox_slot_run, inbox_layout, slot, pipeline_inbox[slot], verify, lock, inbox_mode, pool_max_size)
+
+        # Note: in pipeline order, so the env vars are too
+        for slot, future in futures.items():
+            try:
+                storage_id, target_path = future.result()
+            except Exception as e:
+                _slot_print(slot, f"Failed: {e}")
+                errors.append((slot, e))
+                continue
+
+            # Set env variables that point to the inbox packages
+            env_var_name = f"MB_{storage_id}_ROOT"
+            env_var_value = str(target_path)
+            env_vars[env_var_name] = env_var_value
+
+    if len(errors) == 1:
+        raise errors[0][1]
+    if errors:
+        raise libmailcd.errors.InboxError(errors)
 
     return env_vars
 
+def pipeline_inbox_resolve(slot, slot_config):
+    """Find the package of an inbox slot (by its labels), returns (storage_id, package_hash)
+    """
+    logging.debug(f"{slot}")
+
+    tag = slot_config['tag']
+    logging.debug(f"tag={tag}")
+
+    labels = tag
+    storage_id = slot
+
+    # Find required package
+    matches = libmailcd.storage.find(storage_id, labels)
+    if len(matches) > 1:
+        raise libmailcd.errors.StorageMultipleFound(storage_id, matches, f"multiple found in store '{storage_id}' with labels: {labels}")
+    if not matches:
+        raise ValueError(f"No matches found for '{storage_id}' with labels: {labels}")
+
+    return storage_id, matches[0]
+
+def _slot_print(slot, message):
+    # Note: slots run on different threads, keep each line in one piece
+    with _print_lock:
+        print(f"[{slot}] {message}")
+
+def _inbox_slot_run(inbox_layout, slot, slot_config, verify, lock, inbox_mode=None, pool_max_size=None):
+    """Find and download the package of one inbox slot, returns (storage_id, target_path)
+    """
+    # Only the files the build needs (globs), everything if not set
+    include = slot_config.get('include')
+    if isinstance(include, str):
+        include = [include]
+
+    locked = lockfile.get_locked(lock, slot, slot_config)
+    if locked:
+        storage_id, package_hash = locked
+        if not libmailcd.storage.exists(storage_id, package_hash):
+            raise ValueError(f"Locked package not found: {storage_id}/{package_hash} (run 'mb lock --update')")
+    else:
+        if lock and slot in lock:
+            _slot_print(slot, f"Lock out of date, finding package by labels (run 'mb lock --update')")
+        storage_id, package_hash = pipeline_inbox_resolve(slot, slot_config)
+
+    # Used by this build, even if it never gets downloaded from the store
+    #  (stamp still valid, already in the pool), gc evicts least recently used first
+    libmailcd.storage.touch(storage_id, package_hash)
+
+    # calculate target directory
+    target_path = inbox_layout.get_package_path(storage_id, package_hash)
+    stamp_path = inbox_layout.get_stamp_path(storage_id, package_hash)
+
+    # Skip packages that are still exactly as they were downloaded
+    if libmailcd.stamp.is_valid(stamp_path, target_path, package_hash, include, verify=verify):
+        _slot_print(slot, f"Up to date: {storage_id}/{package_hash}")
+        return storage_id, target_path
+
+    # A stamp that's there but doesn't match means the inbox was changed, if it
+    #  shared files with the pool (hardlink, symlink) so was the pool's copy.
+    #  With verify, the pool's copy is never trusted either.
+    changed = verify or os.path.exists(stamp_path)
+
+    _slot_print(slot, f"Downloading package: {storage_id}/{package_hash}")
+    libmailcd.stamp.remove(stamp_path)
+
+    # link into the target directory from the machine's pool of extracted
+    #  packages (only extracted the first time any workspace needs it)
+    libmailcd.pool.materialize(storage_id, package_hash, target_path, include=include, mode=inbox_mode, verify=changed, max_size=pool_max_size)
+
+    if verify and not libmailcd.stamp.verify_contents(target_path, package_hash, include):
+        raise ValueError(f"Package contents don't match its hash: {storage_id}/{package_hash} (check the store with 'mb store verify')")
+
+    libmailcd.stamp.write(stamp_path, target_path, package_hash, include)
+    _slot_print(slot, f" --> '{target_path}'")
+
+    return storage_id, target_path
+
 def pipeline_set_env(mb_inbox_env_vars, mb_env_path):
     # Note: Order matters here! Should inbox overwrite loaded env? Or vice versa?
     # For now, we prefer loaded env over inbox env vars.  This should give users
@@ -152,55 +243,91 @@ def _expand_variables_from_env(string_to_expand, env): #for stage
 
     return string_to_expand
 
-def _pipeline_process_stage(api, workspace, stage, stage_name, logpath, envlogpath, env):
-    print(f"> Starting Stage: {stage_name}")
-
-    if 'node' not in stage:
-        raise ValueError(f"No 'node' block in stage: {stage_name}")
-
-    node = agent.factory(stage['node'], workspace, env)
+class _StageCancelled(Exception):
+    pass
 
+def _pipeline_run_stage(api, workspace, stage, stage_name, logpath, envlogpath, env, cancelled, stage_cache, key, exclude, copy_mode):
+    """Run a stage, unless its results are in the stage cache (under key, None if
+    it isn't cached, see libmailcd.stagecache.get_keys)
+    """
+    if stage_cache is not None and key is not None:
+        outbox_path = Path(workspace, _get_stage_outbox_root(api, stage_name))
+        if stage_cache.restore(key, outbox_path, logpath, envlogpath):
+            with _print_lock:
+                print(f"> Cached Stage: {stage_name} ({key[:12]})")
+            return
 
+    _pipeline_process_stage(api, workspace, stage, stage_name, logpath, envlogpath, env, cancelled=cancelled, exclude=exclude, copy_mode=copy_mode)
 
-    logpath = logpath.resolve()
-    envlogpath = envlogpath.resolve()
-    stage_steps = None
-    stage_outboxes = None
-    with open(logpath, 'w') as logfp:
-        if 'steps' in stage:
-            stage_steps = stage['steps']
+    # Only reached when every step returned 0 (a failing or cancelled stage
+    #  raises), failed results are never cached
+    if stage_cache is not None and key is not None:
+        stage_cache.save(key, outbox_path, logpath, envlogpath)
 
-        if 'outbox' in stage:
-            stage_outboxes = stage['outbox']
-
-        # Allocate a node if we have steps to run and/or outbox to make
-        if stage_steps or stage_outboxes:
-
-            with node:
-
-                if stage_steps:
-                    env_result = node.get_env()
-                    with open(envlogpath, 'w') as envfp:
-                        env_output = env_result.stdout.strip().replace("\r\n", "\n")
-                        if env_output:
-                            envfp.write(env_output + "\n")
-                        pass
-                    #print(f"{env_result.stdout}")
+def _pipeline_process_stage(api, workspace, stage, stage_name, logpath, envlogpath, env, cancelled=None, exclude=None, copy_mode=None):
+    with _print_lock:
+        print(f"> Starting Stage: {stage_name}")
 
-                    # Process
-                    for step in stage_steps:
-                        step = _expand_variables_from_env(step.strip(), env).strip()
-                        print(f"{stage_name}> {step}")
-                        result = node.run_step(step)
-
-                        result_output = result.stdout.strip().replace("\r\n", "\n")
-                        if result_output:
-                            logfp.write(result_output + "\n")
-                            print(result_output)
-                        print(f"{stage_name}?> {result.returncode}")
+    if 'node' not in stage:
+        raise ValueError(f"No 'node' block in stage: {stage_name}")
 
-                if stage_outboxes:
-                    _stage_outbox_run(api, stage_name, stage_outboxes)
+    # Held for as long as the node is used: stages running at the same time
+    #  can't switch Docker Desktop between Linux and Windows under each other
+    with agent.reserve(stage['node']):
+        node = agent.factory(stage['node'], workspace, env)
+
+        logpath = logpath.resolve()
+        envlogpath = envlogpath.resolve()
+        stage_steps = None
+        stage_outboxes = None
+        with open(logpath, 'w') as logfp:
+            if 'steps' in stage:
+                stage_steps = stage['steps']
+
+            if 'outbox' in stage:
+                stage_outboxes = stage['outbox']
+
+            # Allocate a node if we have steps to run and/or outbox to make
+            if stage_steps or stage_outboxes:
+
+                with node:
+
+                    if stage_steps:
+                        env_result = node.get_env()
+                        with open(envlogpath, 'w') as envfp:
+                            env_output = env_result.stdout.strip().replace("\r\n", "\n")
+                            if env_output:
+                                envfp.write(env_output + "\n")
+                            pass
+                        #print(f"{env_result.stdout}")
+
+                        # Process
+                        for step in stage_steps:
+                            # Another stage failed, stop at the next step
+                            if cancelled is not None and cancelled.is_set():
+                                raise _StageCancelled(stage_name)
+
+                            step = _expand_variables_from_env(step.strip(), env).strip()
+                            result = node.run_step(step)
+
+                            # Each step's output is printed in one go, so stages
+                            #  running at the same time don't interleave
+                            result_output = result.stdout.strip().replace("\r\n", "\n")
+                            if result_output:
+                                logfp.write(result_output + "\n")
+                            with _print_lock:
+                                print(f"{stage_name}> {step}")
+                                if result_output:
+                                    print(result_output)
+                                print(f"{stage_name}?> {result.returncode}")
+
+                            # A failing step fails the stage (the steps after it,
+                            #  its outbox and the stages waiting on it never run)
+                            if result.returncode != 0:
+                                raise ValueError(f"Step failed ({result.returncode}): {step}")
+
+                    if stage_outboxes:
+                        _stage_outbox_run(api, stage_name, stage_outboxes, exclude=exclude, copy_mode=copy_mode)
 
 #def _stage_inbox_run(api, stage, stage_inbox):
 #    pass
@@ -211,9 +338,8 @@ def _get_stage_outbox_root(api, stage):
 
     return Path(mb_stage_relpath, stage, LOCAL_OUTBOX_DIRNAME)
 
-def _stage_outbox_run(api, stage, stage_outbox):
+def _stage_outbox_run(api, stage, stage_outbox, exclude=None, copy_mode=None):
     stage_outbox_root = _get_stage_outbox_root(api, stage)
-    mb_local_root = api.settings("local_root_relative")
     root_path = api.settings("workspace")
 
     # Copy files into outbox
@@ -222,77 +348,63 @@ def _stage_outbox_run(api, stage, stage_outbox):
     outboxes = get_outboxes(stage_outbox, stage_outbox_root)
 
     _exec_outbox_rules(
-        mb_local_root=mb_local_root,
         workspace=root_path,
         outbox=stage_outbox,
-        outboxes=outboxes
+        outboxes=outboxes,
+        exclude=exclude,
+        copy_mode=copy_mode
     )
 
-# todo(matthew): maybe instead of passing in mb_local_root, we pass in directories to ignore and add that to the list
-def _exec_outbox_rules(mb_local_root, workspace, outbox, outboxes):
+def _exec_outbox_rules(workspace, outbox, outboxes, exclude=None, copy_mode=None):
     files_to_copy = {} # all the file copy rules
 
+    # Every rule of every storage ID is matched in a single walk of the
+    #  workspace (see libmailcd.copyrules)
+    rules = []
+    destinations = {}
     for storage_id in outboxes:
         logging.debug(f"{storage_id}")
-        rules = outbox[storage_id]
-        logging.debug(f"rules={rules}")
-
-        target_path = outboxes[storage_id]
+        logging.debug(f"rules={outbox[storage_id]}")
 
         files_to_copy[storage_id] = {}
 
-        for rule in rules:
+        for rule in outbox[storage_id]:
             files_to_copy[storage_id][rule] = []
 
-            source, destination = rule.split(PIPELINE_COPY_SEPARATOR)
-            source = source.strip()
-            destination = destination.strip()
-
-            # Support destinations starting with "/" (in Windows)
-            #  and not have it think it's the root of the drive
-            #  but instead the root of the output path
-            # TODO(matthew): What about linux?
-            if os.name == 'nt':
-                destination = destination.lstrip('/\\')
-
+            source, destination = libmailcd.copyrules.parse_rule(rule)
             logging.debug(f"src='{source}'")
             logging.debug(f"dst='{destination}'")
-            logging.debug(f"target='{target_path}'")
-
-            # TODO(matthew): What about the case where we may want to grab
-            #  something from a pulled in package?  Shouldn't always assume
-            #  searching from the workspace, but how to implement this?
-            # Maybe do this format:
-            #   "WORKSPACE: *.txt -> /docs/"
-            #   "LUA: *.dll -> /external/lua/"
-            found_files = workspace.glob("**/" + source)
-            mb_local_root_str = str(mb_local_root)
-
-            for ffile in found_files:
-                # Ignore files that are in the local mailbox root (that's our stuff)
-                if str(ffile).startswith(mb_local_root_str):
-                    logging.debug(f"Ignoring -- {mb_local_root_str}")
-                    continue
-
-                ffile_source_path = ffile
-
-                # get filename
-                ffilename = ffile.name
-
-                # generate output path
-                ffile_destination_path = Path.joinpath(target_path, destination, ffilename)
-
-                # copy file (or save it to a list to be copied later)
-                files_to_copy[storage_id][rule].append(
-                    libmailcd.workflow.FileCopy(ffile_source_path, ffile_destination_path, rule=rule)
-                )
-
+            logging.debug(f"target='{outboxes[storage_id]}'")
+
+            rules.append(((storage_id, rule), source))
+            destinations[(storage_id, rule)] = destination
+
+    # TODO(matthew): What about the case where we may want to grab
+    #  something from a pulled in package?  Shouldn't always assume
+    #  searching from the workspace, but how to implement this?
+    # Maybe do this format:
+    #   "WORKSPACE: *.txt -> /docs/"
+    #   "LUA: *.dll -> /external/lua/"
+    matcher = libmailcd.copyrules.RuleMatcher(rules)
+    excluded = libmailcd.copyrules.EXCLUDED_ROOTS + list(exclude or [])
+
+    for ffile, keys in matcher.find(workspace, excluded):
+        for storage_id, rule in keys:
+            # generate output path
+            ffile_destination_path = Path(outboxes[storage_id], destinations[(storage_id, rule)], ffile.name)
+
+            # copy file (or save it to a list to be copied later)
+            files_to_copy[storage_id][rule].append(
+                libmailcd.workflow.FileCopy(ffile, ffile_destination_path, rule=rule)
+            )
+
+    copies = []
     if files_to_copy:
         #print(f"ftc={files_to_copy}")
         for sid in files_to_copy:
             logging.info(f"{sid}:")
             if files_to_copy[sid]:
-                for rule in rules:
+                for rule in files_to_copy[sid]:
                     logging.info(f"- {rule}")
                     files = files_to_copy[sid][rule]
                     if files:
@@ -301,130 +413,109 @@ def _exec_outbox_rules(mb_local_root, workspace, outbox, outboxes):
                             #  print how to access it via the generated root variable (example: MB_LIB_ROOT/lib/mylib.lib).
                             logging.info(f"-- Copy {ftc.src_relative} => {ftc.dst_relative}")
                             os.makedirs(ftc.dst_root, exist_ok=True)
-                            shutil.copy(ftc.src, ftc.dst)
+                            copies.append((ftc.src, ftc.dst))
                     else:
                         logging.info("-- No matching files to copy")
                         pass
             else:
                 logging.info("- No rules found")
 
-class StageTreeNode:
-    def __init__(self, name):
-        self.dependencies = None
-        self.name = name
-
-    def add_dependency(self, dependency):
-        if self.dependencies is None:
-            self.dependencies = []
-        self.dependencies.append(dependency)
-
-from collections import defaultdict
-
-class Graph:
-    def __init__(self, nodes):
-        self._edges = defaultdict(list)
-        self._nodes = nodes
-
-    def edge(self, origin, target):
-        #print(f"EDGE: {origin} -> {target}")
-        self._edges[origin].append(target)
-
-    def _topo_sort_util(self, origin_node, visited, stack):
-        visited.append(origin_node)
-
-        #print(f"EDGES({origin_node})={self._edges[origin_node]}")
-        for target_node in self._edges[origin_node]:
-            if target_node not in visited:
-                self._topo_sort_util(target_node, visited, stack)
-
-        stack.append(origin_node)
-
-    def topological_sort(self):
-        visited_nodes = []
-        sorted_nodes = [] # this will be a stack
-
-        #print(f"topo_nodes: {self._nodes}")
-        for node in self._nodes:
-            if node not in visited_nodes:
-                self._topo_sort_util(node, visited_nodes, sorted_nodes)
+    # The copies themselves happen all at once (see libmailcd.filecopy)
+    if copies:
+        copied = libmailcd.filecopy.copy_files(copies, mode=copy_mode or libmailcd.filecopy.COPY_MODE_COPY)
+        logging.debug(f"staged: {dict(copied)}")
 
-        #print(f"visited_nodes={visited_nodes}")
+def pipeline_stages_run(api, workspace, pipeline_stages, layout_logs, env, jobs=None, stage_cache=None, cache_all_stages=False, exclude=None, copy_mode=None):
+    """Run the stages, up to jobs at the same time: a stage starts as soon as every
+    stage it depends on (that makes a package in its inbox) is done.
 
-        return sorted_nodes
+    With a stage_cache (see libmailcd.stagecache), stages whose inputs didn't
+     change aren't run, their outbox and logs are restored from the cache. Only
+     stages that ask for it are cached, or every stage with cache_all_stages
+     (unless it opts out).
 
+    exclude are workspace paths the stage outbox rules don't search, copy_mode is
+     how they copy files (see libmailcd.filecopy.COPY_MODES).
 
-def _get_stage_dependencies(stages, stage):
-    dependent_stages = []
+    The first stage to fail (a step returning non-zero, or an error) stops
+     everything: stages not started yet never are, running ones stop at their
+     next step. Raises StageError.
 
-    # Go through inbox and find all the packages that need to be pulled in
-    required_packages = []
-    if 'inbox' in stages[stage]:
-        for node in stages[stage]['inbox']:
-            required_packages.append(node)
-
-    # Go through all other stages and see if they have the packages in their outbox
-    for other_stage in stages:
-        if 'outbox' in stages[other_stage]:
-            for node in stages[other_stage]['outbox']:
-                if node in required_packages:
-                    dependent_stages.append(other_stage)
-
-    return dependent_stages
-
-
-def _get_stage_order_sequential(stages):
-    ordered_stages = []
-    #print(f"!!stages={stages}")
-
-    deps = {}
-    for stage in stages:
-        d = _get_stage_dependencies(stages, stage)
-        deps[stage] = d
-        print(f"{stage}.deps={d}")
-
-    # TODO(Matthew): maybe re-do with some zip() usage?
-    stage_graph = Graph(stages)
-
-    for stage in stages:
-        # stage_graph.addEdges(stage, stage.deps) # this way I can add a bunch of edges at once.
-        for dstage in deps[stage]:
-            stage_graph.edge(stage, dstage)
-
-    sorted_graph = stage_graph.topological_sort()
-    #print(f"sorted_graph={sorted_graph}")
-    ordered_stages = sorted_graph
-    #print(f"ordered_stages={ordered_stages}")
-
-    return ordered_stages
-
-def pipeline_stages_run(api, workspace, pipeline_stages, layout_logs, env):
+    Stages that need Docker Desktop (Windows) in another mode than running ones
+     wait for them (see agent.reserve).
+    """
     # TODO(Matthew): Should do a schema validation here (or up a level) first,
     #  so we can give line numbers for issues to the end user.
+    if jobs is None:
+        jobs = DEFAULT_STAGE_JOBS
 
-    # Build dependency tree
-    ordered_stages = _get_stage_order_sequential(pipeline_stages)
+    # Build dependency tree (raises if there's a cycle, before anything runs)
+    graph = libmailcd.stagegraph.StageGraph.from_stages(pipeline_stages)
+    ordered_stages = graph.order()
     logging.debug(f"Stage Order: {ordered_stages}")
+    logging.debug(f"Stage Levels: {graph.level_widths()} (critical path: {' -> '.join(graph.critical_path()[0])})")
+
+    # Stage cache keys are worked out up front, before stages change the workspace
+    keys = {}
+    if stage_cache is not None:
+        keys = libmailcd.stagecache.get_keys(workspace, pipeline_stages, graph, env, all_stages=cache_all_stages)
+
+    # When there are more stages ready than jobs, start the ones with the longest
+    #  chain of stages waiting on them first
+    priorities = graph.get_priorities()
+    ordered_stages.sort(key=lambda stage_name: -priorities[stage_name])
 
     # Make the logs directory
     # TODO(Matthew): Should we only create this on the fly on the first write to a log?
     layout_logs.root.mkdir(exist_ok=True, parents=True)
 
-    # TODO(Matthew): Should not just loop through and execute, need to build dependency tree
-    stage_no = 0
-    for stage_name in ordered_stages:
-        stage = pipeline_stages[stage_name]
-        stage_no = stage_no + 1
-        #print(f"STAGE#{stage_no}: {stage_name}")
-
-        logfilepath = layout_logs.get_build_log_path(stage_name)
-        envlogfilepath = layout_logs.get_env_log_path(stage_name)
-
-        _pipeline_process_stage(
-            api,
-            workspace,
-            stage,
-            stage_name,
-            logpath=logfilepath,
-            envlogpath=envlogfilepath,
-            env=env
-        )
+    cancelled = threading.Event()
+    pending = ordered_stages
+    done = set()
+    running = {} # future: stage_name
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # Start every stage that's ready
+            if failure is None:
+                for stage_name in [name for name in pending if graph.get_dependencies(name) <= done]:
+                    if len(running) >= jobs:
+                        break
+                    pending.remove(stage_name)
+                    running[executor.submit(
+                        _pipeline_run_stage,
+                        api,
+                        workspace,
+                        pipeline_stages[stage_name],
+                        stage_name,
+                        logpath=layout_logs.get_build_log_path(stage_name),
+                        envlogpath=layout_logs.get_env_log_path(stage_name),
+                        env=env,
+                        cancelled=cancelled,
+                        stage_cache=stage_cache,
+                        key=keys.get(stage_name),
+                        exclude=exclude,
+                        copy_mode=copy_mode
+                    )] = stage_name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage_name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage_name)
+                except _StageCancelled:
+                    logging.info(f"{stage_name}: cancelled")
+                except Exception as e:
+                    if failure is None:
+                        failure = libmailcd.errors.StageError(stage_name, e)
+                        cancelled.set()
+                    else:
+                        logging.error(f"{stage_name}: {e}")
+
+    if failure is not None:
+        raise failure
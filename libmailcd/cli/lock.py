@@ -0,0 +1,71 @@
+import logging
+import sys
+import traceback
+
+import click
+
+import libmailcd.utils
+import libmailcd.storage
+from libmailcd.cli.common import lockfile
+from libmailcd.cli.common.path_manager import Layout
+from libmailcd.cli.common.workflow import pipeline_inbox_resolve
+from libmailcd.cli.main import main
+
+########################################
+
+@main.command("lock")
+@click.option("--update", is_flag=True, help="Resolve every inbox slot again (not only new or changed ones)")
+@click.pass_obj
+def main_lock(obj, update):
+    """
+    Pins the pipeline's inbox packages in a lock file (next to the pipeline).
+
+    Builds then use the locked packages instead of searching the store's labels,
+     until the slot's labels change or the lock is updated.
+    """
+    exit_code = 0
+
+    api = obj["api"]
+
+    try:
+        workspace = api.settings("workspace")
+        layout = Layout(workspace, api)
+
+        pipeline_filepath = layout.pipeline
+        logging.debug(f"pipeline_filepath: {pipeline_filepath}")
+
+        if not pipeline_filepath.is_file():
+            raise ValueError(f"no pipeline found: {pipeline_filepath.name} ({workspace})")
+        pipeline = libmailcd.utils.load_yaml(pipeline_filepath)
+
+        pipeline_inbox = pipeline.get('inbox') or {}
+
+        lock = None
+        if not update:
+            lock = lockfile.load(layout.lock)
+
+        inbox = {}
+        for slot in pipeline_inbox:
+            slot_config = pipeline_inbox[slot]
+
+            locked = lockfile.get_locked(lock, slot, slot_config)
+            if locked and libmailcd.storage.exists(*locked):
+                storage_id, package_hash = locked
+                print(f"{slot}: {storage_id}/{package_hash}")
+            else:
+                storage_id, package_hash = pipeline_inbox_resolve(slot, slot_config)
+                print(f"{slot}: {storage_id}/{package_hash} (resolved)")
+
+            inbox[slot] = lockfile.make_entry(slot_config, storage_id, package_hash)
+
+        lockfile.save(layout.lock, inbox)
+        print(f"Wrote {layout.lock.name}")
+    except ValueError as e:
+        print(f"{e}")
+        exit_code = 4
+    except Exception as e:
+        print(f"{e}")
+        traceback.print_exc()
+        exit_code = 3
+
+    sys.exit(exit_code)
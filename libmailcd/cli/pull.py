@@ -2,8 +2,11 @@ from pathlib import Path
 
 import click
 
+import libmailcd.pool
 import libmailcd.utils
+from libmailcd.cli.common import lockfile
 from libmailcd.cli.common.constants import INSOURCE_PIPELINE_FILENAME
+from libmailcd.cli.common.path_manager import Layout
 from libmailcd.cli.common.workflow import pipeline_inbox_run
 from libmailcd.cli.main import main
 
@@ -11,8 +14,11 @@ from libmailcd.cli.main import main
 ########################################
 
 @main.command("pull")
+@click.option("--verify", is_flag=True, help="Check the contents of already downloaded inbox packages (not just their stats)")
+@click.option("--inbox-mode", envvar="MB_INBOX_MODE", type=click.Choice(libmailcd.pool.MATERIALIZE_MODES), default=libmailcd.pool.DEFAULT_MATERIALIZE_MODE, help="How inboxes are filled from the machine's package pool: 'auto' (reflinks, or copies), 'reflink', 'copy', or 'hardlink'/'symlink' (share the pool's files, read-only)")
+@click.option("--pool-max-size", envvar="MB_POOL_MAX_SIZE", default=None, help="Size the machine's package pool is kept under, e.g. 50G (least recently used packages are removed)")
 @click.pass_obj
-def main_pull(obj):
+def main_pull(obj, verify, inbox_mode, pool_max_size):
     api = obj["api"]
 
     workspace = api.settings("workspace")
@@ -25,4 +31,6 @@ def main_pull(obj):
         pipeline_inbox = pipeline['inbox']
 
     if pipeline_inbox:
-        env_vars = pipeline_inbox_run(api, pipeline_inbox)
+        layout = Layout(workspace, api)
+        lock = lockfile.load(layout.lock)
+        env_vars = pipeline_inbox_run(layout.inbox, pipeline_inbox, verify=verify, lock=lock, inbox_mode=inbox_mode, pool_max_size=pool_max_size)
@@ -5,7 +5,9 @@ import click
 
 from libmailcd.cli.main import main
 from libmailcd.constants import LOCAL_INBOX_DIRNAME
+import libmailcd.errors
 import libmailcd.storage
+import libmailcd.verify
 
 ########################################
 
@@ -17,8 +19,10 @@ def main_store(ctx):
 @main_store.command("add")
 @click.argument("storage_id")
 @click.argument("package", type=click.Path(exists=True))  # can be zip or directory
+@click.option("--backend", type=click.Choice(libmailcd.storage.STORAGE_BACKENDS), default=None,
+    help="How to store the package (default: the storage ID's 'backend' setting, or zip)")
 @click.pass_obj
-def main_store_add(obj, storage_id, package):
+def main_store_add(obj, storage_id, package, backend):
     """Add a PACKAGE (directory or zip file) to a specified location (STORAGE_ID).
 
     Example(s):
@@ -27,10 +31,12 @@ def main_store_add(obj, storage_id, package):
 
         mb store add MYPACKAGE ./mypackage_v3/
 
+        mb store add MYPACKAGE ./mypackage_v3/ --backend chunked
+
     """
     api = obj["api"]
 
-    package_hash = api.store_add(storage_id, package)
+    package_hash = api.store_add(storage_id, package, backend=backend)
     # TODO(matthew): we need the package hash here does storage.add return that?
     print(f"Package added under store '{storage_id}' ({package_hash})")
 
@@ -38,9 +44,22 @@ def main_store_add(obj, storage_id, package):
 @main_store.command("ls")
 @click.argument("ref", default=None, required=False)
 @click.option("--label")
+@click.option("--recursive", "-r", is_flag=True, help="List every file under the directory")
+@click.option("--offset", type=int, default=0, help="Skip this many entries")
+@click.option("--limit", type=int, default=None, help="Show at most this many entries")
+@click.option("--abbrev", is_flag=True, help="Show the shortest unambiguous package hashes")
 @click.pass_obj
-def main_store_ls(obj, ref, label):
+def main_store_ls(obj, ref, label, recursive, offset, limit, abbrev):
     """Navigate around the package store.
+
+    Example(s):
+
+        mb store ls MYPACKAGE --abbrev
+
+        mb store ls MYPACKAGE/2de
+
+        mb store ls MYPACKAGE/2de/include/foo --limit 100
+
     """
     api = obj["api"]
 
@@ -57,11 +76,7 @@ def main_store_ls(obj, ref, label):
         sys.exit(0)
 
     # split the ref
-    try:
-        storage_id, partial_package_hash = libmailcd.storage.split_ref(ref)
-    except ValueError:
-        storage_id = ref
-        partial_package_hash = None
+    storage_id, partial_package_hash, relpath = libmailcd.storage.split_package_ref(ref)
 
     # Case: mb store SID
     #  Should list all packages/versions for storage id
@@ -71,7 +86,10 @@ def main_store_ls(obj, ref, label):
         for version in versions:
             labels = api.store_get_labels(storage_id, version)
             labels_string = ",".join(labels)
-            print(f"{version}\t{labels_string}")
+            if abbrev:
+                print(f"{api.store_abbreviate(sid, version)}\t{labels_string}")
+            else:
+                print(f"{version}\t{labels_string}")
 
         if not versions:
             print(f"{sid} - No entries")
@@ -107,7 +125,11 @@ def main_store_ls(obj, ref, label):
                 pass
 
         # get contents of the package
-        package_fileinfos = api.store_ls(storage_id, package_hash)
+        try:
+            package_fileinfos = api.store_ls(storage_id, package_hash, relpath, offset, limit, recursive)
+        except FileNotFoundError as e:
+            print(f"{e}")
+            sys.exit(1)
         # get metadata of the package
         package_labels = api.store_get_labels(storage_id, package_hash)
 
@@ -137,11 +159,186 @@ def main_store_ls(obj, ref, label):
             filepath = str(fileinfo['name'])
             print("{0:20}\t{1:20}".format(filepath, str(to_show)))
 
+@main_store.command("config")
+@click.argument("storage_id")
+@click.argument("name", required=False)
+@click.argument("value", required=False)
+@click.option("--unset", is_flag=True, help="Unset the setting (back to its default)")
+@click.pass_obj
+def main_store_config(obj, storage_id, name, value, unset):
+    """Show or change the settings of a STORAGE_ID.
+
+    Example(s):
+
+        mb store config MYPACKAGE
+
+        mb store config MYPACKAGE backend chunked
+
+        mb store config MYPACKAGE backend --unset
+
+    """
+    api = obj["api"]
+
+    # Case: mb store config SID
+    #  Should list every setting
+    if not name:
+        settings = api.store_get_settings(storage_id)
+        for key, setting in settings.items():
+            print(f"{key}\t{setting}")
+
+        if not settings:
+            print(f"{storage_id} - No settings")
+        sys.exit(0)
+
+    # Case: mb store config SID NAME
+    #  Should show the setting
+    if value is None and not unset:
+        settings = api.store_get_settings(storage_id)
+        print(f"{settings.get(name, '')}")
+        sys.exit(0)
+
+    try:
+        api.store_set_setting(storage_id, name, None if unset else value)
+    except ValueError as e:
+        print(f"{e}")
+        sys.exit(1)
+
+@main_store.command("migrate")
+@click.argument("storage_id")
+@click.argument("layout", type=click.Choice(libmailcd.storage.STORAGE_LAYOUTS))
+@click.pass_obj
+def main_store_migrate(obj, storage_id, layout):
+    """Move the packages of a STORAGE_ID to another directory LAYOUT.
+
+    'sharded' fans packages out into 'ab/cd/<hash>' directories, for storage IDs
+     with a lot of packages. Safe to run again if interrupted.
+
+    Example(s):
+
+        mb store migrate MYPACKAGE sharded
+
+    """
+    api = obj["api"]
+
+    try:
+        moved = api.store_migrate(storage_id, layout)
+    except ValueError as e:
+        print(f"{e}")
+        sys.exit(1)
+
+    print(f"{storage_id} - {layout} ({moved} packages moved)")
+
+@main_store.command("verify")
+@click.argument("ref", required=False)
+@click.argument("paths", nargs=-1)
+@click.option("--jobs", "-j", type=int, default=None, help="Packages checked at the same time (default: one per core)")
+@click.option("--quarantine", is_flag=True, help="Move bad packages out of the store (into its .quarantine directory)")
+@click.option("--checkpoint", type=click.Path(dir_okay=False), default=None, help="Record checked packages in this file, and skip the ones already in it")
+@click.option("--limit", type=int, default=None, help="Check at most this many packages (with --checkpoint, the next run carries on)")
+@click.pass_obj
+def main_store_verify(obj, ref, paths, jobs, quarantine, checkpoint, limit):
+    """Check that stored packages haven't been corrupted: the package at REF (only
+    the files under PATHS, if given), every package of a storage ID, or the whole
+    store if no REF.
+
+    Example(s):
+
+        mb store verify MYPACKAGE/2de
+
+        mb store verify MYPACKAGE/2de bin/ lib/libfoo.so
+
+        mb store verify MYPACKAGE --quarantine
+
+        mb store verify --checkpoint nightly.verify --limit 1000
+
+    """
+    api = obj["api"]
+
+    storage_id, partial_package_hash, relpath = (None, None, None)
+    if ref:
+        storage_id, partial_package_hash, relpath = libmailcd.storage.split_package_ref(ref)
+    if relpath:
+        paths = (relpath,) + paths
+
+    # Case: mb store verify SID/2de [PATHS]
+    if partial_package_hash:
+        try:
+            package_hash = api.store_fully_qualify_package(storage_id, partial_package_hash)
+            problems = api.store_verify(storage_id, package_hash, list(paths) or None)
+        except ValueError as e:
+            print(f"{e}")
+            sys.exit(1)
+
+        for path, problem in problems:
+            print(f"{problem}\t{path}")
+
+        if problems:
+            print(f"{storage_id}/{package_hash} - FAILED ({len(problems)} problems)")
+            if quarantine:
+                print(f"quarantined: {api.store_quarantine(storage_id, package_hash)}")
+            sys.exit(1)
+
+        print(f"{storage_id}/{package_hash} - OK")
+        sys.exit(0)
+
+    # Case: mb store verify [SID]
+    try:
+        storage_ids = [storage_id] if storage_id else api.store_get()
+        packages = [(sid, package_hash) for sid in storage_ids for package_hash in api.store_get(sid)]
+    except libmailcd.errors.StorageIdNotFoundError as e:
+        print(f"{e}")
+        sys.exit(1)
+
+    counts = { status: 0 for status in [libmailcd.verify.VERIFY_OK, libmailcd.verify.VERIFY_BAD, libmailcd.verify.VERIFY_SKIPPED] }
+    for result in api.store_verify_packages(packages, jobs, checkpoint, limit):
+        counts[result.status] += 1
+
+        if result.status == libmailcd.verify.VERIFY_BAD:
+            for path, problem in result.problems:
+                print(f"{result.ref} - {problem}\t{path}")
+            if quarantine:
+                print(f"{result.ref} - quarantined: {api.store_quarantine(result.storage_id, result.package_hash)}")
+        else:
+            print(f"{result.ref} - {result.status.upper()}")
+
+    print(f"{counts[libmailcd.verify.VERIFY_OK]} ok, {counts[libmailcd.verify.VERIFY_BAD]} bad, {counts[libmailcd.verify.VERIFY_SKIPPED]} skipped")
+    if counts[libmailcd.verify.VERIFY_BAD]:
+        sys.exit(1)
+
+@main_store.command("gc")
+@click.option("--dry-run", is_flag=True, help="Only show what would be removed")
+@click.pass_obj
+def main_store_gc(obj, dry_run):
+    """Remove the packages each storage ID's gc settings don't keep, and stored
+    data no package uses anymore (chunks of the chunked backend).
+
+    Example(s):
+
+        mb store config MYPACKAGE gc_max_size 20G
+
+        mb store config MYPACKAGE gc_keep_labels release,nightly
+
+        mb store gc --dry-run
+
+    """
+    api = obj["api"]
+
+    removed, chunks_removed, freed = api.store_gc(dry_run=dry_run)
+
+    for storage_id, package_hash, size in removed:
+        print(f"{'would remove' if dry_run else 'removed'}: {storage_id}/{package_hash} ({size} bytes)")
+
+    if dry_run:
+        print(f"Would remove {len(removed)} packages, {chunks_removed} chunks ({freed} bytes)")
+    else:
+        print(f"Removed {len(removed)} packages, {chunks_removed} chunks ({freed} bytes)")
+
 @main_store.command("get")
 @click.argument("ref")
 @click.argument("labels", nargs=-1)
+@click.option("--include", "-i", multiple=True, help="Only get the files matching this glob (can be given more than once)")
 @click.pass_obj
-def main_store_get(obj, ref, labels):
+def main_store_get(obj, ref, labels, include):
     """Get a PACKAGE from the specified REF, that have any of the specified LABELS.
 
     Example(s):
@@ -150,14 +347,18 @@ def main_store_get(obj, ref, labels):
 
         mb store get MYPACKAGE best version ever
 
+        mb store get MYPACKAGE/2de --include "include/*" --include "lib/*.so"
+
+        mb store get MYPACKAGE/2de/include
+
     """
     api = obj["api"]
 
-    try:
-        storage_id, partial_package_hash = libmailcd.storage.split_ref(ref)
-    except ValueError:
-        storage_id = ref
-        partial_package_hash = None
+    # Case: mb store get SID/2de/path -- same as --include path
+    storage_id, partial_package_hash, relpath = libmailcd.storage.split_package_ref(ref)
+    include = list(include)
+    if relpath:
+        include.append(relpath)
 
     # Case: Invalid storage id
     # TODO(matthew): validate storage id here... checking for not null is not correct
@@ -185,7 +386,7 @@ def main_store_get(obj, ref, labels):
         target_path = Path(api.settings("workspace"), target_relpath)
 
         # find package
-        api.store_download(storage_id, package_hash, target_path)
+        api.store_download(storage_id, package_hash, target_path, include=include or None)
         print(f"Package downloaded: '{target_relpath}'")
     elif labels:
         matches = api.store_find(storage_id, labels)
@@ -205,7 +406,7 @@ def main_store_get(obj, ref, labels):
 
         target_relpath = Path(api.settings("local_root_relative"), LOCAL_INBOX_DIRNAME, storage_id, package_hash)
         target_path = Path(api.settings("workspace"), target_relpath)
-        api.store_download(storage_id, package_hash, target_path)
+        api.store_download(storage_id, package_hash, target_path, include=include or None)
         print(f"Package downloaded: '{target_relpath}'")
     # Case: no package hash, no labels, what do? Error?
     else:
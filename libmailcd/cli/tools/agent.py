@@ -1,6 +1,8 @@
 import os
-import subprocess
 import logging
+import threading
+import contextlib
+import subprocess
 
 from libmailcd.cli.common.exceptions import AppNotInstalledError
 from libmailcd.cli.common.exceptions import AppNotRunningError
@@ -25,10 +27,11 @@ def _print_result(result):
         print(f"STDERR:")
         print(result.stderr)
 
-def _run_cmd(args):
+def _run_cmd(args, cwd=None):
     result = subprocess.run(
         args,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=cwd
     )
 
     result.stdout = result.stdout.decode()
@@ -50,28 +53,28 @@ class NodeInterface(ABC):
         pass
 
 class LocalNode(NodeInterface):
+    # NOTE: steps run in the workspace (cwd of their process), never by changing
+    #  this process' cwd, stages run at the same time on different threads
     def __init__(self, workspace):
         self.workspace = workspace
 
     def __enter__(self):
-        self._previous_cwd = os.getcwd()
-        os.chdir(self.workspace)
+        pass
 
-    def __exit__(self):
-        os.chdir(self._previous_cwd)
-        self._previous_cwd = None
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
 
     def run_step(self, step):
         return _run_cmd([
             "cmd", "/c",
             f"{step}"
-        ])
+        ], cwd=self.workspace)
 
     def get_env(self):
         return _run_cmd([
             "cmd", "/c",
             f"SET"
-        ])
+        ], cwd=self.workspace)
 
 class LocalDockerNode(LocalNode):
     def __init__(self, image, host_workspace, env):
@@ -124,21 +127,70 @@ def validate_dependencies_met():
     if not docker.is_running():
         raise AppNotRunningError("docker")
 
+class _DockerModeLock():
+    """Docker Desktop on Windows runs either Linux or Windows containers, and
+     switching modes switches it for every container. Held by any number of
+     stages using the same mode, but only one mode at a time.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._mode = None
+        self._holders = 0
+
+    @contextlib.contextmanager
+    def hold(self, mode):
+        with self._condition:
+            while self._holders and self._mode != mode:
+                self._condition.wait()
+            self._mode = mode
+            self._holders += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._holders -= 1
+                if not self._holders:
+                    self._mode = None
+                    self._condition.notify_all()
+
+_docker_mode_lock = _DockerModeLock()
+
+def reserve(node_dict):
+    """Hold what a node needs to itself (see _DockerModeLock), from before the
+    node is made (factory) until it's done with. Stages running at the same time
+    that need another Docker mode wait for it.
+    """
+    if node_dict and os.name == "nt":
+        containerfile_os, _ = _get_containerfile(node_dict)
+        return _docker_mode_lock.hold(containerfile_os)
+    return contextlib.nullcontext()
+
+def _get_containerfile(node_dict):
+    """Get (containerfile OS, containerfile) of a node
+    """
+    # Assumes Containerfile Scenario
+    containerfile_ref = str(node_dict['containerfile'])
+
+    containerfile = containerfile_ref
+    containerfile_os = PIPELINE_CONTAINERFILE_OS_LINUX # set default to windows .. for now -- also should come in via settings
+
+    # If the user specified the OS, use it instead of the default
+    if PIPELINE_CONTAINERFILE_SEPARATOR in containerfile_ref:
+        containerfile_os, containerfile = containerfile_ref.split(PIPELINE_CONTAINERFILE_SEPARATOR)
+
+    return containerfile_os, containerfile
+
 def factory(node_dict, workspace, env):
+    """Make a stage's node (see reserve, for stages running at the same time)
+    """
     host_workspace = workspace
     if node_dict:
         # NOTE(Matthew): This is getting gross, how to handle the docker cache system? Should not go into the library for sure.
         #  Should be implemented at the cli / default API.  The whole node factory should be implemented by the cli.
 
-        # Assumes Containerfile Scenario
-        containerfile_ref = str(node_dict['containerfile'])
-
-        containerfile = containerfile_ref
-        containerfile_os = PIPELINE_CONTAINERFILE_OS_LINUX # set default to windows .. for now -- also should come in via settings
-
-        # If the user specified the OS, use it instead of the default
-        if PIPELINE_CONTAINERFILE_SEPARATOR in containerfile_ref:
-            containerfile_os, containerfile = containerfile_ref.split(PIPELINE_CONTAINERFILE_SEPARATOR)
+        containerfile_os, containerfile = _get_containerfile(node_dict)
 
         # Should build container?
         container_hash = hash_file(containerfile)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import logging
+from pathlib import Path
+
+from libmailcd.constants import LOCAL_MB_ROOT
+from libmailcd.constants import PIPELINE_COPY_SEPARATOR
+
+########################################
+
+# Workspace directories never searched for files to copy (the mailbox's own
+#  directory holds every extracted inbox package)
+EXCLUDED_ROOTS = [LOCAL_MB_ROOT, ".git"]
+
+########################################
+
+def parse_rule(rule):
+    """Split a copy rule ('src/*.h -> include') into (source glob, destination).
+
+    A destination starting with '/' is the root of the outbox (not of the drive
+     or file system), so destinations never leave the outbox.
+    """
+    source, destination = rule.split(PIPELINE_COPY_SEPARATOR)
+    source = source.strip().replace('\\', '/').lstrip('/')
+    destination = destination.strip().lstrip('/\\')
+    return source, destination
+
+def translate(source):
+    """Get the regex for a source glob, matching the workspace relative paths
+    ('/' separated) of the files workspace.glob("**/" + source) finds.
+
+    '*', '?' and '[...]' don't match across directories, a '**' directory
+     matches any number of them.
+    """
+    regex = "(?:.*/)?"
+    segments = source.split('/')
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == "**":
+            regex += ".*" if last else "(?:.*/)?"
+        else:
+            regex += _translate_segment(segment) + ("" if last else "/")
+    return regex + r"\Z"
+
+########################################
+
+class RuleMatcher():
+    """Every copy rule of every outbox compiled together, so the files they all
+     match are found in a single walk of the workspace (see find).
+
+    rules are (key, source glob), the key is whatever the caller wants back for
+     the rules a file matches.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        # Path.glob() is case insensitive on Windows
+        flags = re.IGNORECASE if os.name == 'nt' else 0
+        self._patterns = [re.compile(translate(source), flags) for _, source in self.rules]
+
+        # Most files match no rule at all, one regex for all of them rules those
+        #  out in a single match
+        self._any = None
+        if self.rules:
+            self._any = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in self._patterns), flags)
+
+    def match(self, relpath):
+        """Get the keys of every rule matching a path (relative to the workspace)
+        """
+        if self._any is None or not self._any.match(relpath):
+            return []
+        return [key for (key, _), pattern in zip(self.rules, self._patterns) if pattern.match(relpath)]
+
+    def find(self, workspace, excluded=()):
+        """Walk the workspace once, yields (path, keys) for every file matching
+        at least one rule.
+
+        excluded are paths (relative to the workspace) that are skipped, excluded
+         directories aren't descended into at all.
+        """
+        if self._any is None:
+            return
+
+        excluded = set(_normalize_path(path) for path in excluded)
+
+        # Iterative, in sorted order (so files copied to the same destination
+        #  always overwrite each other in the same order)
+        pending = [""]
+        while pending:
+            reldirpath = pending.pop()
+            try:
+                with os.scandir(os.path.join(workspace, reldirpath)) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                logging.debug(f"Can't search: {reldirpath} ({e})")
+                continue
+
+            subdirs = []
+            for entry in entries:
+                relpath = f"{reldirpath}/{entry.name}" if reldirpath else entry.name
+                if relpath in excluded:
+                    continue
+
+                # Like Path.glob(), symlinked directories aren't descended into
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                elif entry.is_file():
+                    keys = self.match(relpath)
+                    if keys:
+                        yield Path(workspace, relpath), keys
+
+            pending.extend(reversed(subdirs))
+
+########################################
+
+def _normalize_path(path):
+    return str(path).replace('\\', '/').strip('/')
+
+def _translate_segment(segment):
+    regex = ""
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        i += 1
+        if c == '*':
+            regex += "[^/]*"
+        elif c == '?':
+            regex += "[^/]"
+        elif c == '[':
+            # Same as fnmatch: '[!...]' is negated, a ']' right after the
+            #  opening (or '!') is part of the set, no closing ']' is a literal '['
+            j = i
+            if j < len(segment) and segment[j] == '!':
+                j += 1
+            if j < len(segment) and segment[j] == ']':
+                j += 1
+            j = segment.find(']', j)
+            if j < 0:
+                regex += re.escape(c)
+                continue
+
+            chars = segment[i:j].replace('\\', '\\\\').replace('[', '\\[')
+            i = j + 1
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            regex += f"(?!/)[{chars}]"
+        else:
+            regex += re.escape(c)
+    return regex
@@ -27,4 +27,38 @@ class StorageMultipleFound(StorageIdValueError):
     def __init__(self, storage_id, matches, message = None):
         self.matches = matches
 
-        super(StorageMultipleFound, self).__init__(storage_id, message)
\ No newline at end of file
+        super(StorageMultipleFound, self).__init__(storage_id, message)
+
+
+class InboxError(Exception):
+    """Raised when more than one inbox slot failed"""
+
+    def __init__(self, errors, message = None):
+        self.errors = errors # [(slot, exception)]
+        if not message:
+            message = f"{len(errors)} inbox slots failed: {', '.join(slot for slot, _ in errors)}"
+
+        super(InboxError, self).__init__(message)
+
+
+class StageError(Exception):
+    """Raised when a pipeline stage failed (the stages running with it are cancelled)"""
+
+    def __init__(self, stage, error, message = None):
+        self.stage = stage
+        self.error = error
+        if not message:
+            message = f"Stage '{stage}' failed: {error}"
+
+        super(StageError, self).__init__(message)
+
+
+class StageCycleError(ValueError):
+    """Raised when pipeline stages depend on each other (through their inboxes and outboxes)"""
+
+    def __init__(self, cycle, message = None):
+        self.cycle = cycle # [stage, stage it depends on, ..., stage]
+        if not message:
+            message = f"Stages depend on each other: {' -> '.join(cycle)}"
+
+        super(StageCycleError, self).__init__(message)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import zlib
+import struct
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import libmailcd.hashing
+
+########################################
+
+# Zip local file header (see zipfile.structFileHeader)
+_LOCAL_HEADER_FORMAT = "<4s2B4HL2L2H"
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FORMAT)
+_LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+# Members are handed to workers in batches of (about) this many bytes, so
+#  tiny files don't each cost a round trip through the thread pool
+BATCH_SIZE = 32 * 1024 * 1024
+
+# Only files at least this big are preallocated (for small ones it costs more than it saves)
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+########################################
+
+class ExtractStats():
+    def __init__(self, files, size, elapsed):
+        self.files = files
+        self.size = size # uncompressed bytes written
+        self.elapsed = elapsed # seconds
+
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        return self.size / self.elapsed if self.elapsed > 0 else 0
+
+    def __str__(self):
+        mib = 1024 * 1024
+        return f"{self.files} files, {self.size / mib:.1f} MiB in {self.elapsed:.2f}s ({self.throughput / mib:.1f} MiB/s)"
+
+def extract_zip(archive_path, entries, target_path, dirs=(), max_workers=None):
+    """Extract members of a zip (sidecar entries, see libmailcd.sidecar) in a thread pool.
+
+    Members are split into batches (in archive order, so each worker reads the
+     zip sequentially), every worker reads through its own file handle (zlib
+     releases the GIL, so decompression runs on every core). dirs are created
+     first (so empty directories exist too).
+
+    Returns ExtractStats
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    start = time.perf_counter()
+
+    for dirpath in sorted(dirs):
+        if not dirpath:
+            continue
+        os.makedirs(get_target_filepath(target_path, dirpath), exist_ok=True)
+
+    entries = sorted(entries, key=lambda entry: entry.header_offset)
+    batches = _get_batches(entries, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(extract_entries, archive_path, batch, target_path) for batch in batches]
+        size = sum(future.result() for future in futures)
+
+    return ExtractStats(len(entries), size, time.perf_counter() - start)
+
+def _get_batches(entries, max_workers):
+    # Small packages still get spread over every worker
+    total_size = sum(entry.compress_size for entry in entries)
+    batch_size = min(BATCH_SIZE, max(1, total_size // (max_workers * 4)))
+
+    batches = []
+    batch = []
+    batch_compress_size = 0
+    for entry in entries:
+        batch.append(entry)
+        batch_compress_size += entry.compress_size
+        if batch_compress_size >= batch_size:
+            batches.append(batch)
+            batch = []
+            batch_compress_size = 0
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def extract_entries(archive_path, entries, target_path):
+    """Extract some members of a zip, given their sidecar entries (see libmailcd.sidecar).
+
+    Each member is read straight from its offset in the zip, the zip's central
+     directory is never read. Returns the number of bytes written.
+
+    See extract_zip() to extract in parallel.
+    """
+    written = 0
+    with open(archive_path, 'rb') as f:
+        for entry in entries:
+            written += extract_entry(f, entry, target_path, archive_path)
+    return written
+
+def extract_entry(f, entry, target_path, archive_path):
+    filepath = get_target_filepath(target_path, entry.path)
+    os.makedirs(filepath.parent, exist_ok=True)
+
+    f.seek(entry.header_offset)
+    header = struct.unpack(_LOCAL_HEADER_FORMAT, f.read(_LOCAL_HEADER_SIZE))
+    if header[0] != _LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header for '{entry.path}' in {archive_path}")
+
+    name_length, extra_length = header[10], header[11]
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+
+    if entry.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif entry.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        # Anything else (bzip2, lzma, ...) isn't worth doing by hand
+        with zipfile.ZipFile(archive_path) as zfile:
+            with zfile.open(_get_member_name(zfile, entry.path)) as src, open(filepath, 'wb') as dst:
+                for chunk in libmailcd.hashing.read_chunks(src):
+                    dst.write(chunk)
+        return entry.size
+
+    crc = 0
+    remaining = entry.compress_size
+    with open(filepath, 'wb') as dst:
+        _preallocate(dst, entry.size)
+
+        while remaining > 0:
+            data = f.read(min(remaining, libmailcd.hashing.READ_SIZE))
+            if not data:
+                raise zipfile.BadZipFile(f"Truncated member '{entry.path}' in {archive_path}")
+            remaining -= len(data)
+
+            if decompressor:
+                data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            dst.write(data)
+
+        if decompressor:
+            data = decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            dst.write(data)
+
+    if entry.crc is not None and crc != entry.crc:
+        raise zipfile.BadZipFile(f"Bad CRC for '{entry.path}' in {archive_path}")
+
+    return entry.size
+
+def get_target_filepath(target_path, relpath):
+    """Where a package's file goes under target_path (refuses paths that would escape it)
+    """
+    relpath = libmailcd.hashing.normalize_path(relpath)
+    if not relpath or ".." in relpath.split('/'):
+        raise ValueError(f"Invalid path in package: {relpath}")
+    return Path(target_path, relpath)
+
+def _preallocate(f, size):
+    """Reserve the space for a file up front (less fragmentation, fails early if the disk is full)
+    """
+    if size < PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+        return
+
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        # Not supported by every file system, it's only an optimization
+        if e.errno == errno.ENOSPC:
+            raise
+
+def _get_member_name(zfile, path):
+    for name in zfile.namelist():
+        if libmailcd.hashing.normalize_path(name) == path:
+            return name
+    raise KeyError(path)
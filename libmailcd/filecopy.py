@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import errno
+import shutil
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import libmailcd.hashing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+########################################
+
+# How files are staged (copied into an outbox)
+COPY_MODE_COPY = "copy" # an independent copy, shares blocks (reflink) where the file system can
+COPY_MODE_LINK = "link" # a hard link (same file system), the outbox file IS the workspace file
+COPY_MODES = [COPY_MODE_COPY, COPY_MODE_LINK]
+
+# How a file was copied (see copy_file)
+COPIED_LINK = "link"
+COPIED_REFLINK = "reflink"
+COPIED_KERNEL = "kernel" # copy_file_range() or sendfile(), no copy through user space
+COPIED_READ = "read"
+
+# Most bytes per copy_file_range()/sendfile() call (they're limited to ~2GB)
+KERNEL_COPY_SIZE = 1024 * 1024 * 1024
+
+# ioctl(FICLONE) from linux/fs.h: the destination shares the source's blocks
+#  (copy on write, btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+# A file system or kernel that can't do a copy this way (try the next one)
+_UNSUPPORTED_ERRNOS = set(
+    getattr(errno, name) for name in ["EXDEV", "ENOSYS", "EINVAL", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EBADF"]
+    if hasattr(errno, name)
+)
+
+########################################
+
+def copy_file(src, dst, mode=COPY_MODE_COPY):
+    """Copy a file (and its permission bits), without its bytes going through
+    user space where possible. Returns how it was copied (COPIED_*).
+
+    COPY_MODE_LINK hard links instead, and copies if it can't (different file systems).
+    """
+    # Never write into an existing file, it might be a hard link to a workspace file
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode == COPY_MODE_LINK:
+        try:
+            os.link(src, dst)
+            return COPIED_LINK
+        except OSError as e:
+            logging.debug(f"Can't hard link, copying: {src} ({e})")
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copied = _copy_fd(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+
+    shutil.copymode(src, dst)
+    return copied
+
+def copy_files(copies, mode=COPY_MODE_COPY, max_workers=None):
+    """Copy many files ((src, dst)) at the same time (see copy_file), in a
+    thread pool. Returns how many were copied each way ({COPIED_*: count}).
+
+    Copies to the same dst end up as they would one after the other: the last one wins.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    latest = {}
+    for src, dst in copies:
+        latest[os.path.normpath(dst)] = src
+
+    counts = Counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(copy_file, src, dst, mode) for dst, src in latest.items()]
+        for future in futures:
+            counts[future.result()] += 1
+
+    return counts
+
+########################################
+
+def _copy_fd(src_fd, dst_fd, size):
+    if _reflink(src_fd, dst_fd):
+        return COPIED_REFLINK
+
+    copied = COPIED_READ
+    offset = 0
+    for copy_range in _get_kernel_copies():
+        try:
+            # sendfile() writes at dst's position, copy_file_range() at the offset given
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < size:
+                count = copy_range(src_fd, dst_fd, offset, min(size - offset, KERNEL_COPY_SIZE))
+                if not count:
+                    break
+                offset += count
+            copied = COPIED_KERNEL
+            break
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    # Whatever's left (everything if the kernel couldn't copy it, or what was
+    #  appended to the file since its size was taken)
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while True:
+        buf = os.read(src_fd, libmailcd.hashing.READ_SIZE)
+        if not buf:
+            break
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+    return copied
+
+def _reflink(src_fd, dst_fd):
+    # TODO(matthew): macOS has clonefile() (APFS), but only by path and not through os
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+def _get_kernel_copies():
+    copies = []
+    if hasattr(os, "copy_file_range"):
+        copies.append(lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset))
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        # Only Linux can sendfile() into a regular file
+        copies.append(lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count))
+    return copies
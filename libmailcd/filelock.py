@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+from pathlib import Path
+
+########################################
+
+# How often a blocked lock is tried again (only on Windows, flock() waits by itself)
+RETRY_INTERVAL = 0.05
+
+########################################
+
+class FileLock():
+    """A lock held on a file, between processes (and threads, each one has to
+     create its own FileLock).
+
+    Shared locks can be held by many at the same time, an exclusive lock only by
+     one (and no shared ones). Windows has no shared locks, they're exclusive there.
+
+    with FileLock(path, shared=True):
+        ...
+    """
+
+    def __init__(self, path, shared=False, timeout=None):
+        self.path = Path(path)
+        self.shared = shared
+        self.timeout = timeout # seconds, None waits forever
+        self._fd = None
+
+    def acquire(self):
+        os.makedirs(self.path.parent, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            _lock(fd, self.shared, self.timeout)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            _unlock(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+########################################
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock(fd, shared, timeout):
+        # Locks the first byte (it doesn't need to exist)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for lock: {fd}")
+                time.sleep(RETRY_INTERVAL)
+
+    def _unlock(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock(fd, shared, timeout):
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if timeout is None:
+            fcntl.flock(fd, operation)
+            return
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for lock: {fd}")
+                time.sleep(RETRY_INTERVAL)
+
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+########################################
+
+HASH_CACHE_ROOT = str(Path(Path.home(), ".mailcd", "cache"))
+HASH_CACHE_FILENAME = "hashes.db"
+
+# Bump this whenever what's stored in the cache changes, the cache is thrown
+#  away (not migrated) when the version doesn't match.
+_SCHEMA_VERSION = 1
+_SCHEMA = """
+    CREATE TABLE hashes (
+        path TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        ctime_ns INTEGER NOT NULL,
+        digest BLOB NOT NULL,
+        PRIMARY KEY (path, kind)
+    ) WITHOUT ROWID
+"""
+
+# Files modified this recently aren't cached, they could still be written to
+#  within the resolution of the file system timestamps (and not change the stat).
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+_local = threading.local()
+
+########################################
+
+def open_cache(cache_root=None):
+    """Get the file hash cache (connections are cached per thread).
+    """
+    if cache_root is None:
+        cache_root = HASH_CACHE_ROOT
+
+    caches = getattr(_local, "caches", None)
+    if caches is None:
+        caches = _local.caches = {}
+
+    key = str(cache_root)
+    if key not in caches:
+        caches[key] = HashCache(cache_root)
+
+    return caches[key]
+
+def stat_key(st):
+    """The parts of a stat result that must match for a cached digest to be used.
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+def _is_racy(st):
+    return st.st_mtime_ns >= time.time_ns() - RACY_WINDOW_NS
+
+class HashCache():
+    """Digests of files, keyed on (path, kind) and only valid while the file's stat is unchanged.
+
+    'kind' identifies what the digest is of (what hash, over what), so different
+     callers can cache different digests of the same file.
+    """
+
+    def __init__(self, cache_root):
+        os.makedirs(cache_root, exist_ok=True)
+        self.path = Path(cache_root, HASH_CACHE_FILENAME)
+
+        self._conn = sqlite3.connect(str(self.path), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            self._reset()
+
+    def _reset(self):
+        # Take the write lock before checking again, other threads or processes
+        #  might be opening a new cache at the same time (see catalog.py)
+        self._conn.isolation_level = None
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != _SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS hashes")
+                self._conn.execute(_SCHEMA)
+                self._conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._conn.isolation_level = ""
+
+    def lookup(self, filepath, kind, st=None):
+        """Get the cached digest of a file (None if not cached, or the file changed)
+        """
+        filepath = os.path.abspath(filepath)
+        if st is None:
+            st = os.stat(filepath)
+
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, ino, ctime_ns, digest FROM hashes WHERE path = ? AND kind = ?",
+            (filepath, kind)
+        ).fetchone()
+
+        if row and tuple(row[:4]) == stat_key(st):
+            return bytes(row[4])
+
+        return None
+
+    def store(self, filepath, kind, digest, st=None):
+        filepath = os.path.abspath(filepath)
+        if st is None:
+            st = os.stat(filepath)
+
+        if _is_racy(st):
+            return
+
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hashes (path, kind, size, mtime_ns, ino, ctime_ns, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (filepath, kind, *stat_key(st), digest)
+            )
+
+    def scan(self, directory, kind):
+        """Get a view of the cache for every file under a directory.
+
+        Loads all the entries under the directory up front (one query), and
+         writes all updates in one transaction when closed. Entries for files
+         not looked up during the scan (they're gone) are evicted.
+        """
+        return DirectoryScan(self, directory, kind)
+
+    def prune(self):
+        """Remove the entries of every file that no longer exists.
+        """
+        paths = [row[0] for row in self._conn.execute("SELECT DISTINCT path FROM hashes")]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+
+        with self._conn:
+            self._conn.executemany("DELETE FROM hashes WHERE path = ?", gone)
+
+        return len(gone)
+
+class DirectoryScan():
+    def __init__(self, cache, directory, kind):
+        self._cache = cache
+        self._kind = kind
+        self._prefix = os.path.join(os.path.abspath(directory), "")
+
+        # Every path under the directory sorts between prefix and prefix + max char
+        rows = cache._conn.execute(
+            "SELECT path, kind, size, mtime_ns, ino, ctime_ns, digest FROM hashes WHERE path >= ? AND path < ?",
+            (self._prefix, self._prefix + "\U0010ffff")
+        )
+
+        self._entries = {}
+        self._paths = set()
+        for row in rows:
+            self._paths.add(row[0])
+            if row[1] == kind:
+                self._entries[row[0]] = (tuple(row[2:6]), bytes(row[6]))
+
+        self._seen = set()
+        self._updates = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Only evict after a complete scan, otherwise we didn't see every file
+        self.close(evict=exc_type is None)
+
+    def lookup(self, filepath, st):
+        filepath = os.path.abspath(filepath)
+        self._seen.add(filepath)
+
+        entry = self._entries.get(filepath)
+        if entry and entry[0] == stat_key(st):
+            return entry[1]
+
+        return None
+
+    def store(self, filepath, digest, st):
+        filepath = os.path.abspath(filepath)
+        self._seen.add(filepath)
+
+        if not _is_racy(st):
+            self._updates.append((filepath, self._kind, *stat_key(st), digest))
+
+    def close(self, evict=True):
+        conn = self._cache._conn
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes (path, kind, size, mtime_ns, ino, ctime_ns, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._updates
+            )
+            if evict:
+                conn.executemany(
+                    "DELETE FROM hashes WHERE path = ?",
+                    [(path,) for path in self._paths - self._seen]
+                )
+        self._updates = []
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import hashlib
+import threading
+
+########################################
+
+# Package IDs are "<scheme prefix>-<hex digest>", except for the original
+#  (legacy) scheme, which has no prefix.
+ID_SEPARATOR = "-"
+
+# Size of the (per thread, reused) buffer files are read into for hashing
+READ_SIZE = 1024 * 1024
+
+DEFAULT_SCHEME = "merkle"
+
+_schemes = {}
+_local = threading.local()
+
+########################################
+
+def get_read_buffer():
+    """Get this thread's read buffer (don't hold on to views of it across reads)
+    """
+    buf = getattr(_local, "buffer", None)
+    if buf is None:
+        buf = _local.buffer = bytearray(READ_SIZE)
+    return buf
+
+def read_chunks(f):
+    """Yield the contents of a (binary) file object, READ_SIZE at a time.
+
+    Note: each chunk is a view into a reused buffer, it's only valid until the next one.
+    """
+    buf = get_read_buffer()
+    view = memoryview(buf)
+    while True:
+        size = f.readinto(buf)
+        if not size:
+            break
+        yield view[:size]
+
+########################################
+
+class HashScheme():
+    """How a package hash (ID) is calculated.
+
+    A package hash is a hash over every file of the package: a digest of its
+     path (relative to the package root), then a digest of its contents (see
+     libmailcd.manifest).
+    """
+    name = None
+    prefix = None
+
+    # If the package hash is the root of a tree of directory digests (see
+    #  libmailcd.merkle), instead of a hash over every file in order
+    is_tree = False
+
+    # If a stored package can be checked against its package hash
+    is_verifiable = True
+
+    def new(self):
+        """Create a new hash object"""
+        raise NotImplementedError
+
+    def new_file_digester(self):
+        """Create an object to digest a file's contents (update()/digest())"""
+        return self.new()
+
+    def digest_path(self, relfilepath):
+        path_hash = self.new()
+        path_hash.update(relfilepath.encode())
+        return path_hash.digest()
+
+    def get_directory_entries(self, directory, dirs=None):
+        """Get the files of a directory, as (relfilepath, filepath).
+
+        If dirs is given, the (relative) path of every sub-directory is added to it.
+        """
+        entries = []
+        for root, subdirs, files in os.walk(directory):
+            _add_dirs(dirs, directory, root, subdirs)
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                entries.append((self.normalize_path(os.path.relpath(filepath, directory)), filepath))
+        return entries
+
+    def normalize_path(self, relfilepath):
+        """Get the canonical form of a path (relative to package root), the same
+        for a file in a directory, zip or tarball.
+        """
+        return normalize_path(relfilepath)
+
+    def order_entries(self, entries):
+        """Put (relfilepath, ...) entries in the order they are hashed.
+        """
+        return sorted(entries, key=lambda entry: entry[0])
+
+    def format_id(self, hexdigest):
+        return f"{self.prefix}{ID_SEPARATOR}{hexdigest}"
+
+    @property
+    def cache_kind_file(self):
+        return f"{self.name}-file"
+
+    @property
+    def cache_kind_zip(self):
+        return f"{self.name}-zip"
+
+class Blake2bScheme(HashScheme):
+    name = "blake2b"
+    prefix = "b2"
+
+    def new(self):
+        return hashlib.blake2b(digest_size=32)
+
+class MerkleScheme(Blake2bScheme):
+    """BLAKE2b Merkle tree: the package hash is the digest of the root directory,
+     a directory's digest is a hash over the names and digests of its children.
+
+    So any file or sub-directory can be verified against the package hash on its
+     own, and a change only changes the digests on the way up to the root.
+    """
+    name = "merkle"
+    prefix = "m2"
+    is_tree = True
+
+    def digest_node(self, children):
+        """Digest of a directory, from its (name, is_dir, digest) children (sorted by name)
+        """
+        node_hash = self.new()
+        node_hash.update(b"d")
+        for name, is_dir, digest in children:
+            name = name.encode()
+            node_hash.update(b"d" if is_dir else b"f")
+            node_hash.update(len(name).to_bytes(4, "little"))
+            node_hash.update(name)
+            node_hash.update(digest)
+        return node_hash.digest()
+
+    @property
+    def cache_kind_file(self):
+        # File digests are the same as the blake2b scheme's
+        return "blake2b-file"
+
+class Blake3Scheme(HashScheme):
+    """Only available if the (optional) blake3 package is installed"""
+    name = "blake3"
+    prefix = "b3"
+
+    def new(self):
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+class Sha1BlockScheme(HashScheme):
+    """The original package hash: SHA-1 over the SHA-1 of every 4 KiB block of every file.
+
+    Files are hashed in walk order (zip members in archive order), with paths of
+     top level files starting with './', so a directory and its zip get different
+     hashes. Kept so existing package IDs resolve.
+    """
+    name = "sha1"
+    prefix = None
+
+    # NOTE: a directory's hash has './' paths, but its zip doesn't, so a package
+    #  that was added as a directory never matches its own zip
+    is_verifiable = False
+
+    # NOTE: can't change without changing every legacy package hash. Reads
+    #  can be any multiple of it though.
+    BLOCK_SIZE = 4096
+
+    def new(self):
+        return hashlib.sha1()
+
+    def new_file_digester(self):
+        return _BlockDigester(self.BLOCK_SIZE)
+
+    def get_directory_entries(self, directory, dirs=None):
+        entries = []
+        for root, subdirs, files in os.walk(directory):
+            _add_dirs(dirs, directory, root, subdirs)
+            for filename in sorted(files):
+                reldir = os.path.relpath(root, directory)
+                relfilepath = os.path.join(reldir, filename)
+                relfilepath = relfilepath.replace('\\', '/') # make sure file separator is consistent across os'
+                entries.append((relfilepath, os.path.join(root, filename)))
+        return entries
+
+    def normalize_path(self, relfilepath):
+        return relfilepath
+
+    def order_entries(self, entries):
+        return list(entries)
+
+    def format_id(self, hexdigest):
+        return hexdigest
+
+    @property
+    def cache_kind_file(self):
+        return "sha1-blocks"
+
+    @property
+    def cache_kind_zip(self):
+        return "sha1-zip"
+
+def _add_dirs(dirs, directory, root, subdirs):
+    if dirs is not None:
+        for dirname in sorted(subdirs):
+            dirs.append(os.path.relpath(os.path.join(root, dirname), directory))
+
+class _BlockDigester():
+    """Digest of every BLOCK_SIZE block (concatenated)
+
+    Every update() must be a multiple of the block size, except the last one.
+    """
+
+    def __init__(self, block_size):
+        self._block_size = block_size
+        self._digests = []
+
+    def update(self, buf):
+        view = memoryview(buf)
+        for offset in range(0, len(view), self._block_size):
+            self._digests.append(hashlib.sha1(view[offset:offset + self._block_size]).digest())
+
+    def digest(self):
+        return b"".join(self._digests)
+
+########################################
+
+def register_scheme(scheme):
+    _schemes[scheme.name] = scheme
+
+def get_scheme(name=None):
+    """Get a hash scheme by name (the default scheme if no name given)
+    """
+    if name is None:
+        name = DEFAULT_SCHEME
+
+    if isinstance(name, HashScheme):
+        return name
+
+    if name not in _schemes:
+        raise ValueError(f"Unknown hash scheme: {name}")
+
+    return _schemes[name]
+
+def get_schemes():
+    return list(_schemes.values())
+
+def get_scheme_for_id(package_id):
+    """Get the hash scheme that produced a package ID
+    """
+    prefix, separator, hexdigest = package_id.rpartition(ID_SEPARATOR)
+    if not _is_hex(hexdigest):
+        raise ValueError(f"Invalid package ID: {package_id}")
+
+    for scheme in _schemes.values():
+        if scheme.prefix == (prefix if separator else None):
+            return scheme
+
+    raise ValueError(f"Unknown hash scheme for package ID: {package_id}")
+
+def is_package_id(s):
+    try:
+        get_scheme_for_id(s or "")
+    except ValueError:
+        return False
+    return True
+
+def expand_partial_id(partial_package_id):
+    """Get every package ID prefix a (possibly abbreviated) package ID could be.
+
+    A partial ID without a scheme prefix ('2de') could be the start of the
+     digest of any scheme ('2de', 'b2-2de', ...). Returns (scheme, prefix)
+     pairs, scheme is None if the partial ID already names its scheme.
+    """
+    if ID_SEPARATOR in partial_package_id:
+        return [(None, partial_package_id)]
+
+    candidates = []
+    for scheme in _schemes.values():
+        candidates.append((scheme, scheme.format_id(partial_package_id)))
+    return candidates
+
+def normalize_path(relfilepath):
+    """'/' separated, without empty or '.' parts ('./a//b' -> 'a/b')
+    """
+    relfilepath = relfilepath.replace('\\', '/')
+    parts = [part for part in relfilepath.split('/') if part and part != '.']
+    return '/'.join(parts)
+
+def _is_hex(s):
+    return re.fullmatch(r"^[0-9a-fA-F]+$", s or "") is not None
+
+########################################
+
+register_scheme(Sha1BlockScheme())
+register_scheme(Blake2bScheme())
+register_scheme(MerkleScheme())
+
+try:
+    import blake3
+    register_scheme(Blake3Scheme())
+except ImportError:
+    pass
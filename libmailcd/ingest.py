@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import zlib
+import shutil
+import logging
+import platform
+import tempfile
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import libmailcd.hashcache
+import libmailcd.hashing
+import libmailcd.manifest
+
+########################################
+
+# Compressed output of a single file is held in memory up to this size before
+#  spilling to a temp file (next to the archive being written).
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+COMPRESS_LEVEL = 6
+
+# CPython versions (oldest, newest) whose ZipFile internals _write_compressed()
+#  was checked against, others take the slower public route
+RAW_WRITE_PYTHON_VERSIONS = ((3, 8), (3, 13))
+
+########################################
+
+class _FileEntry():
+    def __init__(self, filepath, arcname, relfilepath):
+        self.filepath = filepath
+        self.arcname = arcname
+        self.relfilepath = relfilepath # name as hashed (see HashScheme.get_directory_entries)
+
+class _FileResult():
+    def __init__(self, st, digest, crc, file_size, compress_size, data):
+        self.st = st
+        self.digest = digest
+        self.crc = crc
+        self.file_size = file_size
+        self.compress_size = compress_size
+        self.data = data
+
+########################################
+
+def archive_directory(directory, output_path, scheme=None, max_workers=None):
+    """Zip up a directory, and calculate its package hash, in a single read of each file.
+
+    Files are hashed and compressed in a thread pool (hashlib and zlib release
+    the GIL), then written to the zip in the order the hash scheme hashes them.
+
+    Returns the manifest (manifest.get_id() is the same as utils.hash_directory(directory, scheme)).
+     The file digests are saved to the file hash cache along the way.
+    """
+    if not os.path.exists(directory):
+        raise ValueError(f"Directory to archive doesn't exist: {directory}")
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    scheme = libmailcd.hashing.get_scheme(scheme)
+    spool_dir = os.path.dirname(os.path.abspath(output_path))
+    entries = []
+
+    scan = libmailcd.hashcache.open_cache().scan(directory, scheme.cache_kind_file)
+
+    with scan, \
+            zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # Only keep a bounded number of files in flight, so memory use doesn't
+        #  grow with the size of the package
+        in_flight = []
+        max_in_flight = max_workers * 2
+
+        for entry in _walk(directory, zf, scheme):
+            in_flight.append((entry, executor.submit(_process_file, entry, scheme, spool_dir)))
+
+            if len(in_flight) >= max_in_flight:
+                _write_result(zf, entries, scan, *in_flight.pop(0))
+
+        while in_flight:
+            _write_result(zf, entries, scan, *in_flight.pop(0))
+
+    return libmailcd.manifest.Manifest(scheme, entries)
+
+def archive_tar(tarpath, output_path, scheme=None):
+    """Convert a tarball into a zip, and calculate its package hash, in a single read of the tarball.
+
+    Returns the manifest (manifest.get_id() is the same as utils.hash_file(tarpath, scheme)).
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
+    spool_dir = os.path.dirname(os.path.abspath(output_path))
+    entries = []
+
+    # Note: tarballs (especially compressed ones) can only be read front to
+    #  back, so members are compressed one at a time, in archive order.
+    with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf, \
+            tarfile.open(tarpath, mode='r|*') as tfile:
+        for member in tfile:
+            relfilepath = scheme.normalize_path(member.name)
+            if not relfilepath:
+                continue
+
+            if member.isdir():
+                zinfo = zipfile.ZipInfo(relfilepath + '/', time.localtime(member.mtime)[:6])
+                zinfo.external_attr = ((0o40000 | member.mode) << 16) | 0x10
+                zf.writestr(zinfo, b"")
+                continue
+
+            if not member.isfile():
+                continue
+
+            with tfile.extractfile(member) as f:
+                result = _process_stream(f, scheme, spool_dir)
+
+            with result.data:
+                zinfo = zipfile.ZipInfo(relfilepath, time.localtime(member.mtime)[:6])
+                zinfo.external_attr = (0o100000 | member.mode) << 16
+                _write_compressed_result(zf, zinfo, result)
+
+            entries.append(libmailcd.manifest.ManifestEntry(relfilepath, result.file_size, result.digest))
+
+    return libmailcd.manifest.Manifest(scheme, entries)
+
+def _walk(directory, zf, scheme):
+    """Yield every file to archive, after writing all the directory entries to the zip.
+    """
+    dirs = []
+    entries = scheme.order_entries(scheme.get_directory_entries(directory, dirs=dirs))
+
+    for reldirpath in dirs:
+        zf.write(os.path.join(directory, reldirpath), reldirpath)
+
+    for relfilepath, filepath in entries:
+        if not os.path.isfile(filepath):
+            continue
+
+        yield _FileEntry(filepath, os.path.relpath(filepath, directory), relfilepath)
+
+def _process_file(entry, scheme, spool_dir):
+    st = os.stat(entry.filepath)
+    with open(entry.filepath, 'rb') as f:
+        result = _process_stream(f, scheme, spool_dir)
+    result.st = st
+    return result
+
+def _process_stream(f, scheme, spool_dir):
+    digester = scheme.new_file_digester()
+    crc = 0
+    file_size = 0
+    compress_size = 0
+
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=spool_dir)
+
+    try:
+        for chunk in libmailcd.hashing.read_chunks(f):
+            digester.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+
+            compressed = compressor.compress(chunk)
+            compress_size += len(compressed)
+            data.write(compressed)
+
+        compressed = compressor.flush()
+        compress_size += len(compressed)
+        data.write(compressed)
+        data.seek(0)
+    except:
+        data.close()
+        raise
+
+    return _FileResult(None, digester.digest(), crc, file_size, compress_size, data)
+
+def _write_result(zf, entries, scan, entry, future):
+    result = future.result()
+
+    with result.data:
+        entries.append(libmailcd.manifest.ManifestEntry(entry.relfilepath, result.file_size, result.digest))
+        scan.store(entry.filepath, result.digest, result.st)
+
+        zinfo = zipfile.ZipInfo.from_file(entry.filepath, entry.arcname)
+        _write_compressed_result(zf, zinfo, result)
+
+    logging.debug(f"archived: {entry.arcname} ({result.file_size} -> {result.compress_size})")
+
+def _write_compressed_result(zf, zinfo, result):
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = result.crc
+    zinfo.file_size = result.file_size
+    zinfo.compress_size = result.compress_size
+
+    _write_compressed(zf, zinfo, result.data)
+
+def _write_compressed(zf, zinfo, data):
+    """Write an already compressed member into the zip.
+
+    NOTE: ZipFile has no public way to do this, this mirrors what ZipFile.write()
+     does after the data is compressed (local header, data, then register the
+     member so close() writes it into the central directory). That's private
+     state, so it's only done on the CPython versions it was checked against
+     (see _can_write_raw), anywhere else the data is decompressed and written
+     through ZipFile.open() (compressed again, the same zip only slower).
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+
+    if not _can_write_raw(zf):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        with zf.open(zinfo, mode='w', force_zip64=zip64) as dst:
+            for chunk in iter(lambda: data.read(libmailcd.hashing.READ_SIZE), b""):
+                dst.write(decompressor.decompress(chunk))
+            dst.write(decompressor.flush())
+        return
+
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zip64))
+    shutil.copyfileobj(data, zf.fp, libmailcd.hashing.READ_SIZE)
+
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+def _can_write_raw(zf):
+    if platform.python_implementation() != "CPython":
+        return False
+    if not RAW_WRITE_PYTHON_VERSIONS[0] <= sys.version_info[:2] <= RAW_WRITE_PYTHON_VERSIONS[1]:
+        return False
+
+    # Another member being written (ZipFile.open(mode='w')) owns the file position
+    if getattr(zf, "_writing", True):
+        return False
+    return all(hasattr(zf, name) for name in ["fp", "filelist", "NameToInfo", "start_dir", "_didModify"])
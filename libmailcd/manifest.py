@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tarfile
+import zipfile
+
+import libmailcd.hashcache
+import libmailcd.hashing
+import libmailcd.merkle
+
+########################################
+
+class ManifestEntry():
+    def __init__(self, path, size, digest):
+        self.path = path # relative to the package root (in the hash scheme's form)
+        self.size = size
+        self.digest = digest # digest of the contents (see HashScheme.new_file_digester)
+
+class Manifest():
+    """Every file of a package, in the order its hash scheme hashes them.
+
+    The package hash (content ID) only depends on the manifest, so the same
+     files give the same ID whether they came from a directory, zip or tarball
+     (except for the legacy sha1 scheme, which hashes paths as they were found).
+    """
+
+    def __init__(self, scheme, entries):
+        self.scheme = libmailcd.hashing.get_scheme(scheme)
+        ordered = self.scheme.order_entries((entry.path, entry) for entry in entries)
+        self.entries = [entry for _, entry in ordered]
+
+    def get_id(self):
+        if self.scheme.is_tree:
+            return self.get_tree().get_id()
+
+        content_hash = self.scheme.new()
+        for entry in self.entries:
+            content_hash.update(self.scheme.digest_path(entry.path))
+            content_hash.update(entry.digest)
+        return self.scheme.format_id(content_hash.hexdigest())
+
+    def get_tree(self):
+        """Get the Merkle tree of the manifest (only for tree hash schemes)
+        """
+        return libmailcd.merkle.from_manifest(self)
+
+    @property
+    def size(self):
+        return sum(entry.size for entry in self.entries)
+
+########################################
+
+def from_directory(directory, scheme=None, use_cache=True, cached_only=False):
+    """Get the manifest of a directory.
+
+    Only files changed since they were last hashed are read (see libmailcd.hashcache).
+     If cached_only, no file is read at all: returns None if any file would have to be.
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
+
+    if not os.path.exists(directory):
+        raise ValueError(f"Directory to hash doesn't exist: {directory}")
+
+    scan = None
+    if use_cache:
+        scan = libmailcd.hashcache.open_cache().scan(directory, scheme.cache_kind_file)
+
+    entries = []
+    try:
+        for relfilepath, filepath in scheme.get_directory_entries(directory):
+            if not os.path.isfile(filepath):
+                continue
+
+            st = os.stat(filepath)
+
+            digest = None
+            if scan:
+                digest = scan.lookup(filepath, st)
+
+            if digest is None:
+                if cached_only:
+                    if scan:
+                        scan.close(evict=False)
+                    return None
+
+                digest = digest_file(filepath, scheme)
+                if scan:
+                    scan.store(filepath, digest, st)
+
+            entries.append(ManifestEntry(relfilepath, st.st_size, digest))
+    except:
+        if scan:
+            scan.close(evict=False)
+        raise
+
+    if scan:
+        scan.close()
+
+    return Manifest(scheme, entries)
+
+def from_zip(filepath, scheme=None):
+    scheme = libmailcd.hashing.get_scheme(scheme)
+
+    entries = []
+    with zipfile.ZipFile(filepath) as zfile:
+        for info in zfile.infolist():
+            if info.is_dir():
+                continue
+
+            # Note: ZipFile.open() already opens it as a binary format (not text)
+            with zfile.open(info, mode='r') as f:
+                digest = digest_stream(f, scheme)
+
+            entries.append(ManifestEntry(scheme.normalize_path(info.filename), info.file_size, digest))
+
+    return Manifest(scheme, entries)
+
+def from_tar(filepath, scheme=None):
+    scheme = libmailcd.hashing.get_scheme(scheme)
+
+    entries = []
+    # Note: Read the tar as a stream, members are digested in archive order anyway
+    with tarfile.open(filepath, mode='r|*') as tfile:
+        for member in tfile:
+            if not member.isfile():
+                continue
+
+            f = tfile.extractfile(member)
+            digest = digest_stream(f, scheme)
+
+            entries.append(ManifestEntry(scheme.normalize_path(member.name), member.size, digest))
+
+    return Manifest(scheme, entries)
+
+def from_archive(filepath, scheme=None):
+    """Get the manifest of a package archive (zip or tarball)
+    """
+    if zipfile.is_zipfile(filepath):
+        return from_zip(filepath, scheme)
+
+    if tarfile.is_tarfile(filepath):
+        return from_tar(filepath, scheme)
+
+    raise ValueError(f"Not a zip or tarball: {filepath}")
+
+def is_archive(filepath):
+    return zipfile.is_zipfile(filepath) or tarfile.is_tarfile(filepath)
+
+########################################
+
+def digest_stream(f, scheme=None):
+    """Digest of a file's contents, as fed into a package hash.
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
+
+    digester = scheme.new_file_digester()
+    for chunk in libmailcd.hashing.read_chunks(f):
+        digester.update(chunk)
+    return digester.digest()
+
+def digest_file(filepath, scheme=None):
+    with open(filepath, 'rb') as f:
+        return digest_stream(f, scheme)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import posixpath
+
+import libmailcd.hashing
+import libmailcd.manifest
+
+########################################
+
+TREE_VERSION = 1
+
+########################################
+
+class MerkleTree():
+    """The files of a package as a tree: files are leaves (their content digest),
+     every directory's digest is a hash over its children (see MerkleScheme.digest_node).
+
+    The package hash is the root directory's digest. Directory digests are only
+     recalculated when something under them changed, so changing a file only
+     rehashes the directories on its way up to the root.
+
+    Paths are the hash scheme's normalized paths ('/' separated, relative to the package root).
+    """
+
+    def __init__(self, scheme=None):
+        self.scheme = libmailcd.hashing.get_scheme(scheme)
+        if not self.scheme.is_tree:
+            raise ValueError(f"Hash scheme isn't a tree: {self.scheme.name}")
+
+        self._files = {} # path -> (size, digest)
+        self._children = { "": {} } # directory path -> { name: is_dir }
+        self._digests = {} # directory path -> digest (if up to date)
+
+    ########################################
+
+    def set_file(self, path, size, digest):
+        dirpath, name = posixpath.split(path)
+        self._add_directory(dirpath)
+        self._children[dirpath][name] = False
+        self._files[path] = (size, digest)
+        self._invalidate(dirpath)
+
+    def remove_file(self, path):
+        if path not in self._files:
+            return
+
+        del self._files[path]
+        dirpath, name = posixpath.split(path)
+        del self._children[dirpath][name]
+        self._invalidate(dirpath)
+
+        # Directories only exist as long as they have files
+        while dirpath and not self._children[dirpath]:
+            del self._children[dirpath]
+            self._digests.pop(dirpath, None)
+            dirpath, name = posixpath.split(dirpath)
+            del self._children[dirpath][name]
+
+    def get_file(self, path):
+        """Get (size, digest) of a file (None if not in the tree)
+        """
+        return self._files.get(path)
+
+    def get_files(self, dirpath=""):
+        """Get the paths of every file under a directory (sorted)
+        """
+        if not dirpath:
+            return sorted(self._files)
+
+        prefix = dirpath.rstrip('/') + '/'
+        return sorted(path for path in self._files if path.startswith(prefix))
+
+    def is_directory(self, path):
+        return path in self._children
+
+    def __len__(self):
+        return len(self._files)
+
+    ########################################
+
+    def get_digest(self, path=""):
+        """Get the digest of a file or directory
+        """
+        if path in self._files:
+            return self._files[path][1]
+
+        if path not in self._children:
+            raise KeyError(path)
+
+        digest = self._digests.get(path)
+        if digest is None:
+            children = []
+            for name in sorted(self._children[path]):
+                is_dir = self._children[path][name]
+                children.append((name, is_dir, self.get_digest(posixpath.join(path, name))))
+            digest = self._digests[path] = self.scheme.digest_node(children)
+
+        return digest
+
+    def get_id(self):
+        return self.scheme.format_id(self.get_digest().hex())
+
+    def diff(self, other):
+        """Get the paths of every file that differs between two trees (added,
+         removed or changed). Only descends into directories whose digests differ.
+        """
+        changed = []
+        self._diff(other, "", changed)
+        return sorted(changed)
+
+    def _diff(self, other, dirpath, changed):
+        if other.is_directory(dirpath) and self.get_digest(dirpath) == other.get_digest(dirpath):
+            return
+
+        names = set(self._children[dirpath])
+        if other.is_directory(dirpath):
+            names.update(other._children[dirpath])
+
+        for name in names:
+            path = posixpath.join(dirpath, name)
+            if self.is_directory(path):
+                self._diff(other, path, changed)
+                if other.get_file(path):
+                    changed.append(path)
+            elif other.is_directory(path):
+                changed.extend(other.get_files(path))
+                if self.get_file(path):
+                    changed.append(path)
+            elif self.get_file(path) != other.get_file(path):
+                changed.append(path)
+
+    ########################################
+
+    def _add_directory(self, dirpath):
+        # Every missing directory (up to the first one that exists) has to be
+        #  added to its parent's children, top down so the parent is there
+        missing = []
+        while dirpath not in self._children:
+            missing.append(dirpath)
+            dirpath = posixpath.dirname(dirpath)
+
+        for dirpath in reversed(missing):
+            self._children[dirpath] = {}
+            parent, name = posixpath.split(dirpath)
+            self._children[parent][name] = True
+
+    def _invalidate(self, dirpath):
+        while True:
+            self._digests.pop(dirpath, None)
+            if not dirpath:
+                break
+            dirpath = posixpath.dirname(dirpath)
+
+    ########################################
+
+    def to_bytes(self):
+        tree = {
+            "version": TREE_VERSION,
+            "scheme": self.scheme.name,
+            "files": [[path, size, digest.hex()] for path, (size, digest) in sorted(self._files.items())]
+        }
+        return zlib.compress(json.dumps(tree, separators=(",", ":")).encode())
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a tree saved with to_bytes()
+
+        Note: only the leaves are saved, directory digests are recalculated (so
+         get_id() of a loaded tree always matches its files).
+        """
+        tree = json.loads(zlib.decompress(data))
+        if tree.get("version") != TREE_VERSION:
+            raise ValueError(f"Unsupported tree version: {tree.get('version')}")
+
+        self = cls(tree["scheme"])
+        for path, size, digest in tree["files"]:
+            self.set_file(path, size, bytes.fromhex(digest))
+        return self
+
+########################################
+
+def from_manifest(manifest):
+    tree = MerkleTree(manifest.scheme)
+    for entry in manifest.entries:
+        tree.set_file(entry.path, entry.size, entry.digest)
+    return tree
+
+def update_from_directory(tree, directory, relpaths):
+    """Incremental rehash: only re-digest the given files (relative to directory)
+     of a tree that was built from directory.
+
+    Files that no longer exist are removed from the tree. Returns the new package hash.
+    """
+    for relpath in relpaths:
+        path = tree.scheme.normalize_path(relpath)
+        filepath = os.path.join(directory, path)
+        if os.path.isfile(filepath):
+            tree.set_file(path, os.path.getsize(filepath), libmailcd.manifest.digest_file(filepath, tree.scheme))
+        else:
+            tree.remove_file(path)
+
+    return tree.get_id()
@@ -2,10 +2,11 @@
 class Pipeline:
     # Note(Matthew): if methods in this class access the dict, we need to restructure
 
-    def __init__(self, inbox, outbox, stages):
+    def __init__(self, inbox, outbox, stages, exclude=None):
         self.inbox = inbox
         self.outbox = outbox
         self.stages = stages
+        self.exclude = exclude # workspace paths outbox rules don't search
 
     @staticmethod
     def from_dict(pipeline):
@@ -21,8 +22,13 @@ class Pipeline:
         if 'stages' in pipeline:
             pipeline_stages = pipeline['stages']
 
+        pipeline_exclude = None
+        if 'exclude' in pipeline:
+            pipeline_exclude = pipeline['exclude']
+
         return Pipeline(
             inbox=pipeline_inbox,
             outbox=pipeline_outbox,
-            stages=pipeline_stages
+            stages=pipeline_stages,
+            exclude=pipeline_exclude
         )
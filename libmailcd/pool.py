@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import stat
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+import libmailcd.hashing
+import libmailcd.stamp
+import libmailcd.storage
+import libmailcd.utils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+########################################
+
+# Extracted packages, shared by every workspace on the machine
+POOL_ROOT = str(Path(Path.home(), ".mailcd", "pool"))
+POOL_INDEX_FILENAME = "pool.db"
+
+# Least recently used packages are evicted once the pool is bigger than this
+#  (mb build/pull --pool-max-size)
+POOL_MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+# How an inbox is filled from the pool (mb build/pull --inbox-mode):
+#  reflink: copy-on-write clones (btrfs, xfs, ...), safe to modify
+#  copy: plain copies, safe to modify
+#  auto: reflink, falling back to copy
+#  hardlink: the pool's files themselves (read-only, replace instead of modifying them)
+#  symlink: the inbox is a (read-only) symlink to the pool, breaks if it's evicted
+#
+# NOTE: read-only doesn't stop root (docker, most CI) or a chmod, writing to a
+#  hardlinked or symlinked inbox changes the pool's copy for every workspace.
+#  That's why they're only used when asked for (and see get(verify=True)).
+MATERIALIZE_MODES = ["auto", "reflink", "hardlink", "symlink", "copy"]
+DEFAULT_MATERIALIZE_MODE = "auto"
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        name TEXT NOT NULL PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    ) WITHOUT ROWID
+"""
+
+# ioctl to clone a file (linux/fs.h)
+_FICLONE = 0x40049409
+
+_local = threading.local()
+
+########################################
+
+def open_pool(pool_root=None, max_size=None):
+    """Get the package pool (connections are cached per thread).
+
+    max_size is in bytes, or a size with a unit ('20G', see utils.parse_size).
+    """
+    if pool_root is None:
+        pool_root = POOL_ROOT
+    if max_size is None:
+        max_size = POOL_MAX_SIZE
+    max_size = libmailcd.utils.parse_size(max_size)
+
+    pools = getattr(_local, "pools", None)
+    if pools is None:
+        pools = _local.pools = {}
+
+    key = (str(pool_root), max_size)
+    if key not in pools:
+        pools[key] = PackagePool(pool_root, max_size)
+
+    return pools[key]
+
+def materialize(storage_id, package_hash, target_path, include=None, mode=None, verify=False, max_size=None):
+    """Fill target_path with a package from the pool (extracting it into the pool first if needed)
+    """
+    open_pool(max_size=max_size).materialize(storage_id, package_hash, target_path, include=include, mode=mode, verify=verify)
+
+class PackagePool():
+    """Packages extracted once per machine, keyed by package hash (and include
+     globs, see storage.download), then linked into every inbox that needs them.
+    """
+
+    def __init__(self, pool_root, max_size):
+        self.root = Path(pool_root)
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+        self._conn = sqlite3.connect(str(Path(self.root, POOL_INDEX_FILENAME)), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+
+    ########################################
+
+    def get(self, storage_id, package_hash, include=None, verify=False):
+        """Get the path of the extracted package, extracting it if it's not in the pool yet.
+
+        If verify, an already extracted package's contents are checked first
+         (reads everything), and it's extracted again if they changed.
+        """
+        name = _get_entry_name(package_hash, include)
+        entry_path = Path(self.root, name)
+
+        if verify and entry_path.exists() and not _is_intact(entry_path, package_hash, include):
+            logging.info(f"pool: {name} was changed, extracting it again")
+            self._remove_entry(name)
+
+        size = None
+        if not entry_path.exists():
+            size = self._extract(storage_id, package_hash, include, entry_path)
+
+        with self._conn:
+            row = self._conn.execute("SELECT size FROM entries WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                if size is None:
+                    # Extracted, but not in the index (the index was removed?)
+                    size = _get_directory_size(entry_path)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (name, size, last_used) VALUES (?, ?, ?)",
+                    (name, size, time.time())
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE entries SET last_used = ? WHERE name = ?",
+                    (time.time(), name)
+                )
+
+        self.evict(keep=[name])
+
+        return entry_path
+
+    def _extract(self, storage_id, package_hash, include, entry_path):
+        # Extract next to where it goes, and move it into place when complete,
+        #  so nobody ever links from a half extracted package
+        temp_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.root))
+        try:
+            libmailcd.storage.download(storage_id, package_hash, temp_path, include=include)
+            size = _get_directory_size(temp_path)
+            _make_read_only(temp_path)
+
+            try:
+                os.rename(temp_path, entry_path)
+            except OSError as e:
+                # Someone else got there first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if temp_path.exists():
+                _remove_tree(temp_path)
+
+        return size
+
+    ########################################
+
+    def materialize(self, storage_id, package_hash, target_path, include=None, mode=None, verify=False):
+        if mode is None:
+            mode = DEFAULT_MATERIALIZE_MODE
+        if mode not in MATERIALIZE_MODES:
+            raise ValueError(f"Unknown materialize mode: {mode}")
+
+        entry_path = self.get(storage_id, package_hash, include, verify=verify)
+        target_path = Path(target_path)
+
+        _remove_target(target_path)
+        os.makedirs(target_path.parent, exist_ok=True)
+
+        if mode == "symlink":
+            os.symlink(entry_path, target_path, target_is_directory=True)
+            return
+
+        link = _get_link_function(mode)
+        for root, dirs, files in os.walk(entry_path):
+            relroot = os.path.relpath(root, entry_path)
+            target_root = Path(target_path, relroot)
+            os.makedirs(target_root, exist_ok=True)
+            for filename in files:
+                link = link(os.path.join(root, filename), Path(target_root, filename))
+
+        logging.debug(f"pool: {package_hash} -> {target_path} ({mode})")
+
+    def evict(self, keep=()):
+        """Remove least recently used packages until the pool is under its maximum size.
+        """
+        rows = self._conn.execute("SELECT name, size FROM entries ORDER BY last_used").fetchall()
+        total = sum(size for _, size in rows)
+
+        for name, size in rows:
+            if total <= self.max_size:
+                break
+            if name in keep:
+                continue
+
+            logging.debug(f"pool: evicting {name}")
+            self._remove_entry(name)
+            total -= size
+
+    def clear(self):
+        for name, in self._conn.execute("SELECT name FROM entries").fetchall():
+            entry_path = Path(self.root, name)
+            if entry_path.exists():
+                _remove_tree(entry_path)
+        with self._conn:
+            self._conn.execute("DELETE FROM entries")
+
+    def _remove_entry(self, name):
+        entry_path = Path(self.root, name)
+        if entry_path.exists():
+            _remove_tree(entry_path)
+        with self._conn:
+            self._conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+########################################
+
+def _get_entry_name(package_hash, include):
+    if not include:
+        return package_hash
+
+    include_hash = hashlib.blake2b("\n".join(sorted(include)).encode(), digest_size=8).hexdigest()
+    return f"{package_hash}.{include_hash}"
+
+def _get_link_function(mode):
+    """Get a function(src, dst) that materializes a file, it returns the function to
+     use for the next file (so 'auto' only finds out once what works here).
+    """
+    def reflink(src, dst):
+        _reflink(src, dst)
+        return reflink
+
+    def hardlink(src, dst):
+        os.link(src, dst)
+        return hardlink
+
+    def copy(src, dst):
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+        os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+        return copy
+
+    def auto(src, dst):
+        # Never a hardlink, the inbox has to be safe to modify (see MATERIALIZE_MODES)
+        try:
+            return reflink(src, dst)
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+        return copy(src, dst)
+
+    return {
+        "auto": auto,
+        "reflink": reflink,
+        "hardlink": hardlink,
+        "copy": copy
+    }[mode]
+
+def _is_intact(entry_path, package_hash, include):
+    scheme = libmailcd.hashing.get_scheme_for_id(package_hash)
+    if not scheme.is_verifiable:
+        # Nothing to check it against, extract it again to be sure
+        return False
+    return libmailcd.stamp.verify_contents(entry_path, package_hash, include)
+
+def _reflink(src, dst):
+    # TODO(matthew): macOS has clonefile() (APFS), but only by path and not through os
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, f"Can't reflink here: {dst}")
+
+    with open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, _FICLONE, fsrc.fileno())
+        finally:
+            os.close(fd)
+    shutil.copymode(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+
+def _make_read_only(path):
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            os.chmod(filepath, os.stat(filepath).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def _remove_tree(path):
+    def on_error(func, p, exc_info):
+        os.chmod(p, stat.S_IWUSR | stat.S_IRUSR | stat.S_IXUSR)
+        func(p)
+    shutil.rmtree(path, onerror=on_error)
+
+def _remove_target(target_path):
+    if target_path.is_symlink() or target_path.is_file():
+        target_path.unlink()
+    elif target_path.exists():
+        _remove_tree(target_path)
+
+def _get_directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import posixpath
+import zipfile
+
+import libmailcd.hashing
+
+########################################
+
+# Written next to a package's archive (so it's never mistaken for the package itself)
+SIDECAR_FILENAME = ".manifest"
+# 2: version 1 could leave out directories only holding directories (rebuilt when read)
+SIDECAR_VERSION = 2
+
+########################################
+
+class SidecarEntry():
+    def __init__(self, path, size, digest=None, header_offset=None, compress_size=None, compress_type=None, crc=None):
+        self.path = path # normalized path (relative to the package root)
+        self.size = size
+        self.digest = digest # content digest (in the package's hash scheme), None if unknown
+
+        # Where the member is in the zip (None for packages that aren't zips)
+        self.header_offset = header_offset
+        self.compress_size = compress_size
+        self.compress_type = compress_type
+        self.crc = crc
+
+    @property
+    def name(self):
+        return posixpath.basename(self.path)
+
+    def _to_row(self):
+        return [
+            self.name,
+            self.size,
+            self.digest.hex() if self.digest else None,
+            self.header_offset,
+            self.compress_size,
+            self.compress_type,
+            self.crc
+        ]
+
+    @classmethod
+    def _from_row(cls, dirpath, row):
+        name, size, digest, header_offset, compress_size, compress_type, crc = row
+        return cls(
+            posixpath.join(dirpath, name),
+            size,
+            bytes.fromhex(digest) if digest else None,
+            header_offset,
+            compress_size,
+            compress_type,
+            crc
+        )
+
+########################################
+
+def save(filepath, scheme, entries, dirs=()):
+    """Write a sidecar manifest of a package's files (entries) and directories.
+
+    Format: a json header line, then a block of lines per directory (one for
+     every sub-directory, then one for every file, sorted). The header has the
+     offset of every directory's block, so listing a directory only reads that
+     block, however many files the package has.
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
+
+    children = { "": [] }
+    def add_directory(dirpath):
+        # Every missing directory (up to the first one that exists) has to be
+        #  added to its parent's block, top down so the parent is there
+        missing = []
+        while dirpath not in children:
+            missing.append(dirpath)
+            dirpath = posixpath.dirname(dirpath)
+
+        for dirpath in reversed(missing):
+            children[dirpath] = []
+            children[posixpath.dirname(dirpath)].append([posixpath.basename(dirpath) + '/'])
+
+    for dirpath in dirs:
+        add_directory(dirpath)
+
+    count = 0
+    size = 0
+    for entry in entries:
+        dirpath = posixpath.dirname(entry.path)
+        add_directory(dirpath)
+        children[dirpath].append(entry._to_row())
+        count += 1
+        size += entry.size
+
+    blocks = []
+    index = {}
+    offset = 0
+    for dirpath in sorted(children):
+        rows = sorted(children[dirpath], key=lambda row: (len(row) > 1, row[0]))
+        block = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+        index[dirpath] = [offset, len(block), len(rows)]
+        blocks.append(block)
+        offset += len(block)
+
+    header = {
+        "version": SIDECAR_VERSION,
+        "scheme": scheme.name,
+        "files": count,
+        "size": size,
+        "dirs": index
+    }
+
+    # Write to a temp file and move it into place, readers never see half a sidecar
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(filepath)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+            for block in blocks:
+                f.write(block)
+        os.replace(temp_path, filepath)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def from_zip(filepath, manifest=None):
+    """Get the sidecar entries (and directories) of a zip.
+
+    Digests come from manifest (of the zip's contents), if given.
+    """
+    digests = {}
+    if manifest:
+        digests = { libmailcd.hashing.normalize_path(entry.path): entry.digest for entry in manifest.entries }
+
+    entries = []
+    dirs = []
+    with zipfile.ZipFile(filepath) as zfile:
+        for info in zfile.infolist():
+            path = libmailcd.hashing.normalize_path(info.filename)
+            if not path:
+                continue
+
+            if info.is_dir():
+                dirs.append(path)
+                continue
+
+            entries.append(SidecarEntry(
+                path,
+                info.file_size,
+                digests.get(path),
+                info.header_offset,
+                info.compress_size,
+                info.compress_type,
+                info.CRC
+            ))
+
+    return entries, dirs
+
+def from_chunk_manifest(chunk_manifest):
+    entries = [SidecarEntry(f["path"], f["size"], bytes.fromhex(f["digest"])) for f in chunk_manifest["files"]]
+    return entries, chunk_manifest["dirs"]
+
+########################################
+
+class Sidecar():
+    """Reads a sidecar manifest (see save())
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            header_line = f.readline()
+        self._header = json.loads(header_line)
+        self._data_offset = len(header_line)
+
+        if self._header.get("version") != SIDECAR_VERSION:
+            raise ValueError(f"Unsupported sidecar version: {self._header.get('version')}")
+
+    @property
+    def scheme(self):
+        return libmailcd.hashing.get_scheme(self._header["scheme"])
+
+    @property
+    def count(self):
+        return self._header["files"]
+
+    @property
+    def size(self):
+        return self._header["size"]
+
+    def is_directory(self, dirpath):
+        return libmailcd.hashing.normalize_path(dirpath) in self._header["dirs"]
+
+    def get_directories(self):
+        return sorted(self._header["dirs"])
+
+    def ls(self, dirpath="", offset=0, limit=None):
+        """Get the sub-directories (as 'name/' strings) and files (as SidecarEntry) of a directory.
+
+        offset/limit page through the directory's children (directories first, then files).
+        """
+        dirpath = libmailcd.hashing.normalize_path(dirpath or "")
+        if dirpath not in self._header["dirs"]:
+            raise FileNotFoundError(f"No such directory in package: {dirpath}")
+
+        children = []
+        for i, row in enumerate(self._read_block(dirpath)):
+            if i < offset:
+                continue
+            if limit is not None and len(children) >= limit:
+                break
+            children.append(self._parse_row(dirpath, row))
+        return children
+
+    def get_file(self, path):
+        path = libmailcd.hashing.normalize_path(path)
+        dirpath = posixpath.dirname(path)
+        if dirpath not in self._header["dirs"]:
+            return None
+
+        for row in self._read_block(dirpath):
+            if len(row) > 1 and row[0] == posixpath.basename(path):
+                return SidecarEntry._from_row(dirpath, row)
+        return None
+
+    def iter_files(self, dirpath=""):
+        """Yield every file (SidecarEntry) under a directory (recursively)
+        """
+        dirpath = libmailcd.hashing.normalize_path(dirpath or "")
+        prefix = dirpath + '/' if dirpath else ""
+        for subdirpath in self.get_directories():
+            if subdirpath != dirpath and not subdirpath.startswith(prefix):
+                continue
+            for row in self._read_block(subdirpath):
+                if len(row) > 1:
+                    yield SidecarEntry._from_row(subdirpath, row)
+
+    def _read_block(self, dirpath):
+        offset, length, _ = self._header["dirs"][dirpath]
+        with open(self.filepath, 'rb') as f:
+            f.seek(self._data_offset + offset)
+            block = f.read(length)
+        for line in block.splitlines():
+            yield json.loads(line)
+
+    def _parse_row(self, dirpath, row):
+        if len(row) == 1:
+            return row[0]
+        return SidecarEntry._from_row(dirpath, row)
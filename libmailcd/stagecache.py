@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+
+import pygit2
+
+import libmailcd.errors
+import libmailcd.hashcache
+import libmailcd.hashing
+import libmailcd.ingest
+import libmailcd.manifest
+import libmailcd.storage
+import libmailcd.utils
+from libmailcd.constants import LOCAL_MB_ROOT
+
+########################################
+
+# A stage's results (its outbox and logs) are cached under a digest of what it
+#  declares it's made from: its node (containerfile), steps, outbox rules, the
+#  environment (inbox package paths have their storage id and hash in them), the
+#  keys of the stages it depends on, and its workspace inputs: the files matching
+#  'cache: { inputs: [globs] }', or the files tracked by git if it has none. A
+#  stage with the same digest as a cached one isn't run, its results are
+#  restored instead.
+#
+# Every key is worked out before any stage runs, so files stages write into the
+#  workspace (now, or left over from an earlier build) never change them. Paths
+#  under the workspace count relative to it, so the same stage has the same
+#  digest in any checkout (on any machine sharing the cache).
+#
+# Caching is opt-in: a stage is cached when it asks to be ('cache: true' or
+#  'cache: { ... }'), or when it's turned on for every stage (mb build
+#  --stage-cache) and it doesn't opt out ('cache: false'). Only stages with an
+#  outbox (otherwise there's nothing to restore), and only if every stage they
+#  depend on is cached too. Stages with side effects, or other inputs (network,
+#  a changed base image), shouldn't be.
+#
+# 2: paths under the workspace are relative to it (were absolute)
+# 3: declared inputs only, dependencies by key (was the whole workspace, and the
+#  dependencies' outboxes)
+STAGE_CACHE_VERSION = 3
+
+# Default backend: packages in the store, found by label
+STAGE_CACHE_STORAGE_ID = "MB-STAGE-CACHE"
+STAGE_CACHE_LABEL_PREFIX = "stage-cache-"
+
+# Workspace directories that never count as stage inputs
+IGNORED_DIRNAMES = [LOCAL_MB_ROOT, ".git"]
+
+# Layout of a cache entry
+ENTRY_DIRNAME = "stage"
+ENTRY_OUTBOX_DIRNAME = "outbox"
+ENTRY_LOG_FILENAME = "build.log"
+ENTRY_ENV_LOG_FILENAME = "env.log"
+
+########################################
+
+def open_cache(location=None):
+    """Get a stage cache: a directory (can be shared, e.g. a mounted network path)
+    if location is given, the package store if not.
+    """
+    if location:
+        return DirectoryStageCache(location)
+    return StoreStageCache()
+
+def is_cacheable(stage, all_stages=False):
+    """Whether a stage asks to be cached (or all_stages are and it doesn't opt out)
+    """
+    if not stage.get('outbox'):
+        return False
+
+    cache_config = stage.get('cache')
+    if cache_config is None:
+        return all_stages
+    return cache_config is not False
+
+def get_keys(workspace, stages, graph, env, all_stages=False):
+    """Get the key of every stage (see get_key), None for stages that aren't
+    cached. Run before any stage does.
+
+    graph is the stages' libmailcd.stagegraph.StageGraph.
+    """
+    keys = {}
+    tracked = None
+    for stage_name in graph.order():
+        stage = stages[stage_name]
+        dependency_keys = [keys[dependency] for dependency in sorted(graph.get_dependencies(stage_name))]
+        if not is_cacheable(stage, all_stages) or None in dependency_keys:
+            keys[stage_name] = None
+            continue
+
+        inputs = _get_inputs(stage)
+        if not inputs and tracked is None:
+            tracked = get_tracked_files(workspace) or []
+            if not tracked:
+                logging.info(f"stage cache: no files tracked by git in the workspace, only stages with 'cache: {{ inputs: [...] }}' are cached")
+
+        if not inputs and not tracked:
+            keys[stage_name] = None
+            continue
+
+        keys[stage_name] = get_key(workspace, stage, stage_name, env, dependency_keys, relpaths=None if inputs else tracked)
+        logging.debug(f"stage cache: {stage_name} -> {keys[stage_name][:12]}")
+
+    return keys
+
+def get_key(workspace, stage, stage_name, env, dependency_keys, relpaths=None):
+    """Digest of everything a stage's results depend on (see STAGE_CACHE_VERSION)
+
+    relpaths are the workspace files that count (normalized, relative to the
+     workspace), if the stage has no cache inputs.
+    """
+    node = stage.get('node') or {}
+    containerfile_digest = None
+    if isinstance(node, dict) and node.get('containerfile'):
+        containerfile = str(node['containerfile']).rpartition(':')[2]
+        containerfile_digest = libmailcd.utils.hash_file(Path(workspace, containerfile))
+
+    key = {
+        "version": STAGE_CACHE_VERSION,
+        "stage": stage_name,
+        "node": node,
+        "containerfile": containerfile_digest,
+        "steps": stage.get('steps') or [],
+        "outbox": stage.get('outbox'),
+        "env": sorted((name, _get_relative_value(value, workspace)) for name, value in (env or {}).items()),
+        "dependencies": list(dependency_keys),
+        "workspace": get_workspace_digest(workspace, _get_inputs(stage), relpaths)
+    }
+
+    data = json.dumps(key, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+def get_workspace_digest(workspace, inputs=None, relpaths=None):
+    """Content digest of the workspace's files: the ones matching the inputs globs
+    (without the .mb directory), or relpaths. Unchanged files aren't read again
+    (see libmailcd.hashcache).
+    """
+    if relpaths is None:
+        relpaths = _find_files(workspace, inputs)
+
+    scheme = libmailcd.hashing.get_scheme()
+    entries = []
+    scan = libmailcd.hashcache.open_cache().scan(workspace, scheme.cache_kind_file)
+    try:
+        for relpath in sorted(relpaths):
+            filepath = os.path.join(workspace, relpath)
+            # Tracked, but deleted (or not a file, e.g. a submodule)
+            if not os.path.isfile(filepath):
+                continue
+
+            st = os.stat(filepath)
+            digest = scan.lookup(filepath, st)
+            if digest is None:
+                digest = libmailcd.manifest.digest_file(filepath, scheme)
+                scan.store(filepath, digest, st)
+            entries.append(libmailcd.manifest.ManifestEntry(relpath, st.st_size, digest))
+    finally:
+        # Not every file under the workspace was looked at, keep the others' entries
+        scan.close(evict=False)
+
+    return libmailcd.manifest.Manifest(scheme, entries).get_id()
+
+def get_tracked_files(workspace):
+    """Get the files under the workspace tracked by git (relative to the
+    workspace), None if it isn't in a git repository.
+    """
+    # git has the real path of the repository (no symlinks)
+    workspace = os.path.realpath(workspace)
+    repository_path = pygit2.discover_repository(workspace)
+    if repository_path is None:
+        return None
+
+    repository = pygit2.Repository(repository_path)
+    if repository.workdir is None:
+        return None
+
+    workdir = os.path.realpath(repository.workdir)
+    relpaths = []
+    for entry in repository.index:
+        relpath = _get_relative_value(os.path.join(workdir, entry.path), workspace)
+        if not os.path.isabs(relpath) and not _is_ignored(relpath):
+            relpaths.append(relpath)
+    return relpaths
+
+def _get_inputs(stage):
+    cache_config = stage.get('cache')
+    return cache_config.get('inputs') if isinstance(cache_config, dict) else None
+
+def _find_files(workspace, inputs):
+    relpaths = []
+    for root, dirs, files in os.walk(workspace):
+        dirs[:] = sorted(dirname for dirname in dirs if dirname not in IGNORED_DIRNAMES)
+        for filename in files:
+            relpath = libmailcd.hashing.normalize_path(os.path.relpath(os.path.join(root, filename), workspace))
+            if not inputs or libmailcd.utils.match_globs(relpath, inputs):
+                relpaths.append(relpath)
+    return relpaths
+
+def _is_ignored(relpath):
+    return relpath.split('/', 1)[0] in IGNORED_DIRNAMES
+
+def _get_relative_value(value, workspace):
+    # A path under the workspace relative to it, anything else as is
+    value = str(value)
+    if not os.path.isabs(value):
+        return value
+
+    try:
+        relpath = os.path.relpath(value, os.path.abspath(workspace))
+    except ValueError:
+        # Windows: on another drive
+        return value
+
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        return value
+    return libmailcd.hashing.normalize_path(relpath)
+
+########################################
+
+class StageCache():
+    """Where stage results are kept, by key (see get_key)
+    """
+
+    def restore(self, key, outbox_path, logpath, envlogpath):
+        """Put a stage's cached results in place, returns False if there are none
+        """
+        os.makedirs(Path(outbox_path).parent, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix=".stage-cache-", dir=Path(outbox_path).parent) as temp_path:
+            entry_path = Path(temp_path, ENTRY_DIRNAME)
+            if not self._get(key, entry_path):
+                return False
+
+            if Path(outbox_path).exists():
+                shutil.rmtree(outbox_path)
+            entry_outbox_path = Path(entry_path, ENTRY_OUTBOX_DIRNAME)
+            if entry_outbox_path.exists():
+                os.replace(entry_outbox_path, outbox_path)
+            else:
+                os.makedirs(outbox_path)
+
+            for filename, target in [(ENTRY_LOG_FILENAME, logpath), (ENTRY_ENV_LOG_FILENAME, envlogpath)]:
+                if Path(entry_path, filename).exists():
+                    shutil.copyfile(Path(entry_path, filename), target)
+
+        return True
+
+    def save(self, key, outbox_path, logpath, envlogpath):
+        """Keep a stage's results
+        """
+        os.makedirs(Path(outbox_path).parent, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix=".stage-cache-", dir=Path(outbox_path).parent) as temp_path:
+            entry_path = Path(temp_path, ENTRY_DIRNAME)
+            os.makedirs(entry_path)
+            if Path(outbox_path).exists():
+                shutil.copytree(outbox_path, Path(entry_path, ENTRY_OUTBOX_DIRNAME))
+            for filename, source in [(ENTRY_LOG_FILENAME, logpath), (ENTRY_ENV_LOG_FILENAME, envlogpath)]:
+                if Path(source).exists():
+                    shutil.copyfile(source, Path(entry_path, filename))
+
+            self._put(key, entry_path)
+
+    def _get(self, key, entry_path):
+        raise NotImplementedError
+
+    def _put(self, key, entry_path):
+        raise NotImplementedError
+
+class StoreStageCache(StageCache):
+    """Stage results stored as packages (deduplicated like any other), labelled with their key
+    """
+
+    def __init__(self, storage_id=None):
+        self.storage_id = storage_id or STAGE_CACHE_STORAGE_ID
+
+    def _get(self, key, entry_path):
+        try:
+            matches = libmailcd.storage.find(self.storage_id, [STAGE_CACHE_LABEL_PREFIX + key])
+        except libmailcd.errors.StorageIdNotFoundError:
+            return False
+
+        if not matches:
+            return False
+
+        libmailcd.storage.download(self.storage_id, matches[0], entry_path)
+        return True
+
+    def _put(self, key, entry_path):
+        package_hash = libmailcd.storage.add(self.storage_id, Path(entry_path))
+        libmailcd.storage.add_label(self.storage_id, package_hash, STAGE_CACHE_LABEL_PREFIX + key)
+
+class DirectoryStageCache(StageCache):
+    """Stage results as zips in a directory ('<root>/ab/<key>.zip'), written under a
+     temp name and renamed into place, so it can be shared by many machines.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _get_entry_path(self, key):
+        return Path(self.root, key[:2], f"{key}.zip")
+
+    def _get(self, key, entry_path):
+        zip_path = self._get_entry_path(key)
+        if not zip_path.exists():
+            return False
+
+        libmailcd.utils.zip_extract(zip_path, entry_path)
+        return True
+
+    def _put(self, key, entry_path):
+        zip_path = self._get_entry_path(key)
+        os.makedirs(zip_path.parent, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".zip", dir=zip_path.parent)
+        os.close(fd)
+        try:
+            libmailcd.ingest.archive_directory(entry_path, temp_path)
+            os.replace(temp_path, zip_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logging.debug(f"stage cache: {key} -> {zip_path}")
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+import libmailcd.errors
+
+########################################
+
+class StageGraph():
+    """Which pipeline stages depend on which: a stage depends on every stage that
+     has one of its inbox slots in its outbox.
+
+    Everything is worked out iteratively (no recursion), in O(stages + dependencies),
+     stages keep their pipeline order wherever the dependencies allow.
+    """
+
+    def __init__(self, stages, dependencies):
+        self.stages = list(stages)
+        self._dependencies = { stage: set() for stage in self.stages }
+        self._dependents = { stage: [] for stage in self.stages }
+
+        for stage in self.stages:
+            for dependency in dependencies.get(stage, ()):
+                if dependency == stage or dependency in self._dependencies[stage]:
+                    continue
+                self._dependencies[stage].add(dependency)
+                self._dependents[dependency].append(stage)
+
+    @classmethod
+    def from_stages(cls, stages):
+        """Build the graph of a pipeline's stages ({name: stage dict})
+        """
+        # Slot -> the stages that make it
+        producers = {}
+        for stage in stages:
+            for slot in stages[stage].get('outbox') or ():
+                producers.setdefault(slot, []).append(stage)
+
+        dependencies = {}
+        for stage in stages:
+            dependencies[stage] = [
+                producer
+                for slot in stages[stage].get('inbox') or ()
+                for producer in producers.get(slot, ())
+            ]
+
+        return cls(stages, dependencies)
+
+    ########################################
+
+    def get_dependencies(self, stage):
+        return self._dependencies[stage]
+
+    def get_dependents(self, stage):
+        return self._dependents[stage]
+
+    def order(self):
+        """Get the stages in an order they can run in, one at a time (Kahn's algorithm).
+
+        Raises StageCycleError if some stages depend on each other.
+        """
+        in_degree = { stage: len(self._dependencies[stage]) for stage in self.stages }
+        ready = deque(stage for stage in self.stages if in_degree[stage] == 0)
+
+        ordered = []
+        while ready:
+            stage = ready.popleft()
+            ordered.append(stage)
+            for dependent in self._dependents[stage]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(ordered) != len(self.stages):
+            raise libmailcd.errors.StageCycleError(self._find_cycle(in_degree))
+
+        return ordered
+
+    def levels(self):
+        """Get the stages grouped by how deep they are in the graph: the first level
+        depends on nothing, every other one on at least one stage of the level before.
+        """
+        depth = {}
+        levels = []
+        for stage in self.order():
+            depth[stage] = max((depth[dependency] + 1 for dependency in self._dependencies[stage]), default=0)
+            if depth[stage] == len(levels):
+                levels.append([])
+            levels[depth[stage]].append(stage)
+        return levels
+
+    def level_widths(self):
+        return [len(level) for level in self.levels()]
+
+    @property
+    def max_parallelism(self):
+        """Most stages that can run at the same time (when they all take as long),
+        more jobs than this never help.
+        """
+        return max(self.level_widths(), default=0)
+
+    def critical_path(self, durations=None):
+        """Get the longest chain of stages (each waiting on the one before), which
+        no number of jobs can make the pipeline faster than.
+
+        durations ({stage: seconds}) default to 1 per stage. Returns (stages, total duration).
+        """
+        length, following = self._get_remaining(durations)
+        if not length:
+            return [], 0
+
+        stage = max(self.stages, key=lambda stage: length[stage])
+        total = length[stage]
+
+        path = []
+        while stage is not None:
+            path.append(stage)
+            stage = following[stage]
+        return path, total
+
+    def get_priorities(self, durations=None):
+        """Get how long the longest chain starting at each stage takes ({stage: duration}),
+        starting the stages with the most left after them first keeps the critical
+        path going.
+        """
+        length, _ = self._get_remaining(durations)
+        return length
+
+    ########################################
+
+    def _get_remaining(self, durations):
+        length = {}
+        following = {}
+        for stage in reversed(self.order()):
+            duration = 1 if durations is None else durations.get(stage, 1)
+            following[stage] = max(self._dependents[stage], key=lambda dependent: length[dependent], default=None)
+            length[stage] = duration + (length[following[stage]] if following[stage] is not None else 0)
+        return length, following
+
+    def _find_cycle(self, in_degree):
+        # Every stage left over is on a cycle or waits on one, walking back
+        #  through dependencies that are left over must come back around
+        left = set(stage for stage in self.stages if in_degree[stage] > 0)
+        stage = next(stage for stage in self.stages if stage in left)
+
+        seen = {}
+        path = []
+        while stage not in seen:
+            seen[stage] = len(path)
+            path.append(stage)
+            stage = next(dependency for dependency in sorted(self._dependencies[stage]) if dependency in left)
+
+        return path[seen[stage]:] + [stage]
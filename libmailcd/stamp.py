@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+from pathlib import Path
+
+import libmailcd.hashing
+import libmailcd.manifest
+import libmailcd.storage
+import libmailcd.utils
+
+########################################
+
+# Stamps record what a directory was filled with (a package, see libmailcd.pool),
+#  and what its files looked like (stat) right after, so it can be reused as
+#  long as nothing changed.
+STAMP_VERSION = 1
+
+########################################
+
+def write(stamp_path, target_path, package_hash, include=None):
+    stamp = {
+        "version": STAMP_VERSION,
+        "package_hash": package_hash,
+        "include": sorted(include) if include else None
+    }
+
+    target_path = Path(target_path)
+    if target_path.is_symlink():
+        stamp["symlink"] = os.readlink(target_path)
+    else:
+        stamp["dirs"], stamp["files"] = _scan(target_path)
+
+    os.makedirs(Path(stamp_path).parent, exist_ok=True)
+    temp_path = Path(f"{stamp_path}.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(stamp, f, separators=(",", ":"))
+    os.replace(temp_path, stamp_path)
+
+def remove(stamp_path):
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+
+def is_valid(stamp_path, target_path, package_hash, include=None, verify=False):
+    """If target_path still holds exactly what the stamp says it was filled with.
+
+    Only compares stats (sizes and mtimes), unless verify, then every file's
+     contents are checked against the package too.
+    """
+    if not os.path.exists(stamp_path):
+        return False
+
+    try:
+        with open(stamp_path, 'r') as f:
+            stamp = json.load(f)
+    except ValueError:
+        return False
+
+    if stamp.get("version") != STAMP_VERSION \
+            or stamp.get("package_hash") != package_hash \
+            or stamp.get("include") != (sorted(include) if include else None):
+        return False
+
+    target_path = Path(target_path)
+    if "symlink" in stamp:
+        if not target_path.is_symlink() or os.readlink(target_path) != stamp["symlink"]:
+            return False
+    else:
+        if target_path.is_symlink() or not target_path.is_dir():
+            return False
+        if list(_scan(target_path)) != [stamp["dirs"], stamp["files"]]:
+            return False
+
+    if verify:
+        return verify_contents(target_path, package_hash, include)
+
+    return True
+
+def verify_contents(target_path, package_hash, include=None):
+    """Check every file's contents (reads everything) against the package
+    """
+    scheme = libmailcd.hashing.get_scheme_for_id(package_hash)
+    if not scheme.is_verifiable:
+        # Nothing to check against, stats will have to do
+        return True
+
+    if not include:
+        return libmailcd.utils.hash_directory(target_path, scheme, use_cache=False) == package_hash
+
+    # Only some of the files, check them one by one against the package's tree
+    tree = libmailcd.storage.get_tree(package_hash)
+    if tree is None:
+        return False
+
+    manifest = libmailcd.manifest.from_directory(target_path, scheme, use_cache=False)
+    files = {}
+    for entry in manifest.entries:
+        files[entry.path] = (entry.size, entry.digest)
+
+    expected = [path for path in tree.get_files() if libmailcd.utils.match_globs(path, include)]
+    if sorted(files) != expected:
+        return False
+
+    return all(tree.get_file(path) == files[path] for path in expected)
+
+def _scan(target_path):
+    dirs = []
+    files = {}
+    for root, subdirs, filenames in os.walk(target_path):
+        subdirs.sort()
+        for dirname in subdirs:
+            dirs.append(libmailcd.hashing.normalize_path(os.path.relpath(os.path.join(root, dirname), target_path)))
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            st = os.lstat(filepath)
+            relpath = libmailcd.hashing.normalize_path(os.path.relpath(filepath, target_path))
+            files[relpath] = [st.st_size, st.st_mtime_ns]
+    return dirs, files
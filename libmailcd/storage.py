@@ -2,11 +2,29 @@
 
 import sys
 import os
+import json
+import zlib
+import errno
+import posixpath
+import contextlib
 from pathlib import Path, PurePath
 import yaml
 import shutil
 import logging
-
+import itertools
+import tempfile
+import tarfile
+import zipfile
+
+import libmailcd.catalog
+import libmailcd.chunkstore
+import libmailcd.extract
+import libmailcd.filelock
+import libmailcd.hashing
+import libmailcd.ingest
+import libmailcd.manifest
+import libmailcd.merkle
+import libmailcd.sidecar
 import libmailcd.utils
 import libmailcd.errors
 
@@ -15,7 +33,58 @@ import libmailcd.errors
 # TODO(Matthew): Where should the base for STORAGE_ROOT be stored? I think it should be passed in.
 #  Maybe like a api init?  So people can overwrite it?
 STORAGE_ROOT = str(Path(Path.home(), ".mailcd", "storage"))
-STORAGE_DB_FILENAME = "db.yml"
+
+# Chunks shared by every package stored with the chunked backend
+STORAGE_CHUNKS_DIRNAME = ".chunks"
+
+# Packages are written under a temp name in their storage ID, then renamed into place
+STORAGE_TEMP_PREFIX = ".tmp-"
+
+# A stored package that can't be read (corrupt or cut short zip, missing or
+#  corrupt chunks), verify() reports these as a problem of the package
+_UNREADABLE_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, OSError, json.JSONDecodeError, KeyError)
+
+# Bad packages are moved here (see quarantine)
+STORAGE_QUARANTINE_DIRNAME = ".quarantine"
+
+# Locked (shared) while adding packages, (exclusive) while removing or moving them
+STORAGE_LOCK_FILENAME = ".lock"
+
+# How packages are stored: a zip per package, or deduplicated chunks (see libmailcd.chunkstore)
+STORAGE_BACKEND_ZIP = "zip"
+STORAGE_BACKEND_CHUNKED = "chunked"
+STORAGE_BACKENDS = [STORAGE_BACKEND_ZIP, STORAGE_BACKEND_CHUNKED]
+
+# Where package directories go in a storage ID: all in the storage ID's directory
+#  (flat), or fanned out by the first characters of their digest (sharded,
+#  'ab/cd/<package_hash>'), so no directory holds more than a few thousand
+#  entries, however many packages there are (see migrate_layout)
+STORAGE_LAYOUT_FLAT = "flat"
+STORAGE_LAYOUT_SHARDED = "sharded"
+STORAGE_LAYOUTS = [STORAGE_LAYOUT_FLAT, STORAGE_LAYOUT_SHARDED]
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+# Abbreviated package hashes are never shorter than this (like git)
+ABBREV_MIN_LENGTH = 7
+
+# Settings that can be set per storage ID (and their allowed values, a function
+#  that raises ValueError for bad values, or None for any)
+#
+# gc_max_size: packages are removed (least recently used first) until the storage
+#  ID is no bigger than this ('20G')
+# gc_keep_last: the last N packages added are never removed
+# gc_keep_labels: packages with any of these labels are never removed (comma separated)
+#
+# Without gc_max_size, gc removes every package gc_keep_last/gc_keep_labels don't
+#  keep (and nothing if neither is set either). See get_gc_candidates.
+STORAGE_SETTINGS = {
+    "backend": STORAGE_BACKENDS,
+    "layout": STORAGE_LAYOUTS,
+    "gc_max_size": libmailcd.utils.parse_size,
+    "gc_keep_last": int,
+    "gc_keep_labels": None
+}
 
 ########################################
 
@@ -28,52 +97,99 @@ def get(storage_id=None):
     """Get the list packages for a given storage ID, if nothing supplied, return the
     list of storage IDs.
     """
-    path = Path(STORAGE_ROOT)
+    catalog = _get_catalog()
 
-    if storage_id:
-        path = Path(path, storage_id)
+    if not storage_id:
+        return catalog.get_storage_ids()
 
-    try:
-        raw_files = os.listdir(path)
-    except FileNotFoundError:
-        if storage_id:
-            raise libmailcd.errors.StorageIdNotFoundError(storage_id)
-        raise
+    packages = catalog.get_packages(storage_id)
+    if not packages and not Path(STORAGE_ROOT, storage_id).exists():
+        raise libmailcd.errors.StorageIdNotFoundError(storage_id)
 
-    # Parse out any files that not package hashes
-    # TODO(matthew): This has to be done because of the database file, is there
-    #  a better spot we can put that file? Better way to filter it out?
-    files = []
-    for rf in raw_files:
-        should_get = True
-        if storage_id and not libmailcd.utils.is_hex(rf):
-            should_get = False
+    return packages
+
+def get_package_info(storage_id, package_hash):
+    """Get the catalog's record of a package (hash, size, added), None if it's not in the store
+    """
+    return _get_catalog().get_package(storage_id, package_hash)
 
-        if should_get:
-            files.append(rf)
+def add(storage_id, package, backend=None):
+    """Add a package (directory, zip, tarball) to the store, returns its package hash.
 
-    return files
+    The package hash only depends on the contents, so adding the same files as a
+     directory, zip or tarball only stores them once.
 
-def add(storage_id, package):
+    If no backend is given, the storage ID's 'backend' setting is used.
+
+    Safe to run from many processes at once: packages are written to a temp
+     directory and renamed into place when complete (see _publish).
+    """
+    if backend is None:
+        backend = get_setting(storage_id, "backend", STORAGE_BACKEND_ZIP)
+
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    with _lock_store(shared=True):
+        return _add(storage_id, package, backend)
+
+def _add(storage_id, package, backend):
     package_hash = None
 
-    # Directory vs Zip file
-    # TODO(matthew): This looks like it could be refactored for code re-use here
-    if os.path.isdir(package):
-        # calculate hash
-        package_hash = libmailcd.utils.hash_directory(package)
+    # Chunked vs Directory vs Tarball vs Zip file
+    if backend == STORAGE_BACKEND_CHUNKED:
+        # Chunks are only written if they're new, so there's nothing to gain
+        #  from checking if the package exists first
+        manifest, chunk_manifest = _get_chunk_store().add(package)
+        package_hash = manifest.get_id()
 
-        # lookup hash in store
-        ## return out if already exists
         if _exists(storage_id, package_hash):
-            logging.debug(f"{storage_id}: {package_hash} - Already exists")
-            return package_hash
-        # create space in store (cleanup on failure? thinking yes)
-        _create(storage_id, package_hash)
-
-        # if directory, zip up
-        # move zip to store (maybe do this with zip up step, so dont have to worry about where to temp put zip)
-        _archive(storage_id, package_hash, package)
+            return _add_existing(storage_id, package_hash)
+
+        with _create_temp(storage_id) as package_root:
+            _save_chunk_manifest(package_root, package, chunk_manifest)
+            _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_chunk_manifest(chunk_manifest))
+            _save_tree(package_hash, manifest)
+            if not _publish(storage_id, package_hash, package_root):
+                return _add_existing(storage_id, package_hash)
+    elif os.path.isdir(package):
+        # Skip zipping up content we already have, but only if we can tell
+        #  without reading the files (every file is in the hash cache), otherwise
+        #  it's just as cheap to hash while zipping up
+        package_hash = libmailcd.utils.hash_directory(package, cached_only=True)
+        if package_hash and _exists(storage_id, package_hash):
+            return _add_existing(storage_id, package_hash)
+
+        # calculate hash and zip up in the same pass, into a temp directory in the
+        #  store (so it can be moved into place once we know the hash)
+        with _create_temp(storage_id) as package_root:
+            archive_path = _get_archive_path(package_root, package)
+            manifest = libmailcd.ingest.archive_directory(package, archive_path)
+            package_hash = manifest.get_id()
+
+            # lookup hash in store
+            ## return out if already exists
+            if _exists(storage_id, package_hash):
+                return _add_existing(storage_id, package_hash)
+
+            _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_zip(archive_path, manifest))
+            _save_tree(package_hash, manifest)
+            if not _publish(storage_id, package_hash, package_root):
+                return _add_existing(storage_id, package_hash)
+    elif tarfile.is_tarfile(package) and not zipfile.is_zipfile(package):
+        # Tarballs are stored as zips (like everything else), convert while hashing
+        with _create_temp(storage_id) as package_root:
+            archive_path = _get_archive_path(package_root, _strip_archive_extension(package))
+            manifest = libmailcd.ingest.archive_tar(package, archive_path)
+            package_hash = manifest.get_id()
+
+            if _exists(storage_id, package_hash):
+                return _add_existing(storage_id, package_hash)
+
+            _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_zip(archive_path, manifest))
+            _save_tree(package_hash, manifest)
+            if not _publish(storage_id, package_hash, package_root):
+                return _add_existing(storage_id, package_hash)
     else:
         # calculate hash
         package_hash = libmailcd.utils.hash_file(package)
@@ -81,146 +197,387 @@ def add(storage_id, package):
         # lookup hash in store
         ## return out if already exists
         if _exists(storage_id, package_hash):
-            logging.debug(f"{storage_id}: {package_hash} - Already exists")
-            return package_hash
-        # create space in store (cleanup on failure? thinking yes)
-        _create(storage_id, package_hash)
+            return _add_existing(storage_id, package_hash)
 
-        _save(storage_id, package_hash, package)
+        with _create_temp(storage_id) as package_root:
+            archive_path = _save(package_root, package)
 
-    # TODO(matthew): What if it's some other compressed archive format?
+            # The hash probably came from the hash cache, only read the zip again
+            #  (for its tree and file digests) if it's new
+            if libmailcd.manifest.is_archive(package):
+                manifest = libmailcd.manifest.from_archive(package, libmailcd.hashing.get_scheme_for_id(package_hash))
+                _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_zip(archive_path, manifest))
+                _save_tree(package_hash, manifest)
+            if not _publish(storage_id, package_hash, package_root):
+                return _add_existing(storage_id, package_hash)
+
+    _get_catalog().add_package(storage_id, package_hash, _get_size(storage_id, package_hash))
 
     # Return the generated package_hash for reference
     return package_hash
 
-def download(storage_id, package_hash, target_path):
+def _add_existing(storage_id, package_hash):
+    logging.debug(f"{storage_id}: {package_hash} - Already exists")
+    _get_catalog().add_package(storage_id, package_hash, _get_size(storage_id, package_hash))
+    return package_hash
+
+def _strip_archive_extension(package):
+    name = os.path.basename(Path(package))
+    for extension in [".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".tar", ".zip"]:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+def download(storage_id, package_hash, target_path, include=None):
     """Download a specified package into the specified target path (probably cwd)
+
+    If include (a list of globs, see utils.match_globs) is given, only the files
+     that match are extracted, nothing else of the package is read.
     """
     # get file for package_hash
     package_path = _get_archive(storage_id, package_hash)
+    _get_catalog().touch_package(storage_id, package_hash)
 
     os.makedirs(target_path, exist_ok=True)
 
-    libmailcd.utils.zip_extract(package_path, target_path)
+    if _is_chunk_manifest(package_path):
+        chunk_manifest = libmailcd.chunkstore.load_manifest(package_path)
+        chunk_store = _get_chunk_store()
+        if include is None:
+            chunk_store.extract(chunk_manifest, target_path)
+        else:
+            for record in chunk_manifest["files"]:
+                if libmailcd.utils.match_globs(record["path"], include):
+                    chunk_store.extract_file(record, libmailcd.extract.get_target_filepath(target_path, record["path"]))
+    else:
+        sidecar = _get_sidecar(storage_id, package_hash)
+        if sidecar is None:
+            if include is not None:
+                raise ValueError(f"Can't include paths of a single file package: {storage_id}/{package_hash}")
+            libmailcd.utils.zip_extract(package_path, target_path)
+            return
+
+        if include is None:
+            entries = list(sidecar.iter_files())
+            dirs = sidecar.get_directories()
+        else:
+            entries = [entry for entry in sidecar.iter_files() if libmailcd.utils.match_globs(entry.path, include)]
+            dirs = []
+
+        stats = libmailcd.extract.extract_zip(package_path, entries, target_path, dirs=dirs)
+        logging.debug(f"extracted: {storage_id}/{package_hash} {stats}")
 
 ########################################
 
-def ls(storage_id, package_hash, relpath = None):
-    # get file for package_hash
-    filepath = _get_archive(storage_id, package_hash)
+def ls(storage_id, package_hash, relpath=None, offset=0, limit=None, recursive=False):
+    """List a directory of a package (the package root if no relpath), sub-directories
+    first, then files. If recursive, lists every file under the directory instead.
 
-    # ls file
-    return libmailcd.utils.zip_ls(filepath, relpath)
+    offset/limit page through the results. Served from the package's sidecar
+     manifest, the archive itself isn't opened.
+    """
+    sidecar = _get_sidecar(storage_id, package_hash)
+    _get_catalog().touch_package(storage_id, package_hash)
 
-########################################
+    # Single file package
+    if sidecar is None:
+        filepath = _get_archive(storage_id, package_hash)
+        return [{ "name": filepath.name, "size": filepath.stat().st_size }]
 
+    if recursive:
+        stop = offset + limit if limit is not None else None
+        entries = itertools.islice(sidecar.iter_files(relpath), offset, stop)
+        return [{ "name": entry.path, "size": entry.size } for entry in entries]
 
-def label(storage_id, package_hash, label):
-    labels = get_labels(storage_id, package_hash)
+    files = []
+    for child in sidecar.ls(relpath, offset, limit):
+        if isinstance(child, str):
+            files.append({ "name": child, "size": 0 })
+        else:
+            files.append({ "name": child.name, "size": child.size })
+    return files
 
-    if label in labels:
-        raise ValueError(f"Label '{label}' already exists")
+def verify(storage_id, package_hash, paths=None):
+    """Check the files of a stored package against its package hash.
 
-    add_label(storage_id, package_hash, label)
-    pass
+    With a Merkle tree (see libmailcd.merkle) only the files under paths are read
+     (every file if no paths given), and every bad file is reported. Without one,
+     the package can only be checked as a whole.
 
-def add_label(storage_id, package_hash, label):
-    # TODO(matthew): Do we need to validate that storage_id exists first, or can we make the assumption it
-    #  does?
+    Legacy (sha1) packages are checked as a whole, whether they were added as a
+     zip or as a directory (see _get_legacy_directory_manifest).
 
-    # get full package_hash
-    full_package_hash = package_hash # TODO(matthew): actually get the full package hash
+    Returns a list of (path, problem), empty if the package is intact. Problems
+     with the package directory itself (missing, empty, more than one package
+     file) or a package that can't be read (unreadable) have an empty path.
+    """
+    problems = _check_package_root(storage_id, package_hash)
+    if problems:
+        return problems
+
+    scheme = libmailcd.hashing.get_scheme_for_id(package_hash)
 
-    # get database (db) location
-    # <storage_id>/db.json
-    # The reason it's not <storage_id>/<package_hash>/db.json is so that it's an easier lookup when searching
-    #  for a package via a label later.
-    db_file_path = Path(STORAGE_ROOT, storage_id, STORAGE_DB_FILENAME)
+    tree = get_tree(package_hash)
+    if tree is not None and tree.get_id() != package_hash:
+        logging.warning(f"{package_hash}: stored tree doesn't match the package hash, checking the whole package")
+        tree = None
 
-    db = None
+    if paths and tree is not None:
+        paths = [scheme.normalize_path(path) for path in paths]
+        match = lambda path: any(path == p or path.startswith(p + '/') for p in paths)
+    else:
+        match = lambda path: True
+
+    package_path = _get_archive(storage_id, package_hash)
+    try:
+        if not _is_chunk_manifest(package_path) and not libmailcd.manifest.is_archive(package_path):
+            # Single file package
+            if libmailcd.utils.hash_file(package_path, scheme, use_cache=False) != package_hash:
+                return [(os.path.basename(package_path), "changed")]
+            return []
+
+        entries = list(_read_entries(package_path, scheme, match))
+    except _UNREADABLE_ERRORS as e:
+        return [("", f"unreadable: {e}")]
+
+    if tree is None:
+        manifest = libmailcd.manifest.Manifest(scheme, entries)
+        if manifest.get_id() == package_hash:
+            return []
+        if not scheme.is_verifiable and _get_legacy_directory_manifest(manifest).get_id() == package_hash:
+            return []
+        return [("", "package hash mismatch")]
+
+    problems = []
+    found = set()
+    for entry in entries:
+        found.add(entry.path)
+        expected = tree.get_file(entry.path)
+        if expected is None:
+            problems.append((entry.path, "unexpected"))
+        elif expected != (entry.size, entry.digest):
+            problems.append((entry.path, "changed"))
+
+    for path in tree.get_files():
+        if match(path) and path not in found:
+            problems.append((path, "missing"))
+
+    return sorted(problems)
+
+def quarantine(storage_id, package_hash):
+    """Move a (bad) package out of the store, into STORAGE_ROOT/.quarantine (to look
+    at or restore by hand), it's no longer in the catalog after.
+
+    Returns where it was moved to.
+    """
+    package_root = _get_package_root(storage_id, package_hash)
+    quarantine_path = Path(STORAGE_ROOT, STORAGE_QUARANTINE_DIRNAME, storage_id, package_hash)
+
+    with _lock_store():
+        if package_root.exists():
+            os.makedirs(quarantine_path.parent, exist_ok=True)
+            if quarantine_path.exists():
+                quarantine_path = Path(tempfile.mkdtemp(prefix=f"{package_hash}.", dir=quarantine_path.parent))
+                os.rmdir(quarantine_path)
+            os.rename(package_root, quarantine_path)
+        _get_catalog().remove_package(storage_id, package_hash)
+
+    logging.info(f"{storage_id}/{package_hash}: quarantined in {quarantine_path}")
+    return quarantine_path
+
+def get_tree(package_hash):
+    """Get the Merkle tree of a package (None if it doesn't have one)
+    """
+    data = _get_catalog().get_tree(package_hash)
+    if data is None:
+        return None
 
-    # load db if one currently exists
-    
-    if db_file_path.exists():
-        db = libmailcd.utils.load_yaml(db_file_path)
+    return libmailcd.merkle.MerkleTree.from_bytes(data)
 
-    # handle special case where db file exists, but no contents (without this, there would be a failure)
-    if not db:
-        db = {}
+def gc(dry_run=False):
+    """Remove the packages the storage IDs' gc settings don't keep (see STORAGE_SETTINGS),
+    then everything in the store no package uses anymore.
 
-    # add label (noop if already exists)
-    # NOTE(matthew): This might be more complex than needed.  Might just need a
-    #  1:1 mapping of label to package, as query by a label should return only
-    #  one package.
-    if not full_package_hash in db:
-        db[full_package_hash] = {}
-        db[full_package_hash]["labels"] = []
-
-    if len(db[full_package_hash]["labels"]):
-        db[full_package_hash]["labels"].append(label)
-    else:
-        db[full_package_hash]["labels"] = [ label ]
+    Decided from the catalog alone (sizes and last uses), the store isn't walked.
 
-    # keep only unique labels
-    db[full_package_hash]["labels"] = list(set(db[full_package_hash]["labels"]))
+    Returns (removed packages [(storage_id, package_hash, size)], number of chunks removed, bytes freed)
+    """
+    catalog = _get_catalog()
+
+    # Nothing can be added meanwhile (new chunks aren't in any package yet)
+    with _lock_store():
+        removed = []
+        chunk_manifests = []
+        for storage_id in catalog.get_storage_ids():
+            if not dry_run:
+                _remove_temps(storage_id)
+
+            candidates = get_gc_candidates(storage_id)
+            for package in candidates:
+                removed.append((storage_id, package["hash"], package["size"]))
+                if not dry_run:
+                    _remove(storage_id, package["hash"])
+
+            candidate_hashes = set(package["hash"] for package in candidates)
+            for package_hash in catalog.get_packages(storage_id):
+                if package_hash in candidate_hashes or not _exists(storage_id, package_hash):
+                    continue
+
+                package_path = _get_archive(storage_id, package_hash)
+                if _is_chunk_manifest(package_path):
+                    chunk_manifests.append(libmailcd.chunkstore.load_manifest(package_path))
+
+        chunks_removed, freed = _get_chunk_store().gc(chunk_manifests, dry_run=dry_run)
+
+    return removed, chunks_removed, freed + sum(size for _, _, size in removed)
+
+def get_gc_candidates(storage_id):
+    """Get the packages of a storage ID gc would remove (least recently used first).
+
+    Packages among the last gc_keep_last added, or with any of gc_keep_labels,
+     are kept. Of the others, the least recently used (downloaded, listed) are
+     removed until the storage ID fits in gc_max_size, or all of them if there's
+     no gc_max_size (but gc_keep_last or gc_keep_labels is set).
+    """
+    settings = get_settings(storage_id)
+    max_size = settings.get("gc_max_size")
+    keep_last = settings.get("gc_keep_last")
+    keep_labels = [label.strip() for label in settings.get("gc_keep_labels", "").split(",") if label.strip()]
+
+    if max_size is None and keep_last is None and not keep_labels:
+        return []
+
+    catalog = _get_catalog()
+    packages = catalog.get_package_infos(storage_id)
+
+    kept = set()
+    if keep_last is not None:
+        newest = sorted(packages, key=lambda package: package["added"], reverse=True)
+        kept.update(package["hash"] for package in newest[:int(keep_last)])
+    for label in keep_labels:
+        kept.update(catalog.find(storage_id, [label]))
+
+    candidates = [package for package in packages if package["hash"] not in kept]
+    if max_size is None:
+        return candidates
+
+    excess = sum(package["size"] for package in packages) - libmailcd.utils.parse_size(max_size)
+
+    removed = []
+    for package in candidates:
+        if excess <= 0:
+            break
+        removed.append(package)
+        excess -= package["size"]
+    return removed
 
-    # save db
-    libmailcd.utils.save_yaml(db_file_path, db)
-    pass
+########################################
 
-# TODO(matthew): refactor these label calls, so they use the same db code.
+def get_settings(storage_id):
+    return _get_catalog().get_settings(storage_id)
 
-def get_labels(storage_id, package_hash):
-    labels = []
+def get_setting(storage_id, name, default=None):
+    return _get_catalog().get_setting(storage_id, name, default)
+
+def set_setting(storage_id, name, value):
+    """Set (or unset, if value is None) a setting of a storage ID
+    """
+    if name not in STORAGE_SETTINGS:
+        raise ValueError(f"Unknown setting: {name}")
+
+    allowed = STORAGE_SETTINGS[name]
+    if value is not None and callable(allowed):
+        try:
+            allowed(value)
+        except ValueError:
+            raise ValueError(f"Invalid value for '{name}': {value}")
+    elif value is not None and allowed is not None and value not in allowed:
+        raise ValueError(f"Invalid value for '{name}': {value} (expected one of: {', '.join(allowed)})")
+
+    _get_catalog().set_setting(storage_id, name, value)
+
+def migrate_layout(storage_id, layout):
+    """Move every package of a storage ID to another directory layout (see STORAGE_LAYOUTS).
+
+    The layout setting is changed first (packages that haven't moved yet are
+     still found where they were), so an interrupted migration just needs to
+     be run again. Returns the number of packages moved.
+    """
+    if layout not in STORAGE_LAYOUTS:
+        raise ValueError(f"Unknown storage layout: {layout}")
+
+    with _lock_store():
+        previous_layout = get_setting(storage_id, "layout", STORAGE_LAYOUT_FLAT)
+        set_setting(storage_id, "layout", layout)
+
+        moved = 0
+        for package_hash in _get_catalog().get_packages(storage_id):
+            target_path = _get_layout_path(storage_id, package_hash, layout)
+            if target_path.exists():
+                continue
+
+            for source_layout in [previous_layout] + STORAGE_LAYOUTS:
+                source_path = _get_layout_path(storage_id, package_hash, source_layout)
+                if source_path.exists():
+                    os.makedirs(target_path.parent, exist_ok=True)
+                    os.rename(source_path, target_path)
+                    logging.debug(f"{storage_id}: moved {source_path} -> {target_path}")
+                    moved += 1
+                    break
+
+        if layout == STORAGE_LAYOUT_FLAT:
+            _remove_empty_shards(storage_id)
+
+        return moved
+
+########################################
+
+def label(storage_id, package_hash, label):
+    if not _get_catalog().add_label(storage_id, package_hash, label):
+        raise ValueError(f"Label '{label}' already exists")
+
+def add_label(storage_id, package_hash, label):
+    # TODO(matthew): Do we need to validate that storage_id exists first, or can we make the assumption it
+    #  does?
 
     # get full package_hash
     full_package_hash = package_hash # TODO(matthew): actually get the full package hash
 
-    # get database (db) location
-    db_file_path = Path(STORAGE_ROOT, storage_id, STORAGE_DB_FILENAME)
+    # add label (noop if already exists)
+    _get_catalog().add_label(storage_id, full_package_hash, label)
 
-    if db_file_path.exists():
-        db = libmailcd.utils.load_yaml(db_file_path)
-        if db:
-            if full_package_hash in db:
-                labels = db[full_package_hash]["labels"]
+def get_labels(storage_id, package_hash):
+    # get full package_hash
+    full_package_hash = package_hash # TODO(matthew): actually get the full package hash
 
-    return labels
+    return _get_catalog().get_labels(storage_id, full_package_hash)
 
 def find(storage_id, labels):
     """Find all the packages for the specified storage_id that match all the specified labels.
     """
-    matches = []
-    # get all packages for a given storage_id
-    packages = get(storage_id)
-
     # Special Case: if labels is not array, and is single string, treat that
     #  string as if it is a label
     if isinstance(labels, str):
         labels = [labels]
 
-    for package in packages:
-        # get all labels for each package
-        package_labels = get_labels(storage_id, package)
+    if not labels:
+        return get(storage_id)
 
-        # match labels for package against target labels
-        # validate that the package contains all the required labels
-        is_match = True
-        for required_label in labels:
-            if not required_label in package_labels:
-                is_match = False
-                break
-
-        if is_match:
-            matches.append(package)
-
-    return matches
+    return _get_catalog().find(storage_id, labels)
 
 ########################################
 
 def split_ref(ref):
     return ref.split('/')
 
+def split_package_ref(ref):
+    """Split 'SID/hash/path/in/package' into (storage_id, partial_package_hash, path),
+    parts that aren't there are None.
+    """
+    parts = ref.split('/', 2)
+    parts += [None] * (3 - len(parts))
+    return tuple(part or None for part in parts)
+
 def get_ref_matches(ref):
     matches = []
     sid, phash = split_ref(ref)
@@ -230,13 +587,58 @@ def get_ref_matches(ref):
     return matches
 
 def get_package_hash_matches(storage_id, partial_package_hash):
-    matches = []
+    """Get all the package hashes (of any hash scheme) that start with partial_package_hash.
+    """
+    catalog = _get_catalog()
+
+    matches = set()
+    for scheme, candidate in libmailcd.hashing.expand_partial_id(partial_package_hash):
+        for match in catalog.get_package_hash_matches(storage_id, candidate):
+            # 'b' (a legacy hash prefix) also matches 'b2-...'
+            if scheme is None or libmailcd.hashing.get_scheme_for_id(match) is scheme:
+                matches.add(match)
 
-    full_matches = Path(STORAGE_ROOT, storage_id).glob(partial_package_hash + "*")
-    for m in full_matches:
-        matches.append(m.name)
+    return sorted(matches)
 
-    return list(matches)
+def get_unique_prefix_length(storage_id, package_hash):
+    """Length of the shortest start of a package hash's digest that no other package
+    of the storage ID starts with (whatever their hash scheme).
+
+    Only the package's neighbours in the catalog's (sorted) index can share the
+     longest prefix with it, so it's two index lookups per hash scheme.
+    """
+    digest = _get_digest(package_hash)
+    catalog = _get_catalog()
+
+    length = 1
+    for scheme in libmailcd.hashing.get_schemes():
+        for neighbour in catalog.get_neighbours(storage_id, scheme.format_id(digest)):
+            if libmailcd.hashing.get_scheme_for_id(neighbour) is scheme:
+                common = len(os.path.commonprefix([digest, _get_digest(neighbour)]))
+                length = max(length, common + 1)
+
+    return min(length, len(digest))
+
+def abbreviate(storage_id, package_hash, min_length=None):
+    """Get the shortest unambiguous ref (at least min_length characters) to a package,
+    without its scheme prefix (see get_package_hash_matches).
+    """
+    if min_length is None:
+        min_length = ABBREV_MIN_LENGTH
+
+    length = max(min_length, get_unique_prefix_length(storage_id, package_hash))
+    return _get_digest(package_hash)[:length]
+
+def exists(storage_id, package_hash):
+    """If a package is in the store (checks its directory, no label lookups)
+    """
+    return _exists(storage_id, package_hash)
+
+def touch(storage_id, package_hash):
+    """Record that a package was used without reading it (e.g. a build found it
+    already downloaded), so gc's least recently used order sees it (see gc).
+    """
+    _get_catalog().touch_package(storage_id, package_hash)
 
 # TODO(Matthew): because of the exception raise, should this logic go into the CLI as helper function there?
 def get_fully_qualified_package_hash(storage_id, partial_package_hash):
@@ -253,36 +655,245 @@ def get_fully_qualified_package_hash(storage_id, partial_package_hash):
 # Note: these methods are a layer around the actual file system structure
 #  They all use STORAGE_ROOT
 
-def _archive(storage_id, package_hash, package):
-    output_filename = os.path.basename(Path(package))
-    output_file_path = Path(STORAGE_ROOT, storage_id, package_hash, output_filename)
-    print(f"archiving: {output_file_path}")
-    #print(f"output_filename={output_filename}")
-    shutil.make_archive(output_file_path, 'zip', root_dir=package)
-    pass
+def _get_archive_path(package_root, package):
+    output_filename = os.path.basename(Path(package)) + ".zip"
+    return Path(package_root, output_filename)
 
-def _save(storage_id, package_hash, package):
+def _save(package_root, package):
     output_filename = os.path.basename(Path(package))
-    output_file_path = Path(STORAGE_ROOT, storage_id, package_hash, output_filename)
+    output_file_path = Path(package_root, output_filename)
     shutil.copyfile(package, output_file_path)
-    print(f"archiving: {output_file_path}")
-    pass
+    return output_file_path
+
+def _save_sidecar(package_root, package_hash, entries, dirs):
+    scheme = libmailcd.hashing.get_scheme_for_id(package_hash)
+    sidecar_path = Path(package_root, libmailcd.sidecar.SIDECAR_FILENAME)
+    libmailcd.sidecar.save(sidecar_path, scheme, entries, dirs)
+
+def _get_sidecar(storage_id, package_hash):
+    """Get the sidecar manifest of a package (None for a single file package)
+
+    Packages stored before sidecars existed (or with an older version of
+     them) get one the first time it's needed.
+    """
+    package_root = _get_package_root(storage_id, package_hash)
+    sidecar_path = Path(package_root, libmailcd.sidecar.SIDECAR_FILENAME)
+    if sidecar_path.exists():
+        try:
+            return libmailcd.sidecar.Sidecar(sidecar_path)
+        except ValueError as e:
+            logging.debug(f"{storage_id}/{package_hash}: {e}, rebuilding it")
+
+    package_path = _get_archive(storage_id, package_hash)
+    if _is_chunk_manifest(package_path):
+        chunk_manifest = libmailcd.chunkstore.load_manifest(package_path)
+        _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_chunk_manifest(chunk_manifest))
+    elif zipfile.is_zipfile(package_path):
+        _save_sidecar(package_root, package_hash, *libmailcd.sidecar.from_zip(package_path))
+    else:
+        return None
+
+    return libmailcd.sidecar.Sidecar(sidecar_path)
+
+def _save_chunk_manifest(package_root, package, chunk_manifest):
+    output_filename = _strip_archive_extension(package) + libmailcd.chunkstore.CHUNK_MANIFEST_SUFFIX
+    output_file_path = Path(package_root, output_filename)
+    libmailcd.chunkstore.save_manifest(output_file_path, chunk_manifest)
+
+def _save_tree(package_hash, manifest):
+    if manifest.scheme.is_tree:
+        _get_catalog().set_tree(package_hash, manifest.get_tree().to_bytes())
+
+def _read_entries(package_path, scheme, match):
+    """Yield a ManifestEntry for every file of a stored package that match(path)
+    """
+    if _is_chunk_manifest(package_path):
+        chunk_manifest = libmailcd.chunkstore.load_manifest(package_path)
+        chunk_store = _get_chunk_store()
+        for record in chunk_manifest["files"]:
+            if not match(record["path"]):
+                continue
+
+            digester = scheme.new_file_digester()
+            size = 0
+            for data in chunk_store.iter_file(record):
+                digester.update(data)
+                size += len(data)
+            yield libmailcd.manifest.ManifestEntry(record["path"], size, digester.digest())
+    else:
+        with zipfile.ZipFile(package_path) as zfile:
+            for info in zfile.infolist():
+                path = scheme.normalize_path(info.filename)
+                if info.is_dir() or not match(path):
+                    continue
+
+                with zfile.open(info, mode='r') as f:
+                    digest = libmailcd.manifest.digest_stream(f, scheme)
+                yield libmailcd.manifest.ManifestEntry(path, info.file_size, digest)
+
+def _get_legacy_directory_manifest(manifest):
+    """Get the manifest a legacy (sha1) package was hashed with when it was added
+    as a directory, from the manifest of its zip.
+
+    Its zip (shutil.make_archive) has the files in the same directory walk order
+     the hash had, but the hash had each directory's files sorted, and the paths
+     of top level files started with './'.
+    """
+    groups = {}
+    for entry in manifest.entries:
+        groups.setdefault(posixpath.dirname(entry.path), []).append(entry)
+
+    entries = []
+    for dirpath, group in groups.items():
+        for entry in sorted(group, key=lambda entry: entry.path):
+            path = entry.path if dirpath else f"./{entry.path}"
+            entries.append(libmailcd.manifest.ManifestEntry(path, entry.size, entry.digest))
+
+    return libmailcd.manifest.Manifest(manifest.scheme, entries)
+
+def _is_chunk_manifest(package_path):
+    return str(package_path).endswith(libmailcd.chunkstore.CHUNK_MANIFEST_SUFFIX)
+
+def _get_catalog():
+    return libmailcd.catalog.open_catalog(STORAGE_ROOT)
+
+def _get_chunk_store():
+    return libmailcd.chunkstore.open_chunk_store(Path(STORAGE_ROOT, STORAGE_CHUNKS_DIRNAME))
+
+def _get_digest(package_hash):
+    return package_hash.rpartition(libmailcd.hashing.ID_SEPARATOR)[2]
+
+def _get_package_root(storage_id, package_hash):
+    """Get the directory of a package, for the storage ID's layout.
+
+    A package that isn't there yet is looked for where the other layouts would
+     put it (the storage ID is being migrated, see migrate_layout).
+    """
+    layout = get_setting(storage_id, "layout", STORAGE_LAYOUT_FLAT)
+    path = _get_layout_path(storage_id, package_hash, layout)
+    if path.exists():
+        return path
+
+    for other_layout in STORAGE_LAYOUTS:
+        if other_layout != layout:
+            other_path = _get_layout_path(storage_id, package_hash, other_layout)
+            if other_path.exists():
+                return other_path
+
+    return path
+
+def _get_layout_path(storage_id, package_hash, layout):
+    if layout == STORAGE_LAYOUT_SHARDED:
+        # Shard on the digest (not the scheme prefix, every new package would
+        #  end up in the same 'm2' shard)
+        digest = _get_digest(package_hash)
+        shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+        return Path(STORAGE_ROOT, storage_id, *shards, package_hash)
+
+    return Path(STORAGE_ROOT, storage_id, package_hash)
+
+def _remove_empty_shards(storage_id):
+    storage_path = Path(STORAGE_ROOT, storage_id)
+    for root, dirs, files in os.walk(storage_path, topdown=False):
+        if Path(root) == storage_path:
+            continue
+        relpath = os.path.relpath(root, storage_path)
+        is_shard = len(Path(relpath).parts) <= SHARD_LEVELS and len(Path(root).name) == SHARD_WIDTH
+        if is_shard and not os.listdir(root):
+            os.rmdir(root)
+
+def _get_size(storage_id, package_hash):
+    package_root = _get_package_root(storage_id, package_hash)
+    return sum(f.stat().st_size for f in package_root.iterdir() if f.is_file())
+
+@contextlib.contextmanager
+def _create_temp(storage_id):
+    """Create a temp package directory in the storage ID (same file system as the
+    packages, so it can be renamed into place), removed on the way out if it wasn't.
+    """
+    path = Path(STORAGE_ROOT, storage_id)
+    os.makedirs(path, exist_ok=True)
+    temp_path = Path(tempfile.mkdtemp(prefix=STORAGE_TEMP_PREFIX, dir=path))
+    try:
+        yield temp_path
+    finally:
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
 
 def _exists(storage_id, package_hash):
     # TODO(matthew): check that at least one (zip) file exists in this directory
-    path = Path(STORAGE_ROOT, storage_id, package_hash)
+    path = _get_package_root(storage_id, package_hash)
     return os.path.exists(path)
 
-def _create(storage_id, package_hash):
+def _publish(storage_id, package_hash, temp_path):
+    """Move a completely written package into place (a single rename, so nobody ever
+    sees half a package). Returns False if it's already there (someone else added
+    the same package at the same time), temp_path is left as is then.
+    """
     # TODO(Matthew): what is an id (spec/format of one)? do I need to pass around a clean up version (like spaces to _)?
-    path = Path(STORAGE_ROOT, storage_id, package_hash)
-    os.makedirs(path, exist_ok=True)
+    path = _get_package_root(storage_id, package_hash)
+    os.makedirs(path.parent, exist_ok=True)
+    try:
+        os.rename(temp_path, path)
+    except OSError as e:
+        if e.errno in (errno.EEXIST, errno.ENOTEMPTY) or path.exists():
+            return False
+        raise
     print(f"created: {storage_id} -- {path}")
+    return True
+
+def _lock_store(shared=False):
+    """Lock the whole store: adding packages takes a shared lock (any number can
+    add at once), what moves or removes stored data (gc, migrate) an exclusive one.
+    """
+    return libmailcd.filelock.FileLock(Path(STORAGE_ROOT, STORAGE_LOCK_FILENAME), shared=shared)
+
+def _remove(storage_id, package_hash):
+    """Remove a package (its chunks are left for the chunk store's gc)
+    """
+    package_root = _get_package_root(storage_id, package_hash)
+    logging.debug(f"{storage_id}: removing {package_hash}")
+    if package_root.exists():
+        shutil.rmtree(package_root)
+    _get_catalog().remove_package(storage_id, package_hash)
+
+def _remove_temps(storage_id):
+    """Remove temp package directories left behind by adds that never finished
+    (only safe with the store locked exclusively)
+    """
+    storage_path = Path(STORAGE_ROOT, storage_id)
+    if not storage_path.is_dir():
+        return
+
+    for name in os.listdir(storage_path):
+        if name.startswith(STORAGE_TEMP_PREFIX):
+            logging.debug(f"{storage_id}: removing {name}")
+            temp_path = Path(storage_path, name)
+            if temp_path.is_dir():
+                shutil.rmtree(temp_path)
+            else:
+                os.remove(temp_path)
+
+def _get_package_files(package_root):
+    # what zip exists here? (skipping the sidecar manifest, and temp files)
+    return sorted(f for f in os.listdir(package_root) if not f.startswith('.'))
+
+def _check_package_root(storage_id, package_hash):
+    package_root = _get_package_root(storage_id, package_hash)
+    if not package_root.is_dir():
+        return [("", "missing")]
+
+    files = _get_package_files(package_root)
+    if not files:
+        return [("", "empty")]
+    if len(files) > 1:
+        return [("", f"more than one package file: {', '.join(files)}")]
+
+    return []
 
 def _get_archive(storage_id, package_hash):
-    package_root = Path(STORAGE_ROOT, storage_id, package_hash)
-    # what zip exists here?
-    files = os.listdir(package_root)
+    package_root = _get_package_root(storage_id, package_hash)
+    files = _get_package_files(package_root)
 
     # TODO(matthew): should error out if more than one file found here
     #  I don't know what to show to the user or how they would fix it, this is an interanl error
@@ -290,8 +901,9 @@ def _get_archive(storage_id, package_hash):
     #  the same hash and use that zip.  If multiple zips have same hash, do we just pick one? or error?
     #  We could probably just pick one... but let's see if this error ever happens in the wild!
 
-    # For now, just return the first file found
-    # TODO(matthew): what if no files found?
+    # For now, just return the first file found ('mb store verify' reports these)
+    if not files:
+        raise FileNotFoundError(f"No package file in: {package_root}")
     return Path(package_root, files[0])
 
 
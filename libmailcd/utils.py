@@ -9,92 +9,89 @@
 #   -2 -> General error (see stack traceback)
 
 # NOTE: This original code was written for python2 (has bad practicies and unnecessary steps)
-# TODO(matthew): sort directories/files so this is consistent across os'
-#  This should be handled before shipping, but we can work with what we have for now
+#  It lives on as the legacy (sha1) scheme in libmailcd.hashing, the other
+#  schemes sort the files so they're consistent across os'
 
 # https://stackoverflow.com/questions/24937495/how-can-i-calculate-a-hash-for-a-filesystem-directory-using-python
 
 import os
-import hashlib
+import fnmatch
 import zipfile
 
+import libmailcd.hashcache
+import libmailcd.hashing
+import libmailcd.manifest
 
-def hash_file(filepath):
-    content_hash = hashlib.sha1()
+
+def hash_file(filepath, scheme=None, use_cache=True):
+    """Get the package hash of a file (if it's a zip or tarball, the package hash of its contents)
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
 
     if not os.path.exists(filepath):
         raise ValueError(f"File to hash doesn't exist: {filepath}")
 
+    cache = libmailcd.hashcache.open_cache() if use_cache else None
+
     # Note: This is a little bit differant that hash_directory
     #  Need to check if file, as directories show up in the return file listing
-    if zipfile.is_zipfile(filepath):
-        with zipfile.ZipFile(filepath) as zfile:
-            for afile in zfile.infolist():
-                if not afile.is_dir():
-                    name = afile.filename
-
-                    # Hash file path (relative to package root)
-                    relfilepath_bytes = name.encode()
-                    relfilepath_sha = hashlib.sha1(relfilepath_bytes)
-                    content_hash.update(relfilepath_sha.digest())
-
-                    # Note: ZipFile.open() already opens it as a binary format (not text)
-                    with zfile.open(name, mode='r') as f:
-                        while True:
-                            buf = f.read(4096)
-                            if not buf:
-                                break
-                            mysha = hashlib.sha1(buf)
-                            content_hash.update(mysha.digest())
+    if os.path.isfile(filepath) and libmailcd.manifest.is_archive(filepath):
+        if cache:
+            package_hash = cache.lookup(filepath, scheme.cache_kind_zip)
+            if package_hash:
+                return package_hash.decode()
+
+        package_hash = libmailcd.manifest.from_archive(filepath, scheme).get_id()
+
+        if cache:
+            cache.store(filepath, scheme.cache_kind_zip, package_hash.encode())
     elif os.path.isfile(filepath):
-        with open(filepath, 'rb') as f:
-            while True:
-                buf = f.read(4096)
-                if not buf:
-                    break
-                mysha = hashlib.sha1(buf)
-                content_hash.update(mysha.digest())
+        digest = None
+        if cache:
+            digest = cache.lookup(filepath, scheme.cache_kind_file)
+
+        if digest is None:
+            st = os.stat(filepath)
+            digest = libmailcd.manifest.digest_file(filepath, scheme)
+            if cache:
+                cache.store(filepath, scheme.cache_kind_file, digest, st)
+
+        content_hash = scheme.new()
+        content_hash.update(digest)
+        package_hash = scheme.format_id(content_hash.hexdigest())
     else:
         raise ValueError(f"File to hash isn't a file: {filepath}")
 
-    return content_hash.hexdigest()
+    return package_hash
 
-def hash_directory(directory):
-    content_hash = hashlib.sha1()
+def hash_directory(directory, scheme=None, use_cache=True, cached_only=False):
+    """Get the package hash of a directory.
 
-    if not os.path.exists(directory):
-        raise ValueError(f"Directory to hash doesn't exist: {directory}")
+    If cached_only, returns None unless every file's digest is in the file hash cache.
+    """
+    manifest = libmailcd.manifest.from_directory(
+        directory,
+        scheme,
+        use_cache=use_cache,
+        cached_only=cached_only
+    )
 
-    # TODO(matthew): create file list first, then sort, then read for hashing
-    #  What is the impact for packaging something with lots of files?
-    for root, _, files in os.walk(directory):
-        for filename in sorted(files):
+    if manifest is None:
+        return None
 
-            # Calculate various paths required
-            reldir = os.path.relpath(root, directory)
-            relfilepath = os.path.join(reldir, filename)
-            filepath = os.path.join(root,filename)
+    return manifest.get_id()
 
-            # Hash file path (relative to package root)
-            relfilepath = relfilepath.replace('\\', '/') # make sure file separator is consistent across os'
-            relfilepath_bytes = relfilepath.encode()
-            relfilepath_sha = hashlib.sha1(relfilepath_bytes)
-            content_hash.update(relfilepath_sha.digest())
+def get_directory_tree(directory, scheme=None, use_cache=True):
+    """Get the Merkle tree of a directory (see libmailcd.merkle), its get_id() is the package hash.
 
-            # Hash file contents
-            if os.path.isfile(filepath):
-                with open(filepath, 'rb') as f:
-                    while True:
-                        # Read file in as little chunks
-                        buf = f.read(4096)
-                        if not buf:
-                            break
-                        mysha = hashlib.sha1(buf)
+    After changing files, libmailcd.merkle.update_from_directory() rehashes only those files
+     (and the directories above them).
+    """
+    scheme = libmailcd.hashing.get_scheme(scheme)
+    if not scheme.is_tree:
+        raise ValueError(f"Hash scheme isn't a tree: {scheme.name}")
 
-                        digest = mysha.digest()
-                        content_hash.update(digest)
-
-    return content_hash.hexdigest()
+    return libmailcd.manifest.from_directory(directory, scheme, use_cache=use_cache).get_tree()
 
 ########################################
 
@@ -122,6 +119,22 @@ def zip_extract(filepath, target_path):
     with zipfile.ZipFile(filepath, 'r') as zip_ref:
         zip_ref.extractall(target_path)
 
+def match_globs(path, globs):
+    """If a path (in a package) matches any of the globs.
+
+    A glob matches a path if it matches it with fnmatch ('*' also matches '/'),
+     or if it's a directory the path is in ('include/' or 'include').
+    """
+    for glob in globs:
+        glob = glob.replace('\\', '/').lstrip('/')
+        if fnmatch.fnmatchcase(path, glob):
+            return True
+        if glob.startswith("**/") and fnmatch.fnmatchcase(path, glob[3:]):
+            return True
+        if path.startswith(glob.rstrip('/') + '/'):
+            return True
+    return False
+
 ########################################
 
 import re
@@ -129,6 +142,16 @@ import re
 def is_hex(s):
     return re.fullmatch(r"^[0-9a-fA-F]+$", s or "") is not None
 
+_SIZE_UNITS = { "": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4 }
+
+def parse_size(s):
+    """Parse a size in bytes, with an optional unit ('500M', '20G', '1.5T', '4096')
+    """
+    match = re.fullmatch(r"\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)i?B?\s*", str(s), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {s}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
 ########################################
 
 import yaml
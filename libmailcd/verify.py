@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import libmailcd.storage
+
+########################################
+
+# Result of checking a package
+VERIFY_OK = "ok"
+VERIFY_BAD = "bad"
+VERIFY_SKIPPED = "skipped" # can't be checked (e.g. its hash scheme isn't available here)
+
+########################################
+
+class VerifyResult():
+    def __init__(self, storage_id, package_hash, status, problems=()):
+        self.storage_id = storage_id
+        self.package_hash = package_hash
+        self.status = status
+        self.problems = list(problems) # [(path, problem)]
+
+    @property
+    def ref(self):
+        return f"{self.storage_id}/{self.package_hash}"
+
+def verify_packages(packages, max_workers=None, checkpoint_path=None, limit=None):
+    """Check many stored packages (see storage.verify) in a process pool, yields a
+    VerifyResult for each one as they finish.
+
+    packages are (storage_id, package_hash), the biggest are started first (so
+     the pool isn't left waiting on one big package at the end). Every result is
+     appended to the checkpoint file (if given), packages already in it are
+     skipped, so a run can be split up (limit) or resumed after being stopped.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    done = load_checkpoint(checkpoint_path) if checkpoint_path else set()
+    packages = [package for package in packages if _get_ref(*package) not in done]
+    packages.sort(key=lambda package: _get_size(*package), reverse=True)
+    if limit is not None:
+        packages = packages[:limit]
+
+    checkpoint = open(checkpoint_path, 'a') if checkpoint_path else None
+    try:
+        # NOTE: spawned, not forked: the catalog, hash cache and chunk index
+        #  sqlite connections this process has open can't be used across a fork
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [
+                executor.submit(_verify_package, libmailcd.storage.STORAGE_ROOT, storage_id, package_hash)
+                for storage_id, package_hash in packages
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if checkpoint:
+                    checkpoint.write(f"{result.ref}\t{result.status}\n")
+                    checkpoint.flush()
+                yield result
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+def load_checkpoint(checkpoint_path):
+    """Get the refs (storage_id/package_hash) already checked in a checkpoint file
+    """
+    if not Path(checkpoint_path).exists():
+        return set()
+
+    done = set()
+    with open(checkpoint_path, 'r') as f:
+        for line in f:
+            ref, _, status = line.rstrip('\n').partition('\t')
+            # A line cut short (killed while writing) doesn't count
+            if status in (VERIFY_OK, VERIFY_BAD, VERIFY_SKIPPED):
+                done.add(ref)
+    return done
+
+########################################
+
+def _verify_package(storage_root, storage_id, package_hash):
+    # Runs in a worker process (which might not have inherited the storage root)
+    libmailcd.storage.STORAGE_ROOT = storage_root
+
+    try:
+        problems = libmailcd.storage.verify(storage_id, package_hash)
+    except ValueError as e:
+        logging.debug(f"{storage_id}/{package_hash}: {e}")
+        return VerifyResult(storage_id, package_hash, VERIFY_SKIPPED)
+    except Exception as e:
+        # Unreadable (corrupt zip, missing chunks, ...)
+        return VerifyResult(storage_id, package_hash, VERIFY_BAD, [("", f"unreadable: {e}")])
+
+    return VerifyResult(storage_id, package_hash, VERIFY_BAD if problems else VERIFY_OK, problems)
+
+def _get_ref(storage_id, package_hash):
+    return f"{storage_id}/{package_hash}"
+
+def _get_size(storage_id, package_hash):
+    package = libmailcd.storage.get_package_info(storage_id, package_hash)
+    return package["size"] if package else 0
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+import unittest
+
+from .context import libmailcd
+
+from libmailcd.cli.tools import agent
+
+
+class DockerModeLockTestSuite(unittest.TestCase):
+
+    def _run(self, modes):
+        """Hold the lock in every mode at the same time (for a moment), returns the
+        most modes ever held at once and the most holders
+        """
+        lock = agent._DockerModeLock()
+        held = []
+        most = { "modes": 0, "holders": 0 }
+        guard = threading.Lock()
+
+        def hold(mode):
+            with lock.hold(mode):
+                with guard:
+                    held.append(mode)
+                    most["modes"] = max(most["modes"], len(set(held)))
+                    most["holders"] = max(most["holders"], len(held))
+                time.sleep(0.05)
+                with guard:
+                    held.remove(mode)
+
+        threads = [threading.Thread(target=hold, args=(mode,)) for mode in modes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return most["modes"], most["holders"]
+
+    def test_same_mode_shared(self):
+        modes, holders = self._run(["linux"] * 4)
+        self.assertEqual(modes, 1)
+        self.assertGreater(holders, 1)
+
+    def test_other_mode_waits(self):
+        modes, _ = self._run(["linux", "windows", "linux", "windows"])
+        self.assertEqual(modes, 1)
+
+class LocalNodeTestSuite(unittest.TestCase):
+
+    def test_keeps_cwd(self):
+        # Stages run on threads of the same process, a node can't chdir
+        cwd = os.getcwd()
+        node = agent.LocalNode(os.path.dirname(__file__))
+        with node:
+            self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(os.getcwd(), cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from .context import libmailcd
+
+import libmailcd.hashcache
+
+
+class HashCacheTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        self.root = self._temp.name
+
+    def tearDown(self):
+        self._temp.cleanup()
+
+    def test_store_lookup(self):
+        filepath = Path(self.root, "file")
+        filepath.write_bytes(b"data")
+        # Older than the racy window, so it's cached
+        os.utime(filepath, (1, 1))
+
+        cache = libmailcd.hashcache.HashCache(Path(self.root, "cache"))
+        cache.store(filepath, "kind", b"digest")
+        self.assertEqual(cache.lookup(filepath, "kind"), b"digest")
+        self.assertIsNone(cache.lookup(filepath, "other"))
+
+        filepath.write_bytes(b"changed")
+        self.assertIsNone(cache.lookup(filepath, "kind"))
+
+    def test_concurrent_open(self):
+        # Every thread opens the same new cache, only one of them creates it
+        cache_root = Path(self.root, "cache")
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def open_cache():
+            barrier.wait()
+            try:
+                libmailcd.hashcache.HashCache(cache_root)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=open_cache) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_old_version_reset(self):
+        cache_root = Path(self.root, "cache")
+        libmailcd.hashcache.HashCache(cache_root)
+
+        conn = sqlite3.connect(str(Path(cache_root, libmailcd.hashcache.HASH_CACHE_FILENAME)))
+        conn.execute("PRAGMA user_version = 0")
+        conn.commit()
+        conn.close()
+
+        cache = libmailcd.hashcache.HashCache(cache_root)
+        version = cache._conn.execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(version, libmailcd.hashcache._SCHEMA_VERSION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import unittest
+
+from .context import libmailcd
+
+import libmailcd.merkle
+
+
+def make_tree(files):
+    tree = libmailcd.merkle.MerkleTree()
+    for path, contents in files.items():
+        tree.set_file(path, len(contents), hashlib.sha256(contents).digest())
+    return tree
+
+
+class MerkleTreeTestSuite(unittest.TestCase):
+
+    def test_nested_directories(self):
+        # Directories only holding directories are part of the hash too
+        tree = make_tree({ "a/b/c/file": b"one" })
+        other = make_tree({ "a/b/c/file": b"two" })
+
+        self.assertTrue(tree.is_directory("a/b"))
+        self.assertNotEqual(tree.get_id(), other.get_id())
+        self.assertEqual(tree.diff(other), ["a/b/c/file"])
+
+    def test_order_independent(self):
+        files = { "lib/x.so": b"x", "bin/tool": b"tool", "lib/sub/y.so": b"y" }
+        tree = make_tree(files)
+        other = make_tree(dict(reversed(list(files.items()))))
+
+        self.assertEqual(tree.get_id(), other.get_id())
+
+    def test_incremental(self):
+        tree = make_tree({ "a/file": b"one", "b/file": b"two" })
+        before = tree.get_id()
+
+        tree.set_file("a/file", 3, hashlib.sha256(b"new").digest())
+        self.assertNotEqual(tree.get_id(), before)
+        self.assertEqual(tree.get_id(), make_tree({ "a/file": b"new", "b/file": b"two" }).get_id())
+
+        tree.remove_file("a/file")
+        self.assertFalse(tree.is_directory("a"))
+        self.assertEqual(tree.get_id(), make_tree({ "b/file": b"two" }).get_id())
+
+    def test_bytes(self):
+        tree = make_tree({ "a/b/file": b"one", "top": b"two" })
+        loaded = libmailcd.merkle.MerkleTree.from_bytes(tree.to_bytes())
+
+        self.assertEqual(loaded.get_id(), tree.get_id())
+        self.assertEqual(loaded.get_files(), ["a/b/file", "top"])
+
+
+if __name__ == '__main__':
+    unittest.main()
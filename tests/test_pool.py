@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from .context import libmailcd
+
+import libmailcd.hashcache
+import libmailcd.pool
+import libmailcd.storage
+
+
+class PoolTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        self.root = self._temp.name
+
+        self._storage_root = libmailcd.storage.STORAGE_ROOT
+        self._hash_cache_root = libmailcd.hashcache.HASH_CACHE_ROOT
+        self._pool_root = libmailcd.pool.POOL_ROOT
+        libmailcd.storage.STORAGE_ROOT = str(Path(self.root, "storage"))
+        libmailcd.hashcache.HASH_CACHE_ROOT = str(Path(self.root, "cache"))
+        libmailcd.pool.POOL_ROOT = str(Path(self.root, "pool"))
+
+        self.package_hash = self._add_package("package", b"contents\n")
+
+    def tearDown(self):
+        libmailcd.storage.STORAGE_ROOT = self._storage_root
+        libmailcd.hashcache.HASH_CACHE_ROOT = self._hash_cache_root
+        libmailcd.pool.POOL_ROOT = self._pool_root
+        self._temp.cleanup()
+
+    def _add_package(self, name, contents):
+        package_path = Path(self.root, name)
+        os.makedirs(Path(package_path, "bin"))
+        Path(package_path, "bin", "tool").write_bytes(contents)
+        return libmailcd.storage.add("PKG", package_path)
+
+    def _get_pool_file(self):
+        return Path(libmailcd.pool.POOL_ROOT, self.package_hash, "bin", "tool")
+
+    def test_auto_is_a_copy(self):
+        target_path = Path(self.root, "inbox")
+        libmailcd.pool.materialize("PKG", self.package_hash, target_path)
+
+        Path(target_path, "bin", "tool").write_bytes(b"changed\n")
+        self.assertEqual(self._get_pool_file().read_bytes(), b"contents\n")
+
+    def test_auto_without_reflink(self):
+        # e.g. Windows (no fcntl)
+        target_path = Path(self.root, "inbox")
+        with mock.patch.object(libmailcd.pool, "fcntl", None):
+            libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="auto")
+            self.assertEqual(Path(target_path, "bin", "tool").read_bytes(), b"contents\n")
+
+            with self.assertRaises(OSError):
+                libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="reflink")
+
+    def test_hardlink(self):
+        target_path = Path(self.root, "inbox")
+        libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="hardlink")
+
+        self.assertTrue(os.path.samefile(Path(target_path, "bin", "tool"), self._get_pool_file()))
+
+    def test_symlink(self):
+        target_path = Path(self.root, "inbox")
+        libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="symlink")
+
+        self.assertTrue(target_path.is_symlink())
+        self.assertEqual(Path(target_path, "bin", "tool").read_bytes(), b"contents\n")
+
+    def test_verify_repairs_changed_entry(self):
+        target_path = Path(self.root, "inbox")
+        libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="hardlink")
+
+        # Writing to a hardlinked inbox changes the pool's copy
+        tool_path = Path(target_path, "bin", "tool")
+        os.chmod(tool_path, 0o644)
+        tool_path.write_bytes(b"changed\n")
+
+        libmailcd.pool.materialize("PKG", self.package_hash, target_path, mode="copy", verify=True)
+        self.assertEqual(self._get_pool_file().read_bytes(), b"contents\n")
+        self.assertEqual(tool_path.read_bytes(), b"contents\n")
+
+    def test_max_size(self):
+        other_hash = self._add_package("other", b"other contents\n")
+
+        libmailcd.pool.materialize("PKG", self.package_hash, Path(self.root, "inbox"), max_size="10")
+        libmailcd.pool.materialize("PKG", other_hash, Path(self.root, "other-inbox"), max_size="10")
+
+        # Only the one just used fits
+        self.assertFalse(Path(libmailcd.pool.POOL_ROOT, self.package_hash).exists())
+        self.assertTrue(Path(libmailcd.pool.POOL_ROOT, other_hash).exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from .context import libmailcd
+
+import libmailcd.errors
+from libmailcd.stagegraph import StageGraph
+
+
+def stage(inbox=(), outbox=()):
+    return { "inbox": { slot: {} for slot in inbox }, "outbox": { slot: [] for slot in outbox } }
+
+
+class StageGraphTestSuite(unittest.TestCase):
+
+    def test_dependencies(self):
+        graph = StageGraph.from_stages({
+            "app": stage(inbox=["LIB", "TOOLS"], outbox=["APP"]),
+            "lib": stage(outbox=["LIB"]),
+            "tools": stage(outbox=["TOOLS"]),
+            "docs": stage()
+        })
+
+        self.assertEqual(graph.get_dependencies("app"), {"lib", "tools"})
+        self.assertEqual(graph.order(), ["lib", "tools", "docs", "app"])
+        self.assertEqual(graph.levels(), [["lib", "tools", "docs"], ["app"]])
+        self.assertEqual(graph.max_parallelism, 3)
+
+    def test_cycle(self):
+        graph = StageGraph.from_stages({
+            "a": stage(inbox=["C"], outbox=["A"]),
+            "b": stage(inbox=["A"], outbox=["B"]),
+            "c": stage(inbox=["B"], outbox=["C"]),
+            "d": stage(inbox=["C"])
+        })
+
+        with self.assertRaises(libmailcd.errors.StageCycleError) as cm:
+            graph.order()
+
+        cycle = cm.exception.cycle
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertEqual(set(cycle), {"a", "b", "c"})
+        for stage_name, dependency in zip(cycle, cycle[1:]):
+            self.assertIn(dependency, graph.get_dependencies(stage_name))
+
+    def test_own_outbox(self):
+        # A stage using its own outbox doesn't depend on itself
+        graph = StageGraph.from_stages({ "a": stage(inbox=["A"], outbox=["A"]) })
+        self.assertEqual(graph.order(), ["a"])
+
+    def test_critical_path(self):
+        graph = StageGraph.from_stages({
+            "lib": stage(outbox=["LIB"]),
+            "app": stage(inbox=["LIB"], outbox=["APP"]),
+            "docs": stage()
+        })
+
+        path, length = graph.critical_path({ "lib": 2, "app": 3, "docs": 4 })
+        self.assertEqual(path, ["lib", "app"])
+        self.assertEqual(length, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+from .context import libmailcd
+
+import libmailcd.hashcache
+import libmailcd.storage
+import libmailcd.verify
+
+
+def make_package(directory):
+    os.makedirs(Path(directory, "lib"))
+    Path(directory, "readme.txt").write_bytes(b"readme\n")
+    Path(directory, "lib", "data.bin").write_bytes(os.urandom(64 * 1024))
+    return directory
+
+def corrupt_zip_member(zip_path, name):
+    """Flip a byte in the middle of a member's data (the zip itself still opens)
+    """
+    with zipfile.ZipFile(zip_path) as zfile:
+        info = zfile.getinfo(name)
+
+    with open(zip_path, 'r+b') as f:
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        offset = info.header_offset + 30 + name_length + extra_length + info.compress_size // 2
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+class StorageVerifyTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        self.root = self._temp.name
+
+        self._storage_root = libmailcd.storage.STORAGE_ROOT
+        self._hash_cache_root = libmailcd.hashcache.HASH_CACHE_ROOT
+        libmailcd.storage.STORAGE_ROOT = str(Path(self.root, "storage"))
+        libmailcd.hashcache.HASH_CACHE_ROOT = str(Path(self.root, "cache"))
+
+        self.package_path = make_package(Path(self.root, "package"))
+
+    def tearDown(self):
+        libmailcd.storage.STORAGE_ROOT = self._storage_root
+        libmailcd.hashcache.HASH_CACHE_ROOT = self._hash_cache_root
+        self._temp.cleanup()
+
+    def _get_stored_path(self, storage_id, package_hash):
+        package_root = Path(libmailcd.storage.STORAGE_ROOT, storage_id, package_hash)
+        return [path for path in package_root.iterdir() if not path.name.startswith(".")][0]
+
+    def test_intact(self):
+        package_hash = libmailcd.storage.add("PKG", self.package_path)
+        self.assertEqual(libmailcd.storage.verify("PKG", package_hash), [])
+
+    def test_corrupt_zip(self):
+        package_hash = libmailcd.storage.add("PKG", self.package_path)
+        corrupt_zip_member(self._get_stored_path("PKG", package_hash), "lib/data.bin")
+
+        problems = libmailcd.storage.verify("PKG", package_hash)
+        self.assertEqual(len(problems), 1)
+        self.assertEqual(problems[0][0], "")
+        self.assertTrue(problems[0][1].startswith("unreadable: "))
+
+    def test_missing_chunk(self):
+        package_hash = libmailcd.storage.add("PKG", self.package_path, backend=libmailcd.storage.STORAGE_BACKEND_CHUNKED)
+
+        chunks_root = Path(libmailcd.storage.STORAGE_ROOT, libmailcd.storage.STORAGE_CHUNKS_DIRNAME)
+        chunk_paths = [Path(dirpath, filename) for dirpath, _, filenames in os.walk(chunks_root) for filename in filenames if not filename.endswith(".db")]
+        self.assertTrue(chunk_paths)
+        os.remove(chunk_paths[0])
+
+        problems = libmailcd.storage.verify("PKG", package_hash)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0][1].startswith("unreadable: "))
+
+    def test_bulk_matches_single(self):
+        good_hash = libmailcd.storage.add("PKG", self.package_path)
+        Path(self.package_path, "readme.txt").write_bytes(b"other\n")
+        bad_hash = libmailcd.storage.add("PKG", self.package_path)
+        corrupt_zip_member(self._get_stored_path("PKG", bad_hash), "lib/data.bin")
+
+        results = { result.package_hash: result for result in libmailcd.verify.verify_packages([("PKG", good_hash), ("PKG", bad_hash)], max_workers=2) }
+        self.assertEqual(results[good_hash].status, libmailcd.verify.VERIFY_OK)
+        self.assertEqual(results[bad_hash].status, libmailcd.verify.VERIFY_BAD)
+        self.assertEqual(results[bad_hash].problems, libmailcd.storage.verify("PKG", bad_hash))
+
+
+if __name__ == '__main__':
+    unittest.main()
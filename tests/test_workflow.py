@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import pygit2
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from .context import libmailcd
+
+import libmailcd.errors
+import libmailcd.hashcache
+import libmailcd.stagecache
+from libmailcd.cli.common import workflow
+
+
+class FakeNode():
+    """Runs nothing, a step's return code is in the step ('exit 2')
+    """
+
+    def __init__(self, ran, cancelled, waiting):
+        self._ran = ran
+        self._cancelled = cancelled
+        self._waiting = waiting
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def get_env(self):
+        return subprocess.CompletedProcess([], 0, "", "")
+
+    def run_step(self, step):
+        self._ran.append(step)
+        if step == "wait":
+            # Until another stage failed
+            self._waiting.set()
+            self._cancelled.wait(5)
+        if step == "sync":
+            # Until another stage is waiting
+            self._waiting.wait(5)
+        if step.startswith("write"):
+            # A build output (never the same twice)
+            filepath = Path(step.split()[1])
+            os.makedirs(filepath.parent, exist_ok=True)
+            filepath.write_bytes(os.urandom(16))
+        returncode = int(step.split()[1]) if step.startswith("exit") else 0
+        return subprocess.CompletedProcess([], returncode, "", "")
+
+class FakeLogs():
+    def __init__(self, root):
+        self.root = Path(root, "logs")
+
+    def get_build_log_path(self, stage_name):
+        return Path(self.root, f"{stage_name}.log")
+
+    def get_env_log_path(self, stage_name):
+        return Path(self.root, f"{stage_name}.env")
+
+class FakeApi():
+    # Like mb build (--workspace .), run from the workspace
+    def __init__(self):
+        self._settings = { "stage_root_relative": Path(".mb", "stage"), "workspace": Path(".") }
+
+    def settings(self, name):
+        return self._settings[name]
+
+
+class StagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        self.workspace = Path(self._temp.name, "workspace")
+        os.makedirs(self.workspace)
+
+        # Stage outboxes are relative to the cwd (the workspace, for mb build)
+        self._cwd = os.getcwd()
+        os.chdir(self.workspace)
+
+        self._hash_cache_root = libmailcd.hashcache.HASH_CACHE_ROOT
+        libmailcd.hashcache.HASH_CACHE_ROOT = str(Path(self._temp.name, "cache"))
+
+        self.ran = []
+        self.cancelled = threading.Event()
+        self.waiting = threading.Event()
+        self._factory = mock.patch.object(workflow.agent, "factory", lambda *args: FakeNode(self.ran, self.cancelled, self.waiting))
+        self._factory.start()
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._factory.stop()
+        libmailcd.hashcache.HASH_CACHE_ROOT = self._hash_cache_root
+        self._temp.cleanup()
+
+    def _run(self, stages, jobs=None, stage_cache=None, cache_all_stages=False):
+        workflow.pipeline_stages_run(
+            FakeApi(),
+            self.workspace,
+            stages,
+            FakeLogs(self._temp.name),
+            {},
+            jobs=jobs,
+            stage_cache=stage_cache,
+            cache_all_stages=cache_all_stages
+        )
+
+class StagesRunTestSuite(StagesTestCase):
+
+    def test_failing_step(self):
+        stages = {
+            "a": { "node": {}, "steps": ["exit 2", "after"] },
+            "b": { "node": {}, "steps": ["before"] }
+        }
+        with self.assertRaises(libmailcd.errors.StageError) as cm:
+            self._run(stages, jobs=1)
+
+        self.assertEqual(cm.exception.stage, "a")
+        self.assertNotIn("after", self.ran)
+
+    def test_failing_step_cancels_running_stages(self):
+        original_run = workflow._pipeline_process_stage
+
+        def process_stage(*args, **kwargs):
+            # The steps wait on the pipeline's own cancellation
+            self.cancelled = kwargs["cancelled"]
+            return original_run(*args, **kwargs)
+
+        stages = {
+            "a": { "node": {}, "steps": ["sync", "exit 1"] },
+            "b": { "node": {}, "steps": ["wait", "after"] }
+        }
+        with mock.patch.object(workflow, "_pipeline_process_stage", process_stage):
+            with self.assertRaises(libmailcd.errors.StageError):
+                self._run(stages, jobs=2)
+
+        self.assertIn("wait", self.ran)
+        self.assertNotIn("after", self.ran)
+
+class StageCacheTestSuite(StagesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stage_cache = libmailcd.stagecache.open_cache(Path(self._temp.name, "stage-cache"))
+
+        # Sources tracked by git (what stages are keyed on without cache inputs)
+        Path(self.workspace, "src").mkdir()
+        Path(self.workspace, "src", "main.c").write_text("int main() { return 0; }\n")
+        repository = pygit2.init_repository(str(self.workspace))
+        repository.index.add("src/main.c")
+        repository.index.write()
+
+        # C depends on A (A's outbox is in C's inbox)
+        self.stages = {
+            "A": { "node": {}, "steps": ["write build/a.o"], "outbox": { "ALIB": ["build/a.o -> /"] } },
+            "B": { "node": {}, "steps": ["write b.out"], "outbox": { "BOUT": ["b.out -> /"] } },
+            "C": { "node": {}, "steps": ["write c.out"], "inbox": { "ALIB": {} }, "outbox": { "COUT": ["c.out -> /"] } }
+        }
+
+    def _run_cached(self, jobs=2, cache_all_stages=True):
+        del self.ran[:]
+        self._run(self.stages, jobs=jobs, stage_cache=self.stage_cache, cache_all_stages=cache_all_stages)
+        return sorted(self.ran)
+
+    def test_second_run_hits(self):
+        self.assertEqual(self._run_cached(), ["write b.out", "write build/a.o", "write c.out"])
+        # The build outputs run 1 left in the workspace don't change the keys
+        self.assertEqual(self._run_cached(), [])
+        self.assertEqual(self._run_cached(jobs=1), [])
+        self.assertTrue(Path(self.workspace, ".mb", "stage", "C", "outbox", "COUT", "c.out").exists())
+
+    def test_source_change(self):
+        self._run_cached()
+        Path(self.workspace, "src", "main.c").write_text("int main() { return 1; }\n")
+        self.assertEqual(self._run_cached(), ["write b.out", "write build/a.o", "write c.out"])
+
+    def test_opt_in(self):
+        self.stages["A"]["cache"] = True
+        self.stages["B"]["cache"] = { "inputs": ["src/**"] }
+
+        self._run_cached(cache_all_stages=False)
+        # C doesn't ask to be cached
+        self.assertEqual(self._run_cached(cache_all_stages=False), ["write c.out"])
+
+    def test_opt_out(self):
+        self.stages["A"]["cache"] = False
+
+        self._run_cached()
+        # Nor is C, it depends on A
+        self.assertEqual(self._run_cached(), ["write build/a.o", "write c.out"])
+
+    def test_failed_stage_not_saved(self):
+        self.stages["B"]["steps"] = ["write b.out", "exit 1"]
+        with self.assertRaises(libmailcd.errors.StageError):
+            self._run_cached(jobs=1)
+
+        self.stages["B"]["steps"] = ["write b.out"]
+        self.assertIn("write b.out", self._run_cached())
+
+    def test_not_a_repository(self):
+        # Nothing to key the stages on without cache inputs
+        os.chdir(self._cwd)
+        os.rename(Path(self.workspace, ".git"), Path(self._temp.name, "git"))
+        os.chdir(self.workspace)
+
+        self._run_cached()
+        self.assertEqual(len(self._run_cached()), 3)
+
+    def test_same_key_in_another_workspace(self):
+        other_workspace = Path(self._temp.name, "other", "workspace")
+        os.makedirs(other_workspace)
+        for workspace in [self.workspace, other_workspace]:
+            os.makedirs(Path(workspace, ".mb", "inbox", "LIB", "m2-abc"), exist_ok=True)
+
+        def get_key(workspace):
+            env = { "MB_LIB_ROOT": str(Path(workspace, ".mb", "inbox", "LIB", "m2-abc")) }
+            return libmailcd.stagecache.get_key(workspace, self.stages["A"], "A", env, [], relpaths=[])
+
+        self.assertEqual(get_key(self.workspace), get_key(other_workspace))
+
+
+if __name__ == '__main__':
+    unittest.main()